@@ -0,0 +1,150 @@
+"""
+    Offline benchmarks of the osmgo stages on synthetic data
+
+    python benchmarks/run.py --scale small -o bench.json
+    python benchmarks/run.py --scale small -o bench_new.json --compare bench.json
+"""
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+import click
+
+# Benchmark the osmgo of this checkout, synthetic is imported from the script folder
+sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from synthetic import SCALES, THEMES, write_synthetic_pbf, write_clip  # noqa: E402
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return None
+
+
+def timed(fn, *args, **kwargs):
+    begin = time.perf_counter()
+    fn(*args, **kwargs)
+    return time.perf_counter() - begin
+
+
+def bench_export(pbf, clip, ext, themes, workdir):
+    """
+        Run ProcessOSM with the profile report and return the total seconds per stage
+    """
+    from osmgo.osmprocess import ProcessOSM
+    output = os.path.join(workdir, f'export_{ext}')
+    os.makedirs(output, exist_ok=True)
+    posm = ProcessOSM(pbf, output, 'bench', ext, themes, ['point', 'line', 'polygon'])
+    posm.clip_data = clip
+    posm.profile_report = os.path.join(workdir, f'report_{ext}.json')
+    begin = time.perf_counter()
+    posm.process()
+    results = {'total': time.perf_counter() - begin}
+    with open(posm.profile_report) as fp:
+        report = json.load(fp)
+    stages = defaultdict(float)
+    for span in report['spans']:
+        stages[span['stage']] += span['seconds']
+    results.update(stages)
+    return output, results
+
+
+def run_benchmarks(scale, exts, themes, osmconvert, workdir, repeat):
+    from osmgo.extract import write_poly, write_pbf
+    from osmgo.util import combine_gpkg
+
+    results = {}
+
+    def keep_best(name, seconds):
+        # Best of the repeats, the least noisy estimate on a shared machine
+        results[name] = min(seconds, results.get(name, seconds))
+
+    pbf = os.path.join(workdir, 'synthetic.osm.pbf')
+    clip = os.path.join(workdir, 'clip.shp')
+    print(f'Writing {scale} synthetic PBF')
+    keep_best('generate.pbf', timed(write_synthetic_pbf, pbf, osmconvert, **SCALES[scale]))
+    write_clip(clip)
+
+    for _ in range(repeat):
+        poly_output = os.path.join(workdir, 'extract.pbf')
+        keep_best('extract.write_poly', timed(write_poly, clip, poly_output, cache=False))
+        poly = os.path.join(workdir, 'clip.poly')
+        keep_best('extract.write_pbf', timed(write_pbf, pbf, poly_output, osmconvert, poly=poly))
+
+        for ext in exts:
+            output, stages = bench_export(pbf, clip, ext, themes, workdir)
+            for stage, seconds in stages.items():
+                keep_best(f'export.{ext}.{stage}', seconds)
+            if ext == 'gpkg':
+                combined = os.path.join(workdir, 'combined.gpkg')
+                if os.path.exists(combined):
+                    os.remove(combined)
+                keep_best('util.combine_gpkg', timed(combine_gpkg, output, combined, 'bench'))
+            shutil.rmtree(output)
+    return results
+
+
+def compare(results, baseline):
+    """
+        Print the change against a previous results file
+    """
+    print('{:<40}{:>12}{:>12}{:>10}'.format('benchmark', 'baseline', 'current', 'ratio'))
+    for name in sorted(set(results) | set(baseline)):
+        old = baseline.get(name)
+        new = results.get(name)
+        ratio = '' if not old or new is None else '{:.2f}'.format(new / old)
+        print('{:<40}{:>12}{:>12}{:>10}'.format(name, '' if old is None else '{:.3f}'.format(old),
+                                                '' if new is None else '{:.3f}'.format(new), ratio))
+
+
+@click.command()
+@click.option('--scale', type=click.Choice(list(SCALES)), default='small', show_default=True)
+@click.option('-e', '--ext', type=str, default='shp,gpkg', show_default=True, help='Export extensions to time')
+@click.option('-t', '--theme', type=str, help='Themes to export, default all')
+@click.option('-r', '--repeat', type=int, default=1, show_default=True, help='Repeats, the best time is kept')
+@click.option('-o', '--output', type=click.Path(), default='bench.json', show_default=True, help='Results JSON')
+@click.option('--compare', 'baseline', type=click.Path(exists=True), help='Results JSON of a previous run')
+@click.option('--workdir', type=click.Path(), help='Keep the synthetic data and outputs in this folder')
+@click.option('--osmconvert', envvar='OSMCONVERT', help='Path to osmconvert file')
+def main(scale, ext, theme, repeat, output, baseline, workdir, osmconvert):
+    from osmgo.extract import find_osmconvert
+    osmconvert_path = find_osmconvert(osmconvert)
+    if osmconvert_path is None:
+        print('Unable to find osmconvert program')
+        exit()
+    themes = list(THEMES) if theme is None else [each.strip() for each in theme.split(',')]
+    exts = [each.strip() for each in ext.split(',')]
+
+    keep = workdir is not None
+    if workdir is None:
+        workdir = tempfile.mkdtemp(prefix='osmgo_bench_')
+    os.makedirs(workdir, exist_ok=True)
+    try:
+        results = run_benchmarks(scale, exts, themes, osmconvert_path, workdir, repeat)
+    finally:
+        if not keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {'commit': git_commit(), 'date': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+              'platform': platform.platform(), 'scale': scale, 'config': SCALES[scale], 'themes': themes,
+              'repeat': repeat, 'results': results}
+    with open(output, 'w') as fp:
+        json.dump(report, fp, indent=2)
+    print(f'Results: {output}')
+
+    if baseline is not None:
+        with open(baseline) as fp:
+            compare(results, json.load(fp)['results'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+"""
+    Startup time of the osmgo CLI and of a pool worker, each measured in a fresh interpreter
+
+    python benchmarks/startup.py -o startup.json
+    python benchmarks/startup.py -o startup_new.json --compare startup.json
+"""
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import click
+
+from run import compare, git_commit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules that should only be loaded by the commands and workers that need them
+HEAVY = ['pyrosm', 'geopandas', 'pandas', 'numpy', 'shapely', 'pygeos', 'fiona', 'pyogrio', 'pyarrow', 'psutil']
+
+STARTUP = {
+    'cli.help': "from osmgo.cli.cli import cli; cli(['--help'])",
+    'cli.extract_help': "from osmgo.cli.cli import cli; cli(['extract', '--help'])",
+    'import.osmgo': 'import osmgo',
+    'import.worker': 'import osmgo.osmprocess',
+}
+
+
+def run_python(code):
+    """
+        Seconds to run code in a new interpreter, click exits the help commands with SystemExit
+    """
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([ROOT, os.environ.get('PYTHONPATH', '')]))
+    begin = time.perf_counter()
+    subprocess.run([sys.executable, '-c', f'try:\n    {code}\nexcept SystemExit:\n    pass'], env=env,
+                   stdout=subprocess.DEVNULL, check=True)
+    return time.perf_counter() - begin
+
+
+def loaded_modules(code):
+    """
+        Heavy modules imported by code
+    """
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([ROOT, os.environ.get('PYTHONPATH', '')]))
+    check = f'import sys, json\ntry:\n    {code}\nexcept SystemExit:\n    pass\n' \
+            f'print(json.dumps([m for m in {HEAVY!r} if m in sys.modules]), file=sys.stderr)'
+    result = subprocess.run([sys.executable, '-c', check], env=env, stdout=subprocess.DEVNULL,
+                            stderr=subprocess.PIPE, text=True, check=True)
+    return json.loads(result.stderr.strip().splitlines()[-1])
+
+
+@click.command()
+@click.option('-r', '--repeat', type=int, default=5, show_default=True, help='Repeats, the best time is kept')
+@click.option('-o', '--output', type=click.Path(), default='startup.json', show_default=True, help='Results JSON')
+@click.option('--compare', 'baseline', type=click.Path(exists=True), help='Results JSON of a previous run')
+def main(repeat, output, baseline):
+    # The interpreter alone, subtracted when reading the other results
+    results = {'python': min(run_python('pass') for _ in range(repeat))}
+    modules = {}
+    for name, code in STARTUP.items():
+        results[name] = min(run_python(code) for _ in range(repeat))
+        modules[name] = loaded_modules(code)
+        print('{:<24}{:>8.3f}s  {}'.format(name, results[name], ','.join(modules[name])))
+
+    report = {'commit': git_commit(), 'date': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+              'platform': platform.platform(), 'repeat': repeat, 'modules': modules, 'results': results}
+    with open(output, 'w') as fp:
+        json.dump(report, fp, indent=2)
+    print(f'Results: {output}')
+
+    if baseline is not None:
+        with open(baseline) as fp:
+            compare(results, json.load(fp)['results'])
+
+
+if __name__ == '__main__':
+    main()
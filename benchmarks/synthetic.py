@@ -0,0 +1,176 @@
+"""
+    Synthetic OSM data for the benchmarks.  The OSM XML is converted to PBF with the bundled osmconvert.
+"""
+import math
+import os
+import random
+import subprocess
+from xml.sax.saxutils import quoteattr
+
+# Theme keys and values of the synthetic tags, matches the themes of osmgo export
+THEMES = {
+    'aerialway': ['cable_car', 'chair_lift'], 'aeroway': ['runway', 'taxiway'], 'amenity': ['cafe', 'school', 'bank'],
+    'boundary': ['administrative'], 'building': ['yes', 'house', 'residential'], 'craft': ['carpenter'],
+    'emergency': ['fire_hydrant'], 'geological': ['outcrop'], 'highway': ['primary', 'residential', 'footway'],
+    'historic': ['memorial'], 'landuse': ['farmland', 'forest', 'residential'], 'leisure': ['park', 'pitch'],
+    'natural': ['water', 'wood', 'tree'], 'office': ['company'], 'place': ['village'], 'power': ['line', 'tower'],
+    'public_transport': ['platform'], 'railway': ['rail'], 'route': ['bus'], 'shop': ['bakery', 'supermarket'],
+    'tourism': ['hotel'], 'waterway': ['river', 'stream']}
+
+# Relative frequency of the themes, roughly the mix of a country extract
+WEIGHTS = {'building': 40, 'highway': 25, 'landuse': 6, 'natural': 6, 'amenity': 5, 'waterway': 3, 'shop': 2,
+           'leisure': 2, 'power': 2, 'railway': 1}
+
+# Themes drawn as closed areas, the others as lines
+AREAS = {'building', 'landuse', 'leisure', 'natural', 'amenity', 'aeroway', 'boundary'}
+
+SCALES = {'small': {'nodes': 5000, 'ways': 5000, 'relations': 100},
+          'medium': {'nodes': 100000, 'ways': 100000, 'relations': 2000},
+          'large': {'nodes': 1000000, 'ways': 1000000, 'relations': 20000}}
+
+
+class SyntheticOSM:
+    """
+        Write a reproducible OSM file of random tagged nodes, ways and multipolygon relations
+    """
+
+    def __init__(self, nodes=5000, ways=5000, relations=100, bbox=(1.40, 42.40, 1.80, 42.70), seed=1,
+                 themes=None, multi_theme=0.05):
+        self.nodes = nodes
+        self.ways = ways
+        self.relations = relations
+        self.bbox = bbox
+        self.random = random.Random(seed)
+        self.themes = themes or list(THEMES)
+        self.weights = [WEIGHTS.get(theme, 1) for theme in self.themes]
+        self.multi_theme = multi_theme  # Share of features with a second theme key
+        self._id = {'node': 0, 'way': 0, 'relation': 0}
+        self._lines = []
+        self._ways = []
+
+    def next_id(self, kind):
+        self._id[kind] += 1
+        return self._id[kind]
+
+    def point(self):
+        return (self.random.uniform(self.bbox[0], self.bbox[2]), self.random.uniform(self.bbox[1], self.bbox[3]))
+
+    def tags(self):
+        theme = self.random.choices(self.themes, self.weights)[0]
+        tags = {theme: self.random.choice(THEMES[theme])}
+        if self.random.random() < self.multi_theme:
+            other = self.random.choice(self.themes)
+            tags.setdefault(other, self.random.choice(THEMES[other]))
+        if self.random.random() < 0.3:
+            tags['name'] = 'name {}'.format(self.random.randint(0, 10000))
+        return theme, tags
+
+    def write_tags(self, tags):
+        return ''.join('<tag k={} v={}/>'.format(quoteattr(k), quoteattr(v)) for k, v in tags.items())
+
+    def node(self, lon, lat, tags=None):
+        node_id = self.next_id('node')
+        self._lines.append('<node id="{}" version="1" timestamp="2020-01-01T00:00:00Z" lat="{:.7f}" lon="{:.7f}">'
+                           '{}</node>'.format(node_id, lat, lon, self.write_tags(tags or {})))
+        return node_id
+
+    def way(self, refs, tags=None):
+        way_id = self.next_id('way')
+        self._ways.append('<way id="{}" version="1" timestamp="2020-01-01T00:00:00Z">{}{}</way>'.format(
+            way_id, ''.join(f'<nd ref="{ref}"/>' for ref in refs), self.write_tags(tags or {})))
+        return way_id
+
+    def ring(self, lon, lat, radius, vertices):
+        refs = []
+        for i in range(vertices):
+            angle = 2 * math.pi * i / vertices
+            refs.append(self.node(lon + radius * math.cos(angle), lat + radius * math.sin(angle) * 0.7))
+        return refs + refs[:1]
+
+    def write(self, path):
+        """
+            Write the OSM XML file.  Nodes, ways and relations are kept in separate lists to keep the
+            order osmconvert expects.
+        """
+        self._lines = []
+        self._ways = []
+        relations = []
+        for _ in range(self.nodes):
+            _, tags = self.tags()
+            self.node(*self.point(), tags=tags)
+        for _ in range(self.ways):
+            theme, tags = self.tags()
+            lon, lat = self.point()
+            if theme in AREAS:
+                self.way(self.ring(lon, lat, self.random.uniform(0.0001, 0.002), self.random.randint(4, 12)), tags)
+            else:
+                refs = [self.node(lon, lat)]
+                for _ in range(self.random.randint(1, 20)):
+                    lon += self.random.uniform(-0.002, 0.002)
+                    lat += self.random.uniform(-0.002, 0.002)
+                    refs.append(self.node(lon, lat))
+                self.way(refs, tags)
+        for _ in range(self.relations):
+            theme, tags = self.tags()
+            tags['type'] = 'multipolygon'
+            lon, lat = self.point()
+            radius = self.random.uniform(0.002, 0.01)
+            outer = self.way(self.ring(lon, lat, radius, self.random.randint(8, 64)))
+            inner = self.way(self.ring(lon, lat, radius / 3, self.random.randint(4, 16)))
+            relation_id = self.next_id('relation')
+            relations.append('<relation id="{}" version="1" timestamp="2020-01-01T00:00:00Z">'
+                             '<member type="way" ref="{}" role="outer"/><member type="way" ref="{}" role="inner"/>'
+                             '{}</relation>'.format(relation_id, outer, inner, self.write_tags(tags)))
+        with open(path, 'w') as fp:
+            fp.write('<?xml version="1.0" encoding="UTF-8"?>\n<osm version="0.6" generator="osmgo-benchmark">\n')
+            for lines in [self._lines, self._ways, relations]:
+                fp.write('\n'.join(lines))
+                fp.write('\n')
+            fp.write('</osm>\n')
+        self._lines = []
+        self._ways = []
+        return path
+
+
+def write_synthetic_pbf(path, osmconvert, **kwargs):
+    """
+        Write a synthetic PBF, kwargs are passed to SyntheticOSM
+    """
+    osm = os.path.splitext(path)[0] + '.osm'
+    SyntheticOSM(**kwargs).write(osm)
+    subprocess.run([osmconvert, osm, f'-o={path}'], check=True)
+    os.remove(osm)
+    return path
+
+
+def clip_polygon(bbox=(1.40, 42.40, 1.80, 42.70), vertices=20000, holes=10, seed=1):
+    """
+        Jagged polygon with many vertices and holes covering the middle of the bbox
+    """
+    from shapely.geometry import Polygon
+    rnd = random.Random(seed)
+    cx, cy = (bbox[0] + bbox[2]) / 2, (bbox[1] + bbox[3]) / 2
+    rx, ry = (bbox[2] - bbox[0]) * 0.4, (bbox[3] - bbox[1]) * 0.4
+    shell = []
+    for i in range(vertices):
+        angle = 2 * math.pi * i / vertices
+        scale = rnd.uniform(0.9, 1.0)
+        shell.append((cx + rx * scale * math.cos(angle), cy + ry * scale * math.sin(angle)))
+    interiors = []
+    for i in range(holes):
+        angle = 2 * math.pi * i / holes
+        hx, hy = cx + rx * 0.5 * math.cos(angle), cy + ry * 0.5 * math.sin(angle)
+        hr = min(rx, ry) * 0.05
+        interiors.append([(hx + hr * math.cos(2 * math.pi * j / 64), hy + hr * math.sin(2 * math.pi * j / 64))
+                          for j in range(64)])
+    return Polygon(shell, interiors)
+
+
+def write_clip(path, **kwargs):
+    """
+        Write the synthetic clip polygon to a shapefile
+    """
+    import geopandas as gpd
+    gdf = gpd.GeoDataFrame({'name': ['synthetic']}, geometry=[clip_polygon(**kwargs)], crs='EPSG:4326')
+    gdf.to_file(path)
+    return path
@@ -1,3 +1,28 @@
-from .osmprocess import *
-from .extract import *
-from .util import *
+import importlib
+
+# Public names of the submodules, imported on first access so `import osmgo` and the CLI start without
+# loading pyrosm, geopandas and GDAL
+_LAZY = {'ProcessOSM': 'osmprocess', 'kill_child_processes': 'osmprocess', 'split_themes': 'osmprocess',
+         'THEMES': 'osmprocess', 'FEATURES': 'osmprocess',
+         'find_osmconvert': 'extract', 'pbf_bounds': 'extract', 'write_pbf': 'extract', 'write_pbfs': 'extract',
+         'write_poly': 'extract', 'write_polys': 'extract', 'write_poly_file': 'extract',
+         'clip_fingerprint': 'extract', 'region_name': 'extract', 'region_names': 'extract', 'read_clip': 'extract',
+         'read_columns': 'schema', 'theme_columns': 'schema', 'compact': 'schema', 'DEFAULT_COLUMNS': 'schema',
+         'Manifest': 'manifest', 'apply_changes': 'update', 'read_changes': 'update', 'read_batches': 'stream',
+         'NodeIndex': 'index', 'build_index': 'index', 'load_jobs': 'jobs', 'run_jobs': 'jobs',
+         'WorkQueue': 'workqueue', 'run_worker': 'workqueue',
+         'copy_layer': 'util', 'combine_gpkg': 'util'}
+
+__all__ = list(_LAZY)
+
+
+def __getattr__(name):
+    if name in _LAZY:
+        value = getattr(importlib.import_module(f'.{_LAZY[name]}', __name__), name)
+        globals()[name] = value
+        return value
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+def __dir__():
+    return sorted(list(globals()) + list(_LAZY))
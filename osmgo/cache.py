@@ -0,0 +1,117 @@
+import glob
+import hashlib
+import os
+import geopandas as gpd
+
+# Bytes read from the start and end of the PBF for the content part of the cache key
+HASH_BLOCK = 1024 ** 2
+
+
+def pbf_fingerprint(inputs):
+    """
+        Fingerprint of a pbf from its size, modification time and the hash of its first and last block
+    """
+    stat = os.stat(inputs)
+    sha = hashlib.sha1('{}:{}'.format(stat.st_size, stat.st_mtime_ns).encode())
+    with open(inputs, 'rb') as fp:
+        sha.update(fp.read(HASH_BLOCK))
+        if stat.st_size > HASH_BLOCK:
+            fp.seek(max(HASH_BLOCK, stat.st_size - HASH_BLOCK))
+            sha.update(fp.read(HASH_BLOCK))
+    return sha.hexdigest()
+
+
+class ParseCache:
+    """
+        On disk cache of parsed theme GeoDataFrames stored as GeoParquet with least recently used eviction
+    """
+
+    def __init__(self, cache_dir, max_size=None):
+        self.cache_dir = cache_dir
+        self.max_size = max_size  # Bytes, None for no limit
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def available():
+        """
+            GeoParquet needs pyarrow
+        """
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            return False
+        return True
+
+    @staticmethod
+    def key(fingerprint, extent, theme, mode=''):
+        return hashlib.sha1('{}|{}|{}|{}'.format(fingerprint, extent, theme, mode).encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, f'{key}.parquet')
+
+    def empty_path(self, key):
+        return os.path.join(self.cache_dir, f'{key}.empty')
+
+    def has(self, key):
+        return os.path.exists(self.path(key)) or os.path.exists(self.empty_path(key))
+
+    def get(self, key):
+        """
+            Return (hit, gdf). An empty theme is a hit with gdf None.
+        """
+        for path in [self.path(key), self.empty_path(key)]:
+            if os.path.exists(path):
+                # Touch the entry so eviction removes the least recently used first
+                os.utime(path)
+                if path.endswith('.empty'):
+                    return True, None
+                try:
+                    return True, gpd.read_parquet(path)
+                except Exception as e:
+                    print(f'Unable to read cache {path} {e}')
+                    os.remove(path)
+        return False, None
+
+    def put(self, key, gdf):
+        if gdf is None:
+            open(self.empty_path(key), 'w').close()
+            return
+        path = self.path(key)
+        temp = f'{path}.{os.getpid()}.tmp'
+        try:
+            gdf.to_parquet(temp, compression='zstd')
+            os.replace(temp, path)
+        except Exception as e:
+            print(f'Unable to cache {key} {e}')
+            if os.path.exists(temp):
+                os.remove(temp)
+            return
+        self.evict()
+
+    def evict(self):
+        """
+            Remove the least recently used entries until the cache fits max_size, an entry is the GeoParquet or
+            the empty marker of a key
+        """
+        if self.max_size is None:
+            return
+        entries = {}
+        for path in glob.glob(os.path.join(self.cache_dir, '*.parquet')) + \
+                glob.glob(os.path.join(self.cache_dir, '*.empty')):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            key = os.path.splitext(os.path.basename(path))[0]
+            used, size = entries.get(key, (0, 0))
+            entries[key] = (max(used, stat.st_mtime), size + stat.st_size)
+        total = sum(size for _, size in entries.values())
+        for used, key in sorted((used, key) for key, (used, _) in entries.items()):
+            if total <= self.max_size:
+                break
+            for path in [self.path(key), self.empty_path(key)]:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            total -= entries[key][1]
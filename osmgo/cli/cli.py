@@ -1,9 +1,9 @@
 import os
 import sys
+import time
 import click
-from osmgo.extract import write_poly, write_pbf
-from osmgo.osmprocess import ProcessOSM, kill_child_processes
-from osmgo.util import combine_gpkg
+# Only the light extract module is imported here, the commands import pyrosm, geopandas and GDAL when they run
+from osmgo.extract import find_osmconvert, extract_pbf
 #from concurrent.futures import ProcessPoolExecutor, as_completed
 
 
@@ -18,7 +18,7 @@ osmgo andorra-latest.osm.pbf C:/OSM/output -c C:/OSM/andorra.shp -w 4
 
 
 # noinspection SpellCheckingInspection
-@cli.command('export', short_help='Export PBF to shp,geojson,gpkg')
+@cli.command('export', short_help='Export PBF to shp,geojson,gpkg,fgb,parquet')
 @click.argument('inputs', type=click.Path(exists=True))
 @click.argument('output', type=click.Path(exists=True))
 @click.argument('prefix', type=str)
@@ -28,9 +28,46 @@ osmgo andorra-latest.osm.pbf C:/OSM/output -c C:/OSM/andorra.shp -w 4
 @click.option('-t', '--theme', type=str, help='Individual themes in a comma separated list.')
 @click.option('-f', '--feature', type=str, help='Feature type point,line,polygon')
 @click.option('-w', '--workers', type=int, default=1, show_default=True, help='Number of workers')
-@click.option('-e', '--ext', type=str, default='shp', show_default=True, help='shp,geojson,gpkg')
+@click.option('-e', '--ext', type=str, default='shp', show_default=True, help='shp,geojson,gpkg,fgb,parquet')
 @click.option('--keep', is_flag=True, show_default=True, help='Keep bad geometries')
-def export(inputs, output, prefix, clip_data, theme, feature, workers, ext, keep, bbox, layer):
+@click.option('--single-pass', is_flag=True, show_default=True, help='Parse the PBF once for all themes')
+@click.option('--tiles', type=str, help='Process the extent as a NxM grid of tiles')
+@click.option('--tile-size', type=float, help='Process the extent in tiles of this size in decimal degrees')
+@click.option('--osmconvert', envvar='OSMCONVERT', help='Path to osmconvert file')
+@click.option('--max-memory', type=str, help='Memory budget for the workers e.g. 8G')
+@click.option('--clip-threads', type=int, default=1, show_default=True,
+              help='Threads per worker intersecting features on the clip boundary')
+@click.option('--cache-dir', envvar='OSMGO_CACHE', type=click.Path(),
+              default=os.path.join(os.path.expanduser('~'), '.osmgo', 'cache'), show_default=True,
+              help='Folder of the parse cache, on by default')
+@click.option('--cache-size', type=str, default='10G', show_default=True,
+              help='Size limit of the parse cache, least recently used themes are removed above it')
+@click.option('--no-cache', is_flag=True, show_default=True, help='Do not read or write the parse cache')
+@click.option('--single-gpkg', is_flag=True, show_default=True, help='Write all layers into OUTPUT/PREFIX.gpkg')
+@click.option('--write-threads', type=int, default=1, show_default=True,
+              help='Background write threads per worker, 0 writes inline')
+@click.option('--profile-report', type=click.Path(), help='Write stage timings to a *.json or *.csv report')
+@click.option('--profile-tasks', type=click.Path(), help='Folder for a profile of each worker task')
+@click.option('--profiler', type=click.Choice(['cprofile', 'pyinstrument']), default='cprofile', show_default=True,
+              help='Profiler used with --profile-tasks')
+@click.option('--prefilter', is_flag=True, show_default=True, help='Filter the PBF to the theme keys before parsing')
+@click.option('--osmium', envvar='OSMIUM', help='Path to the osmium tool used by --prefilter')
+@click.option('--no-split', is_flag=True, show_default=True, help='Do not split heavy themes into smaller tasks')
+@click.option('--columns', type=str, help="Tag columns per theme, default or a JSON file of theme: [tag, ...]")
+@click.option('--resume', is_flag=True, show_default=True, help='Skip the outputs finished by a previous run')
+@click.option('--split-by', type=str, help='Clip attribute used to write the outputs of each clip feature')
+@click.option('--stream', is_flag=True, show_default=True, help='Stream the PBF in batches with bounded memory')
+@click.option('--batch-size', type=int, default=50000, show_default=True,
+              help='Features per theme held in memory with --stream')
+@click.option('--node-store', type=click.Choice(['sparse_file_array', 'dense_file_array', 'flex_mem']),
+              default='sparse_file_array', show_default=True, help='Way node location store used with --stream')
+@click.option('--queue', type=click.Path(), help='Shared folder of a work queue run by osmgo worker on any host')
+@click.option('--lease', type=int, default=120, show_default=True,
+              help='Seconds a queued unit stays claimed by a worker without a heartbeat')
+def export(inputs, output, prefix, clip_data, theme, feature, workers, ext, keep, bbox, layer, single_pass, tiles,
+           tile_size, osmconvert, max_memory, clip_threads, cache_dir, cache_size, no_cache, single_gpkg,
+           write_threads, profile_report, profile_tasks, profiler, prefilter, osmium, no_split,
+           columns, resume, split_by, stream, batch_size, node_store, queue, lease):
     # noinspection SpellCheckingInspection
     """
 
@@ -46,8 +83,65 @@ def export(inputs, output, prefix, clip_data, theme, feature, workers, ext, keep
         highway,historic,landuse,leisure,man_made,military,natural,office
         ,place,power,public_transport,railway,route,shop,sport,tourism ,waterway
 
+        Extension fgb writes FlatGeobuf with a spatial index and parquet writes zstd compressed GeoParquet
+
+        The --single-gpkg if set sends the layers from the workers to one writer that appends them to
+        OUTPUT/PREFIX.gpkg, replacing the combine step
+
+        The --profile-report if set records the time, feature count, bytes written and memory of each stage
+        per theme and feature type.  --profile-tasks saves a cProfile or pyinstrument profile per worker task
+
         The --keep if set retains invalid polygons geometries from the OSM and does not clip the data
 
+        The --single-pass if set decodes the PBF once for all themes and hands each theme to the workers
+
+        The --prefilter if set first writes a copy of the PBF with only the objects tagged with the theme keys
+        and the nodes and members they reference, so pyrosm parses a smaller file.  It uses osmium tags-filter
+        when the osmium tool is found, otherwise pyosmium
+
+        The --tiles or --tile-size if set cuts the extent into tiles with osmconvert, processes the tiles
+        in the workers and merges the tile outputs
+
+        Themes are started longest first using their run time from previous exports.  With more than one
+        worker a theme expected to take longer than its share of the work is split, per feature type with
+        --single-pass, otherwise into spatial chunks cut with osmconvert, and the parts are merged when
+        written.  --no-split turns the split off
+
+        The --columns if set parses only the listed tags of each theme as columns, the other tags stay in
+        the JSON tags column, with --single-pass they are dropped.  'default' uses the built in columns, a
+        JSON file of theme: [tag, ...] overrides them per theme.  Tag columns that are empty are dropped and
+        text columns with few distinct values such as the theme key are stored as categoricals
+
+        Outputs are written under a temporary name and renamed when complete, and each finished output is
+        recorded with a hash of its inputs and settings in OUTPUT/PREFIX_manifest.jsonl.  The --resume if set
+        skips the outputs the manifest records as finished and only reruns the missing or stale ones
+
+        The --split-by if set parses the PBF once for the union of the clip features, assigns the features to
+        the clip features they intersect and writes each clip feature's outputs as PREFIX_<value>_theme_geo.
+        The regions are clipped --clip-threads at a time
+
+        The --stream if set reads the PBF once with pyosmium and appends each theme to its outputs in batches
+        of --batch-size features, so memory stays flat whatever the size of the PBF.  Way nodes are located
+        from a memory mapped file in OUTPUT, sparse_file_array suits extracts and dense_file_array continents
+        or the planet.  The outputs keep the built in or --columns tag columns and are written as shp or gpkg
+
+        The --queue if set breaks the export into units of a theme per tile with --tiles or --tile-size, per
+        region bounds with --split-by, otherwise per theme, and puts them in a work queue in the shared folder.
+        Any number of osmgo worker processes on hosts sharing the folder claim and run the units, -w starts
+        that many local workers and 0 only coordinates.  A worker renews the lease of its unit while it runs,
+        a unit whose worker stops for longer than --lease goes back to the queue and fails after 3 runs.  The
+        unit outputs are merged when all units are finished.  With --resume the units finished by a queue left
+        by the same export are kept
+
+        The --max-memory if set limits the address space of each worker to its share of the budget and only
+        starts tasks when there is headroom.  pyarrow and GDAL reserve address space they never use, so leave
+        room above the resident memory the workers need.  Tasks that run out of memory are retried with fewer
+        workers, then a theme or tile still too large for one worker is split into four spatial parts
+
+        Parsed themes are cached as GeoParquet in --cache-dir keyed by the PBF, the clip/bbox extent and the
+        theme, so later exports of the same data skip the PBF parse.  The cache is on by default and holds up
+        to --cache-size, ~/.osmgo/cache and 10G unless set.  --no-cache turns the cache off
+
         Example:
 
         osmgo export andorra-latest.osm.pbf output andorra-l-nstfs -t highway -f line -c andorra_hole.shp
@@ -55,7 +149,19 @@ def export(inputs, output, prefix, clip_data, theme, feature, workers, ext, keep
         osmgo export andorra-latest.osm.pbf  output andorra_e_l-ns3  -t highway -f line -b 1.4275,42.4705,1.7201,42.6325
 
         osmgo export andorra-latest.osm.pbf  output andorra_e_l-ns3  -t highway -f line  -c ../andorra.gdb -l andorra_hole
+
+        osmgo export andorra-latest.osm.pbf  output andorra-tiles -w 4 --tiles 2x2
+
+        osmgo export andorra-latest.osm.pbf  output andorra -w 4 -c andorra_parishes.shp --split-by name
+
+        osmgo export andorra-latest.osm.pbf  output andorra -w 2 --tiles 4x4 --queue /shared/andorra-queue
         """
+    from osmgo.osmprocess import ProcessOSM, THEMES, FEATURES
+    from osmgo.scheduler import parse_memory
+    from osmgo.cache import ParseCache
+    from osmgo.writer import DRIVERS
+    from osmgo.tiles import parse_tiles
+    from osmgo.manifest import Manifest
 
     print(f'Input PBF: {inputs}')
     print(f'Output folder: {output}')
@@ -67,16 +173,20 @@ def export(inputs, output, prefix, clip_data, theme, feature, workers, ext, keep
 
     print(f'Workers: {workers}')
     print(f'Keep bad geometries: {keep}')
+    print(f'Single pass: {single_pass}')
+    print(f'Resume: {resume}')
 
-    if ext not in ['shp', 'geojson', 'gpkg']:
+    if ext not in DRIVERS:
         print('Please select valid extension')
         exit()
     else:
         print(f'Output extension: {ext}')
 
-    _themes = ['aerialway', 'aeroway', 'amenity', 'boundary', 'building', 'craft', 'emergency', 'geological',
-               'highway', 'historic', 'landuse', 'leisure', 'natural', 'office', 'place', 'power', 'public_transport',
-               'railway', 'route', 'shop', 'tourism', 'waterway']
+    if single_gpkg and ext != 'gpkg':
+        print('Single gpkg requires the gpkg extension')
+        exit()
+
+    _themes = THEMES
 
     if theme is None:
         themes = _themes
@@ -91,7 +201,7 @@ def export(inputs, output, prefix, clip_data, theme, feature, workers, ext, keep
                 exit()
     print('Processing the following themes {}'.format(','.join(themes)))
 
-    _features = ['point', 'line', 'polygon']
+    _features = FEATURES
 
     if feature is None:
         features = _features
@@ -134,6 +244,79 @@ def export(inputs, output, prefix, clip_data, theme, feature, workers, ext, keep
             print('GDB missing layer flag')
             exit()
 
+    if split_by is not None:
+        if clip_data is None:
+            print('Split by requires clip data')
+            exit()
+        print(f'Split by: {split_by}')
+
+    if stream:
+        from osmgo.stream import stream_available
+        from osmgo.writer import STREAM_EXTS
+        if not stream_available():
+            print('Stream requires pyosmium 4')
+            exit()
+        if ext not in STREAM_EXTS or single_gpkg:
+            print('Stream writes {} outputs'.format(','.join(STREAM_EXTS)))
+            exit()
+        if single_pass or tiles is not None or tile_size is not None:
+            print('Stream reads the PBF once, it does not combine with single pass or tiles')
+            exit()
+        if batch_size < 1:
+            print('Batch size must be greater than 0')
+            exit()
+        print(f'Stream: batches of {batch_size} features')
+
+    if queue is not None:
+        if stream or single_pass or single_gpkg:
+            print('Queue runs the units in workers, it does not combine with stream, single pass or single gpkg')
+            exit()
+        if lease < 1:
+            print('Lease must be at least 1 second')
+            exit()
+        print(f'Queue: {queue}')
+
+    grid = None
+    if tiles is not None and tile_size is not None:
+        print('Tiles and tile size selected')
+        exit()
+    if tiles is not None:
+        grid = parse_tiles(tiles)
+        if grid is None:
+            print(f'{tiles} is not a valid NxM tile grid')
+            exit()
+        print(f'Tiles {grid[0]}x{grid[1]}')
+    if tile_size is not None:
+        if tile_size <= 0:
+            print('Tile size must be greater than 0')
+            exit()
+        print(f'Tile size {tile_size}')
+    osmconvert_path = find_osmconvert(osmconvert)
+    if osmconvert_path is None and (grid is not None or tile_size is not None or
+                                    (queue is not None and split_by is not None)):
+        print('Unable to find osmconvert program in {} or {}'.format(os.path.join(sys.prefix, 'bin/osmconvert'),
+                                                                     osmconvert))
+        exit()
+    # Also used to cut heavy themes into chunks when it is found
+    osmconvert = osmconvert_path
+
+    schema = None
+    if columns is not None:
+        from osmgo.schema import read_columns
+        schema, error = read_columns(columns)
+        if error is not None:
+            print(error)
+            exit()
+        print(f'Columns: {columns}')
+
+    memory = None
+    if max_memory is not None:
+        memory = parse_memory(max_memory)
+        if memory is None:
+            print(f'{max_memory} is not a valid memory size')
+            exit()
+        print(f'Max memory: {max_memory}')
+
     # process(input, output, themes, features,workers,clip_data)
     posm = ProcessOSM(inputs, output, prefix, ext, themes, features)
 
@@ -148,9 +331,74 @@ def export(inputs, output, prefix, clip_data, theme, feature, workers, ext, keep
     if keep:
         posm.keep = True
 
+    if single_pass:
+        posm.single_pass = True
+
     if bbox is not None:
         posm.bbox = box
 
+    if memory is not None:
+        posm.max_memory = memory
+
+    if clip_threads > 1:
+        posm.clip_threads = clip_threads
+
+    if single_gpkg:
+        posm.single_gpkg = True
+
+    if write_threads != 1:
+        posm.write_threads = max(0, write_threads)
+
+    if profile_report is not None:
+        posm.profile_report = profile_report
+
+    if profile_tasks is not None:
+        os.makedirs(profile_tasks, exist_ok=True)
+        posm.profiler = (profiler, profile_tasks)
+
+    if not no_cache:
+        if ParseCache.available():
+            cache_limit = parse_memory(cache_size)
+            if cache_limit is None:
+                print(f'{cache_size} is not a valid cache size')
+                exit()
+            print(f'Parse cache: {cache_dir} up to {cache_size}')
+            posm.cache = ParseCache(cache_dir, max_size=cache_limit)
+        else:
+            print('Parse cache needs pyarrow, continuing without cache')
+
+    if grid is not None or tile_size is not None:
+        posm.tiles = grid
+        posm.tile_size = tile_size
+    posm.osmconvert = osmconvert
+
+    if no_split:
+        posm.split = False
+
+    if schema is not None:
+        posm.columns = schema
+
+    if split_by is not None:
+        posm.split_by = split_by
+
+    if stream:
+        posm.stream = True
+        posm.batch_size = batch_size
+        posm.node_store = node_store
+
+    if queue is not None:
+        posm.queue = queue
+        posm.lease = lease
+        posm.queue_workers = max(0, workers)
+
+    posm.manifest = Manifest(os.path.join(output, f'{prefix}_manifest.jsonl'))
+    if resume:
+        posm.resume = True
+
+    if prefilter:
+        posm.prefilter = True
+        posm.osmium = osmium
+
     posm.process()
 
     #
@@ -184,10 +432,22 @@ osmgo extract andorra-latest.osm.pbf andorra-extract_sub1.pbf -c andorra_hole.sh
 @click.option('-b', '--bbox', type=str, help='minx,miny,maxx,maxy in decimal degrees')
 @click.option('-l', '--layer', type=str, help='layer name used in gdb')
 @click.option('--osmconvert', envvar='OSMCONVERT', help='Path to osmconvert file')
-def extract(inputs, output, osmconvert, bbox, clip_data, layer):
+@click.option('--split-by', type=str, help='Attribute used to write one PBF per clip feature into the OUTPUT folder')
+@click.option('-w', '--workers', type=int, default=1, show_default=True, help='Number of workers')
+@click.option('--simplify', type=float, help='Simplify the clip polygons with this tolerance in decimal degrees')
+@click.option('--keep-themes', type=str, help='Keep only the objects of these themes in a comma separated list')
+@click.option('--osmium', envvar='OSMIUM', help='Path to the osmium tool used by --keep-themes')
+def extract(inputs, output, osmconvert, bbox, clip_data, layer, split_by, workers, simplify, keep_themes, osmium):
     """
     Extract PBF file
 
+    With --split-by OUTPUT is a folder and each clip feature is written to <attribute value>.pbf
+
+    The *.poly written from the clip data is reused while the clip data and --simplify are unchanged
+
+    With --keep-themes the input is first filtered to the objects tagged with the theme keys and the nodes
+    and members they reference, with osmium tags-filter when the osmium tool is found, otherwise pyosmium
+
     Example:
 
     osmgo extract andorra-latest.osm.pbf andorra-extract_sub1.pbf -c andorra_hole.shp
@@ -197,15 +457,17 @@ def extract(inputs, output, osmconvert, bbox, clip_data, layer):
     osmgo extract andorra-latest.osm.pbf andorra-extract_lc.pbf -c andorra.gdb -l andorra_hole
 
     osmgo extract andorra-latest.osm.pbf andorra-extract_lc.pbf -c andorra_hole.shp
+
+    osmgo extract andorra-latest.osm.pbf regions -c andorra_parishes.shp --split-by name -w 4
+
+    osmgo extract andorra-latest.osm.pbf andorra-roads.pbf -c andorra_hole.shp --keep-themes highway,railway
     """
-    if os.path.exists(os.path.join(sys.prefix, 'bin/osmconvert')):
-        osmconvert = os.path.join(sys.prefix, 'bin/osmconvert')
-    elif os.path.exists(osmconvert):
-        osmconvert = osmconvert
-    else:
+    osmconvert_path = find_osmconvert(osmconvert)
+    if osmconvert_path is None:
         print('Unable to find osmconvert program in {} or {}'.format(os.path.join(sys.prefix, 'bin/osmconvert'),
                                                                      osmconvert))
         exit()
+    osmconvert = osmconvert_path
 
     print(f'Path to osmconvert: {osmconvert}')
     if bbox is None:
@@ -237,18 +499,51 @@ def extract(inputs, output, osmconvert, bbox, clip_data, layer):
             print('GDB missing layer flag')
             exit()
 
-    if clip_data is not None:
-        if os.path.splitext(clip_data)[-1] == '.shp':
-            poly = write_poly(clip_data, output)
-            write_pbf(inputs, output, osmconvert, poly=poly)
-        else:
-            poly = write_poly(clip_data, output, layer=layer)
-            write_pbf(inputs, output, osmconvert, poly=poly)
-    elif box is not None:
-        print('bbox')
-        write_pbf(inputs, output, osmconvert, bbox=box)
-    else:
-        write_pbf(inputs, output, osmconvert)
+    if split_by is not None and clip_data is None:
+        print('Split by requires clip data')
+        exit()
+
+    keys = None
+    if keep_themes is not None:
+        from osmgo.osmprocess import THEMES
+        keys = []
+        for each in keep_themes.split(','):
+            each = each.strip()
+            if each in THEMES:
+                keys.append(each)
+            else:
+                print(f'Theme {each} is misspelled or missing')
+                exit()
+
+    if not extract_pbf(inputs, output, osmconvert, clip_data=clip_data, bbox=box, layer=layer, split_by=split_by,
+                       workers=workers, simplify=simplify, keep_themes=keys, osmium=osmium):
+        exit()
+
+
+@cli.command('index', short_help='Index the node coordinates and way nodes of a PBF')
+@click.argument('inputs', type=click.Path(exists=True))
+@click.option('--osmconvert', envvar='OSMCONVERT', help='Path to osmconvert file')
+def index(inputs, osmconvert):
+    """
+        INPUTS is the name of the PBF file
+
+        Writes INPUTS.osmgo-index next to the PBF holding the node ids and coordinates and the node ids of
+        each way as flat arrays sorted by id.  The arrays are memory mapped so every worker reads the same
+        pages.  An export with --stream and an update use the index while it matches the size and time
+        of the PBF, build it again after the PBF changes.  The way node lists need pyosmium
+
+        Example:
+
+        osmgo index andorra-latest.osm.pbf
+    """
+    from osmgo.index import build_index
+    osmconvert_path = find_osmconvert(osmconvert)
+    if osmconvert_path is None:
+        print('Unable to find osmconvert program in {} or {}'.format(os.path.join(sys.prefix, 'bin/osmconvert'),
+                                                                     osmconvert))
+        exit()
+    if build_index(inputs, osmconvert_path) is None:
+        exit()
 
 
 @cli.command('combine', short_help='Combine gpkg')
@@ -263,7 +558,348 @@ def combine(inputs, output, prefix):
 
         PREFIX of the GPKG in INPUTS folder
     """
+    from osmgo.util import combine_gpkg
     if os.path.exists(output):
         print(f'{output} already exists please delete before continuing')
         exit()
     combine_gpkg(inputs, output, prefix)
+
+
+@cli.command('worker', short_help='Run the units of an export work queue')
+@click.argument('queue', type=click.Path())
+@click.option('--wait', type=int, default=60, show_default=True, help='Seconds to wait for the queue to be started')
+@click.option('--osmconvert', envvar='OSMCONVERT', help='Path to osmconvert file')
+def worker(queue, wait, osmconvert):
+    """
+        QUEUE is the shared folder of an osmgo export --queue
+
+        Claims units from the queue and runs them until no unit is waiting or running, then exits.  Start as
+        many workers as each host has cores to spare, every host must see the PBF, the clip data, the output
+        folder and QUEUE at the same paths as the export.  Units are cut from the PBF with osmconvert when the
+        export uses tiles or --split-by
+
+        Example:
+
+        osmgo worker /shared/andorra-queue
+    """
+    from osmgo.workqueue import run_worker
+    run_worker(queue, osmconvert=find_osmconvert(osmconvert), wait=wait)
+
+
+@cli.command('serve', short_help='Serve export requests for a resident PBF')
+@click.argument('inputs', type=click.Path(exists=True))
+@click.argument('output', type=click.Path(exists=True))
+@click.option('-t', '--theme', type=str, help='Themes parsed once at start and kept in memory')
+@click.option('-w', '--workers', type=int, default=1, show_default=True, help='Number of workers')
+@click.option('--host', type=str, default='127.0.0.1', show_default=True, help='Host to listen on')
+@click.option('--port', type=int, default=8765, show_default=True, help='Port to listen on')
+@click.option('--socket', 'socket_path', type=click.Path(), help='Listen on this Unix socket instead of a port')
+@click.option('--max-queue', type=int, default=16, show_default=True,
+              help='Requests waiting before new ones are refused')
+@click.option('--cache-dir', envvar='OSMGO_CACHE', type=click.Path(),
+              default=os.path.join(os.path.expanduser('~'), '.osmgo', 'cache'), show_default=True,
+              help='Folder of the parse cache, on by default')
+@click.option('--cache-size', type=str, default='10G', show_default=True,
+              help='Size limit of the parse cache, least recently used themes are removed above it')
+@click.option('--no-cache', is_flag=True, show_default=True, help='Do not read or write the parse cache')
+def serve(inputs, output, theme, workers, host, port, socket_path, max_queue, cache_dir, cache_size, no_cache):
+    """
+        INPUTS is the name of the PBF file
+
+        OUTPUT is the folder the request outputs are written to, one sub folder per request
+
+        The themes in --theme are parsed once for the whole PBF and each request clips them, other themes are
+        parsed per request.  Requests are JSON posted to /export:
+
+        {"themes": "highway,building", "features": "line", "bbox": [1.4275, 42.4705, 1.7201, 42.6325],
+        "ext": "gpkg", "prefix": "andorra"}
+
+        "clip" takes a Polygon or MultiPolygon WKT in place of "bbox".  POST /export?wait=1 answers when the
+        request is finished, otherwise GET /jobs/<id> returns its status.  GET /status shows the queue.
+
+        Example:
+
+        osmgo serve andorra-latest.osm.pbf output -t highway,building -w 4
+
+        curl -d '{"themes": "highway", "bbox": "1.4275,42.4705,1.7201,42.6325"}' localhost:8765/export?wait=1
+    """
+    from osmgo.server import ExportServer, preload_themes, serve as serve_requests
+    from osmgo.osmprocess import THEMES
+    from osmgo.cache import ParseCache
+    from osmgo.scheduler import parse_memory
+
+    themes = []
+    if theme is not None:
+        for each in theme.split(','):
+            each = each.strip()
+            if each in THEMES:
+                themes.append(each)
+            else:
+                print(f'Theme {each} is misspelled or missing')
+                exit()
+
+    cache = None
+    if not no_cache and ParseCache.available():
+        cache_limit = parse_memory(cache_size)
+        if cache_limit is None:
+            print(f'{cache_size} is not a valid cache size')
+            exit()
+        print(f'Parse cache: {cache_dir} up to {cache_size}')
+        cache = ParseCache(cache_dir, max_size=cache_limit)
+
+    if len(themes) > 0:
+        begin_time = time.time()
+        print('Loading the following themes {}'.format(','.join(themes)))
+        preload_themes(inputs, themes, cache=cache)
+        print('Done loading after {} seconds.'.format(round(time.time() - begin_time, 0)))
+
+    serve_requests(ExportServer(inputs, output, workers=max(1, workers), max_queue=max_queue, cache=cache,
+                                themes=themes), host=host, port=port, socket_path=socket_path)
+
+
+@cli.command('update', short_help='Apply change files and update the outputs of an export')
+@click.argument('inputs', type=click.Path(exists=True))
+@click.argument('output', type=click.Path(exists=True))
+@click.argument('prefix', type=str)
+@click.argument('changes', nargs=-1, required=True, type=click.Path(exists=True))
+@click.option('-c', '--clip_data', type=click.Path(exists=True), help='Path to clip *.shp')
+@click.option('-b', '--bbox', type=str, help='minx,miny,maxx,maxy in decimal degrees')
+@click.option('-l', '--layer', type=str, help='layer name used in gdb')
+@click.option('-t', '--theme', type=str, help='Individual themes in a comma separated list.')
+@click.option('-f', '--feature', type=str, help='Feature type point,line,polygon')
+@click.option('-w', '--workers', type=int, default=1, show_default=True, help='Number of workers')
+@click.option('-e', '--ext', type=str, default='shp', show_default=True, help='shp,geojson,gpkg,fgb,parquet')
+@click.option('--keep', is_flag=True, show_default=True, help='Keep bad geometries')
+@click.option('--columns', type=str, help="Tag columns per theme, default or a JSON file of theme: [tag, ...]")
+@click.option('--tiles', type=str, help='Locate the changes in a NxM grid of tiles')
+@click.option('--tile-size', type=float, help='Locate the changes in tiles of this size in decimal degrees')
+@click.option('--updated', type=click.Path(), help='Path of the updated PBF, defaults to INPUTS_updated.osm.pbf')
+@click.option('--in-place', is_flag=True, show_default=True, help='Replace INPUTS with the updated PBF')
+@click.option('--osmconvert', envvar='OSMCONVERT', help='Path to osmconvert file')
+def update(inputs, output, prefix, changes, clip_data, bbox, layer, theme, feature, workers, ext, keep, columns,
+           tiles, tile_size, updated, in_place, osmconvert):
+    """
+        INPUTS is the PBF of the previous export
+
+        OUTPUT is the output folder of the previous export
+
+        PREFIX is the prefix of the previous export
+
+        CHANGES are one or more *.osc or *.osc.gz change files in the order they apply
+
+        The change files are applied to INPUTS with osmconvert and the updated PBF is written next to INPUTS
+        with _updated before the extension, or to --updated.  --in-place replaces INPUTS instead.  The next
+        update of the export takes the updated PBF as INPUTS.  The themes tagged on the changed objects, or
+        holding them in the previous outputs, are exported again from only the tiles holding the changes and
+        the new features replace the changed ones in the previous outputs.  The other outputs are kept as they
+        are.  A moved or deleted node updates the themes holding the ways using it, found through the node
+        index of INPUTS built with osmgo index.  Without an index it updates all themes in its tiles.
+
+        The options must match the previous export, outputs the manifest does not record as finished with the
+        same settings are exported in full.  The tiles are 0.25 degrees unless --tiles or --tile-size is set.
+        Locating changed ways and relations needs pyosmium, without it all tiles are updated
+
+        Example:
+
+        osmgo update andorra-latest.osm.pbf output andorra -t highway,building -c andorra_hole.shp 4101.osc.gz
+
+        osmgo update andorra-latest.osm.pbf output andorra -w 4 --updated andorra-new.osm.pbf 4101.osc.gz 4102.osc.gz
+
+        osmgo update andorra-new.osm.pbf output andorra -e gpkg -w 4 --in-place 4103.osc.gz
+    """
+    from osmgo.osmprocess import ProcessOSM, THEMES, FEATURES
+    from osmgo.writer import DRIVERS
+    from osmgo.tiles import parse_tiles
+    from osmgo.manifest import Manifest
+
+    print(f'Input PBF: {inputs}')
+    print(f'Output folder: {output}')
+    print(f'Output prefix: {prefix}')
+    print('Change files: {}'.format(','.join(changes)))
+    if ext not in DRIVERS:
+        print('Please select valid extension')
+        exit()
+    osmconvert_path = find_osmconvert(osmconvert)
+    if osmconvert_path is None:
+        print('Unable to find osmconvert program in {} or {}'.format(os.path.join(sys.prefix, 'bin/osmconvert'),
+                                                                     osmconvert))
+        exit()
+    for change in changes:
+        if not change.endswith(('.osc', '.osc.gz')):
+            print(f'{change} not a .osc or .osc.gz')
+            exit()
+    if in_place:
+        if updated is not None:
+            print('In place and updated PBF selected')
+            exit()
+        updated = inputs
+    elif updated is None:
+        from osmgo.update import updated_path
+        updated = updated_path(inputs)
+    elif os.path.abspath(updated) == os.path.abspath(inputs):
+        print('Updated PBF is INPUTS, use --in-place to replace it')
+        exit()
+    print(f'Updated PBF: {updated}')
+
+    themes = THEMES
+    if theme is not None:
+        themes = []
+        for each in theme.split(','):
+            each = each.strip()
+            if each in THEMES:
+                themes.append(each)
+            else:
+                print(f'Theme {each} is misspelled or missing')
+                exit()
+    features = FEATURES
+    if feature is not None:
+        features = []
+        for each in feature.split(','):
+            each = each.strip()
+            if each in FEATURES:
+                features.append(each)
+            else:
+                print(f'Feature {each} is misspelled or missing')
+                exit()
+
+    box = None
+    if bbox is not None:
+        box = []
+        for each in bbox.split(','):
+            each = each.strip()
+            try:
+                box.append(float(each))
+            except ValueError:
+                print(f'{each} not a integer or float value')
+                exit()
+        if box[0] >= box[2] or box[1] >= box[3]:
+            print('Coordinates out of sequence')
+            exit()
+    if clip_data is not None and bbox is not None:
+        print('Clip data and BBOX selected')
+        exit()
+
+    grid = None
+    if tiles is not None and tile_size is not None:
+        print('Tiles and tile size selected')
+        exit()
+    if tiles is not None:
+        grid = parse_tiles(tiles)
+        if grid is None:
+            print(f'{tiles} is not a valid NxM tile grid')
+            exit()
+    if tile_size is not None and tile_size <= 0:
+        print('Tile size must be greater than 0')
+        exit()
+
+    schema = None
+    if columns is not None:
+        from osmgo.schema import read_columns
+        schema, error = read_columns(columns)
+        if error is not None:
+            print(error)
+            exit()
+
+    posm = ProcessOSM(inputs, output, prefix, ext, themes, features)
+    posm.workers = max(1, workers)
+    posm.clip_data = clip_data
+    posm.layer = layer
+    posm.bbox = box
+    posm.keep = keep
+    posm.columns = schema
+    posm.tiles = grid
+    posm.tile_size = tile_size
+    posm.osmconvert = osmconvert_path
+    posm.manifest = Manifest(os.path.join(output, f'{prefix}_manifest.jsonl'))
+    posm.process_update(changes, updated)
+
+
+@cli.command('run', short_help='Run a file of extract, export and combine jobs on one worker pool')
+@click.argument('jobs', type=click.Path(exists=True))
+@click.option('-w', '--workers', type=int, help='Number of workers, overrides the workers of the jobs file')
+@click.option('--max-memory', type=str, help='Memory budget for the workers e.g. 8G')
+@click.option('--resume', is_flag=True, show_default=True, help='Skip the outputs finished by a previous run')
+@click.option('--dry-run', is_flag=True, show_default=True, help='Print the tasks without running them')
+@click.option('--osmconvert', envvar='OSMCONVERT', help='Path to osmconvert file')
+@click.option('--osmium', envvar='OSMIUM', help='Path to the osmium tool used by keep_themes')
+@click.option('--cache-dir', envvar='OSMGO_CACHE', type=click.Path(),
+              default=os.path.join(os.path.expanduser('~'), '.osmgo', 'cache'), show_default=True,
+              help='Folder of the parse cache, on by default')
+@click.option('--cache-size', type=str, default='10G', show_default=True,
+              help='Size limit of the parse cache, least recently used themes are removed above it')
+@click.option('--no-cache', is_flag=True, show_default=True, help='Do not read or write the parse cache')
+def run(jobs, workers, max_memory, resume, dry_run, osmconvert, osmium, cache_dir, cache_size, no_cache):
+    """
+        JOBS is a YAML or JSON file of jobs, each with a type of extract, export or combine and the arguments
+        and options of that osmgo command, e.g. clip_data, bbox, theme, feature, ext, split_by.  A name lets
+        other jobs list it in after, relative paths are taken from the folder of the jobs file.
+
+        workers: 4
+
+        jobs:
+
+          - {type: extract, name: hole, inputs: andorra-latest.osm.pbf, output: andorra-extract_lc.pbf,
+          clip_data: andorra_hole.shp}
+
+          - {type: export, inputs: andorra-extract_lc.pbf, output: output, prefix: andorra_e_l-ns, theme: highway,
+          feature: line, ext: gpkg}
+
+          - {type: combine, inputs: output, output: andorra.gpkg, prefix: andorra_e_l-ns}
+
+        The jobs run as one graph of tasks on a single pool of --workers.  An export runs after the extract
+        writing its PBF and a combine after the gpkg exports into its folder with its prefix.  A job repeated
+        with the same options runs once, an extract repeated with another output is copied, and a theme is
+        parsed once for all the exports reading the same PBF with the same clip or bbox and tag columns.  Each
+        export records its outputs in OUTPUT/PREFIX_manifest.jsonl and --resume only reruns the missing ones,
+        extracts newer than their input are kept
+
+        Example:
+
+        osmgo run nightly.yaml -w 8 --max-memory 48G
+    """
+    from osmgo.jobs import load_jobs, run_jobs
+    from osmgo.scheduler import parse_memory
+    from osmgo.cache import ParseCache
+
+    settings, job_list, error = load_jobs(jobs)
+    if error is not None:
+        print(error)
+        exit()
+    workers = workers or settings.get('workers', 1)
+    max_memory = max_memory or settings.get('max_memory')
+    print(f'Jobs: {jobs}')
+    print(f'Workers: {workers}')
+
+    memory = None
+    if max_memory is not None:
+        memory = parse_memory(str(max_memory))
+        if memory is None:
+            print(f'{max_memory} is not a valid memory size')
+            exit()
+        print(f'Max memory: {max_memory}')
+
+    osmconvert_path = find_osmconvert(osmconvert)
+    if osmconvert_path is None and any(job['type'] == 'extract' for job in job_list):
+        print('Unable to find osmconvert program in {} or {}'.format(os.path.join(sys.prefix, 'bin/osmconvert'),
+                                                                     osmconvert))
+        exit()
+
+    cache = None
+    if not no_cache:
+        if ParseCache.available():
+            cache_limit = parse_memory(cache_size)
+            if cache_limit is None:
+                print(f'{cache_size} is not a valid cache size')
+                exit()
+            print(f'Parse cache: {cache_dir} up to {cache_size}')
+            cache = ParseCache(cache_dir, max_size=cache_limit)
+        else:
+            print('Parse cache needs pyarrow, continuing without cache')
+
+    failed = run_jobs(job_list, workers=max(1, int(workers)), max_memory=memory, osmconvert=osmconvert_path,
+                      osmium=osmium, cache=cache, resume=resume, dry_run=dry_run)
+    if failed is None:
+        exit()
+    if len(failed) > 0:
+        print('Failed jobs {}'.format(','.join(failed)))
+        exit(1)
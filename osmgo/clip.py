@@ -0,0 +1,176 @@
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import geopandas as gpd
+import shapely
+
+# Dimension of the geometry types kept when an intersection returns a GeometryCollection
+DIMENSION = {'Point': 0, 'MultiPoint': 0, 'LineString': 1, 'LinearRing': 1, 'MultiLineString': 1,
+             'Polygon': 2, 'MultiPolygon': 2}
+
+
+def subdivide(geom, max_vertices=256, depth=0, max_depth=16):
+    """
+        Recursively split a polygon in half along the long side of its bounds until each piece has
+        at most max_vertices vertices.  The parts of a piece are kept together, cutting across a jagged
+        boundary would otherwise leave thousands of slivers.
+    """
+    if geom.is_empty:
+        return []
+    if shapely.get_num_coordinates(geom) <= max_vertices or depth >= max_depth:
+        # clip_by_rect is fast but may leave invalid polygons
+        geom = keep_dimension(shapely.make_valid(geom), 2)
+        return [] if geom is None or geom.is_empty else [geom]
+    minx, miny, maxx, maxy = geom.bounds
+    if maxx - minx >= maxy - miny:
+        mid = (minx + maxx) / 2
+        halves = [(minx, miny, mid, maxy), (mid, miny, maxx, maxy)]
+    else:
+        mid = (miny + maxy) / 2
+        halves = [(minx, miny, maxx, mid), (minx, mid, maxx, maxy)]
+    pieces = []
+    for half in halves:
+        pieces.extend(subdivide(shapely.clip_by_rect(geom, *half), max_vertices, depth + 1, max_depth))
+    return pieces
+
+
+def keep_dimension(geom, dimension):
+    """
+        Drop the parts of a GeometryCollection that are not of the input dimension
+    """
+    if geom is None or geom.is_empty or geom.geom_type != 'GeometryCollection':
+        return geom
+    parts = [part for part in shapely.get_parts(geom) if DIMENSION.get(part.geom_type) == dimension]
+    if len(parts) == 0:
+        return None
+    return shapely.union_all(parts)
+
+
+class ClipIndex:
+    """
+        Clip geometry subdivided into small pieces with a spatial index.  Features inside a piece are
+        passed through, features outside all pieces are dropped and only features on a piece boundary
+        are intersected.
+    """
+
+    def __init__(self, clip_gdf, max_vertices=256, threads=1):
+        geom = shapely.make_valid(shapely.union_all(np.asarray(clip_gdf.geometry.values)))
+        self.pieces = np.array(subdivide(geom, max_vertices), dtype=object)
+        shapely.prepare(self.pieces)
+        self.tree = shapely.STRtree(self.pieces)
+        self.threads = threads
+
+    def classify(self, geoms):
+        """
+            Return the positions of the features inside the clip geometry and the (feature, piece) pairs
+            of the features on the boundary
+        """
+        inside = np.unique(self.tree.query(geoms, predicate='within')[0])
+        pairs = self.tree.query(geoms, predicate='intersects')
+        pairs = pairs[:, np.lexsort((pairs[1], pairs[0]))]
+        boundary = ~np.isin(pairs[0], inside)
+        return inside, pairs[:, boundary]
+
+    def intersect(self, geoms, pairs):
+        """
+            Intersect the boundary features with the pieces they touch and merge the parts per feature
+        """
+        def chunk_intersection(chunk):
+            return shapely.intersection(geoms[chunk[0]], self.pieces[chunk[1]])
+
+        # Vectorised intersections release the GIL so chunks run on separate cores
+        chunks = np.array_split(pairs, max(1, self.threads), axis=1)
+        if self.threads > 1:
+            with ThreadPoolExecutor(max_workers=self.threads) as executor:
+                parts = np.concatenate(list(executor.map(chunk_intersection, chunks)))
+        else:
+            parts = np.concatenate([chunk_intersection(chunk) for chunk in chunks])
+
+        positions = np.unique(pairs[0])
+        results = np.empty(len(positions), dtype=object)
+        # pairs are sorted by feature so the parts of a feature are contiguous
+        starts = np.searchsorted(pairs[0], positions)
+        ends = np.append(starts[1:], pairs.shape[1])
+        for i, (position, start, end) in enumerate(zip(positions, starts, ends)):
+            feature_parts = parts[start:end]
+            feature_parts = feature_parts[~shapely.is_empty(feature_parts)]
+            if len(feature_parts) == 0:
+                results[i] = None
+                continue
+            geom = feature_parts[0] if len(feature_parts) == 1 else shapely.union_all(feature_parts)
+            dimension = DIMENSION.get(geoms[position].geom_type)
+            if dimension == 1 and geom.geom_type == 'MultiLineString':
+                # Join lines split at piece edges
+                geom = shapely.line_merge(geom)
+            results[i] = keep_dimension(geom, dimension)
+        return positions, results
+
+    def clip(self, gdf):
+        """
+            Clip the GeoDataFrame to the clip geometry
+        """
+        if gdf.empty:
+            return gdf
+        geoms = np.asarray(gdf.geometry.values)
+        inside, pairs = self.classify(geoms)
+        positions, results = self.intersect(geoms, pairs) if pairs.shape[1] > 0 else (np.array([], dtype=int),
+                                                                                      np.array([], dtype=object))
+        keep = ~shapely.is_missing(results)
+        keep[keep] = ~shapely.is_empty(results[keep])
+        positions = positions[keep]
+
+        order = np.sort(np.concatenate([inside, positions]))
+        gdf_clip = gdf.iloc[order].copy()
+        if len(positions) > 0:
+            # Inside features keep their geometry, boundary features get the intersection
+            new_geoms = np.asarray(gdf_clip.geometry.values).copy()
+            new_geoms[np.searchsorted(order, positions)] = results[keep]
+            gdf_clip[gdf_clip.geometry.name] = gpd.GeoSeries(new_geoms, index=gdf_clip.index, crs=gdf.crs)
+        return gdf_clip
+
+
+class RegionIndex:
+    """
+        Named clip regions with a spatial index.  Features are assigned to the regions they intersect with
+        one query and each region clips only its own features with its own ClipIndex.
+    """
+
+    def __init__(self, names, geoms, crs=None, threads=1):
+        self.names = list(names)
+        self.geoms = np.asarray(geoms, dtype=object)
+        self.tree = shapely.STRtree(self.geoms)
+        self.crs = crs
+        # Regions clipped at the same time
+        self.threads = threads
+        self.indexes = {}
+
+    def index(self, region):
+        """
+            ClipIndex of a region built on first use
+        """
+        if region not in self.indexes:
+            self.indexes[region] = ClipIndex(gpd.GeoDataFrame(geometry=[self.geoms[region]], crs=self.crs))
+        return self.indexes[region]
+
+    def split(self, gdf):
+        """
+            Return {region name: clipped GeoDataFrame} of the regions the features fall in
+        """
+        if gdf.empty:
+            return {}
+        pairs = self.tree.query(np.asarray(gdf.geometry.values), predicate='intersects')
+        # Group the features by region, each group keeps the order of the features
+        pairs = pairs[:, np.lexsort((pairs[0], pairs[1]))]
+        regions, starts = np.unique(pairs[1], return_index=True)
+        ends = np.append(starts[1:], pairs.shape[1])
+
+        def clip_region(region, start, end):
+            gdf_clip = self.index(region).clip(gdf.iloc[pairs[0, start:end]])
+            return self.names[region], gdf_clip
+
+        groups = list(zip(regions.tolist(), starts.tolist(), ends.tolist()))
+        if self.threads > 1:
+            with ThreadPoolExecutor(max_workers=self.threads) as executor:
+                results = list(executor.map(lambda group: clip_region(*group), groups))
+        else:
+            results = [clip_region(*group) for group in groups]
+        return {name: gdf_clip for name, gdf_clip in results if not gdf_clip.empty}
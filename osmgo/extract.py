@@ -1,104 +1,358 @@
 import os
-import geopandas as gpd
+import re
+import glob
+import hashlib
+import sys
+import time
+import shutil
+import tempfile
 import subprocess
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
+# Name of the poly and PBF of the union of the regions cut next to the region files
+UNION_NAME = 'osmgo_union'
 
-def write_pbf(inputs, output, osmconvert, poly=None, bbox=None):
+
+def find_osmconvert(osmconvert=None):
+    """
+        Return the path to osmconvert in the python env bin folder or the path passed in, otherwise None
+    """
+    if os.path.exists(os.path.join(sys.prefix, 'bin/osmconvert')):
+        return os.path.join(sys.prefix, 'bin/osmconvert')
+    elif osmconvert is not None and os.path.exists(osmconvert):
+        return osmconvert
+    return None
+
+
+def find_osmium(osmium=None):
+    """
+        Return the path to the osmium tool passed in, in the python env bin folder or on the PATH, otherwise None
+    """
+    if osmium is not None and os.path.exists(osmium):
+        return osmium
+    if os.path.exists(os.path.join(sys.prefix, 'bin/osmium')):
+        return os.path.join(sys.prefix, 'bin/osmium')
+    return shutil.which('osmium')
+
+
+def filter_pbf(inputs, output, keys, osmium=None):
     """
-        Run osmcovert to clip and/or write pbf file
+        Write the objects tagged with any of the keys and the nodes, ways and members they reference.
+        Uses osmium tags-filter when the osmium tool is found, otherwise the pyosmium key filter.
+        Returns output or None when neither is available.
+    """
+    begin_time = time.time()
+    osmium_path = find_osmium(osmium)
+    if osmium_path is not None:
+        cmd = [osmium_path, 'tags-filter', inputs] + [f'nwr/{key}' for key in keys] + \
+              ['-o', output, '--overwrite', '--no-progress']
+        result = subprocess.run(cmd, capture_output=True, text=True)
+        if result.returncode != 0:
+            print(result.stderr)
+            print('Unable to filter {}'.format(' '.join(cmd)))
+            return None
+    else:
+        try:
+            import osmium as pyosmium
+        except ImportError:
+            pyosmium = None
+        if pyosmium is None or not hasattr(pyosmium, 'IdTracker'):
+            print('Unable to find the osmium tool or pyosmium 4 to filter the PBF')
+            return None
+        # The key filter, the reference completion and the write run in C++, Python only sees the tagged objects
+        tracker = pyosmium.IdTracker()
+        for obj in pyosmium.FileProcessor(inputs).with_filter(pyosmium.filter.KeyFilter(*keys)):
+            if obj.is_node():
+                tracker.add_node(obj.id)
+            elif obj.is_way():
+                tracker.add_way(obj.id)
+                tracker.add_references(obj)
+            else:
+                tracker.add_relation(obj.id)
+                tracker.add_references(obj)
+        tracker.complete_backward_references(inputs)
+        with pyosmium.SimpleWriter(output, overwrite=True) as writer:
+            pyosmium.apply(inputs, tracker.id_filter(), writer)
+    print('Filtered {} to {} in {} seconds, {} MB to {} MB.'.format(
+        ','.join(keys), output, round(time.time() - begin_time, 0), round(os.path.getsize(inputs) / 1024 ** 2, 1),
+        round(os.path.getsize(output) / 1024 ** 2, 1)))
+    return output
+
+
+def pbf_bounds(inputs, osmconvert):
+    """
+        Read the lon/lat extent of a pbf file from the osmconvert statistics as minx,miny,maxx,maxy
+    """
+    cmd = '{} {} --out-statistics'.format(osmconvert, inputs)
+    result = subprocess.run(cmd, shell=True, capture_output=True, text=True)
+    stats = {}
+    for line in result.stdout.splitlines():
+        key, _, value = line.partition(':')
+        stats[key.strip()] = value.strip()
+    try:
+        return [float(stats['lon min']), float(stats['lat min']), float(stats['lon max']), float(stats['lat max'])]
+    except (KeyError, ValueError):
+        print(f'Unable to read extent of {inputs}')
+        print(cmd)
+        return None
+
+
+def write_pbf(inputs, output, osmconvert, poly=None, bbox=None, complete_ways=False, temp=None):
+    """
+        Run osmcovert to clip and/or write pbf file, returns False when osmconvert fails
     """
     cmd = None
+    if temp is None:
+        temp = '{}/osm_temp'.format(os.path.dirname(output))
+    # Keep ways and multipolygons crossing the border whole
+    complete = ' --complete-ways --complete-multipolygons' if complete_ways else ''
     try:
 
         if poly is not None:
-            cmd = '{}  {} -B={} -o={} -t={}/osm_temp'.format(osmconvert, inputs, poly, output, os.path.dirname(output))
-            subprocess.run(cmd, shell=True)
+            cmd = '{}  {} -B={}{} -o={} -t={}'.format(osmconvert, inputs, poly, complete, output, temp)
+            subprocess.run(cmd, shell=True, check=True)
 
         elif bbox is not None:
-            cmd = '{} {} -b={},{},{},{} -o={} -t={}/osm_temp'.format(osmconvert, inputs, bbox[0], bbox[1], bbox[2],
-                                                                     bbox[3], output, os.path.dirname(output))
-            subprocess.run(cmd, shell=True)
+            cmd = '{} {} -b={},{},{},{}{} -o={} -t={}'.format(osmconvert, inputs, bbox[0], bbox[1], bbox[2],
+                                                              bbox[3], complete, output, temp)
+            subprocess.run(cmd, shell=True, check=True)
 
         else:
-            cmd = '{}  {} -o={} -t={}/osm_temp'.format(osmconvert, inputs, output, os.path.dirname(output))
-            subprocess.run(cmd, shell=True)
+            cmd = '{}  {} -o={} -t={}'.format(osmconvert, inputs, output, temp)
+            subprocess.run(cmd, shell=True, check=True)
 
     except subprocess.CalledProcessError as e:
         print(e.output)
         print('Unable to finish export')
         print(cmd)
+        return False
+    return True
 
 
-def write_poly(clip_data, output, layer=None):
+def extract_pbf(inputs, output, osmconvert, clip_data=None, bbox=None, layer=None, split_by=None, workers=1,
+                simplify=None, keep_themes=None, osmium=None, temp=None):
     """
-        Read shapefile and write *.poly file for use with osmconvert
+        Write the part of the PBF inside the clip data or bbox to output, or one PBF per clip feature into the
+        output folder with split_by.  keep_themes first filters the PBF to the objects tagged with the theme
+        keys.  Returns False when the extract could not be written.
     """
+    if split_by is not None:
+        os.makedirs(output, exist_ok=True)
+
+    filtered = None
+    if keep_themes is not None:
+        folder = output if split_by is not None else os.path.dirname(os.path.abspath(output))
+        # Named per process so extracts running side by side into one folder do not collide
+        filtered = filter_pbf(inputs, os.path.join(folder, f'osmgo_filtered_{os.getpid()}.osm.pbf'), keep_themes,
+                              osmium=osmium)
+        if filtered is None:
+            return False
+        inputs = filtered
+
+    try:
+        if split_by is not None:
+            polys = write_polys(clip_data, output, split_by, layer=layer, simplify=simplify)
+            if polys is None:
+                return False
+            union_poly = write_poly(clip_data, os.path.join(output, UNION_NAME), layer=layer, simplify=simplify,
+                                    name=UNION_NAME)
+            return write_pbfs(inputs, output, osmconvert, polys, union_poly=union_poly, workers=workers)
+        elif clip_data is not None:
+            if os.path.splitext(clip_data)[-1] == '.shp':
+                poly = write_poly(clip_data, output, simplify=simplify)
+                return write_pbf(inputs, output, osmconvert, poly=poly, temp=temp)
+            else:
+                poly = write_poly(clip_data, output, layer=layer, simplify=simplify)
+                return write_pbf(inputs, output, osmconvert, poly=poly, temp=temp)
+        elif bbox is not None:
+            print('bbox')
+            return write_pbf(inputs, output, osmconvert, bbox=bbox, temp=temp)
+        else:
+            return write_pbf(inputs, output, osmconvert, temp=temp)
+    finally:
+        # The filtered copy is as large as the extent of the input, never leave it behind
+        if filtered is not None and os.path.exists(filtered):
+            os.remove(filtered)
+
+
+def clip_fingerprint(clip_data, layer=None):
+    """
+        Hash of the clip shapefile and its sidecar files, or of the files in the FileGDB folder
+    """
+    if os.path.isdir(clip_data):
+        paths = sorted(glob.glob(os.path.join(clip_data, '*')))
+    else:
+        paths = sorted(glob.glob(os.path.splitext(clip_data)[0] + '.*'))
+    sha = hashlib.sha1(str(layer).encode())
+    for path in paths:
+        if path.endswith('.poly') or path.endswith('.key') or not os.path.isfile(path):
+            continue
+        sha.update(os.path.basename(path).encode())
+        with open(path, 'rb') as fp:
+            for block in iter(lambda: fp.read(1024 ** 2), b''):
+                sha.update(block)
+    return sha.hexdigest()
+
+
+def read_clip(clip_data, layer=None):
+    """
+        Read the clip shapefile or FileGDB layer, geopandas is only imported when there is clip data
+    """
+    import geopandas as gpd
     if os.path.splitext(clip_data)[-1] == '.shp':
         print('Processing shapefile')
-        wb_poly = gpd.read_file(clip_data)
+        return gpd.read_file(clip_data)
+    print('Processing FileGDB')
+    return gpd.read_file(clip_data, driver="FileGDB", layer=layer)
+
+
+def write_poly(clip_data, output, layer=None, simplify=None, cache=True, name=None):
+    """
+        Read shapefile and write *.poly file for use with osmconvert.  The poly is named after the shapefile
+        or layer unless name is given.  The poly is reused when the key file next to it matches the clip data,
+        layer and simplify tolerance.
+    """
+    if os.path.splitext(clip_data)[-1] == '.shp':
         attr = os.path.basename(clip_data).split('.')[0]
     else:
-        print('Processing FileGDB')
-        wb_poly = gpd.read_file(clip_data, driver="FileGDB", layer=layer)
         attr = layer
+    poly = os.path.join(os.path.dirname(output), f'{name or attr}.poly')
 
-    poly = os.path.join(os.path.dirname(output), f'{attr}.poly')
-    with open(poly, 'w') as fp:
-        fp.write(attr + "\n")
-        total_ring_count = 0
-        for _, f in wb_poly.iterrows():
-            geom = f.geometry
-            coordinates = extract_coords(geom)
-            for coordinate in coordinates:
-
-                fp.write('{0}\n'.format(total_ring_count))
-                for coords in coordinate[0]['exterior_coords']:
-                    x = '{:.7E}'.format(coords[0])
-                    y = '{:.7E}'.format(coords[1])
-                    fp.write('\t{0}\t{1}\n'.format(x, y))
-                fp.write("END\n")
-                total_ring_count += 1
-                for rings in coordinate[0]['interior_coords']:
-                    fp.write('!{0}\n'.format(total_ring_count))
-                    for coords in rings:
-                        x = '{:.7E}'.format(coords[0])
-                        y = '{:.7E}'.format(coords[1])
-                        fp.write('\t{0}\t{1}\n'.format(x, y))
-                    total_ring_count += 1
-                    fp.write("END\n")
-
-        fp.write("END\n")
+    key = '{}|{}|{}'.format(clip_fingerprint(clip_data, layer), attr, simplify) if cache else None
+    if key is not None and os.path.exists(poly) and os.path.exists(f'{poly}.key'):
+        with open(f'{poly}.key') as fp:
+            if fp.read() == key:
+                print(f'Using cached {poly}')
+                return poly
+
+    wb_poly = read_clip(clip_data, layer)
+
+    write_poly_file(poly, name or attr, wb_poly.geometry, simplify=simplify)
+    if key is not None:
+        with open(f'{poly}.key', 'w') as fp:
+            fp.write(key)
+    elif os.path.exists(f'{poly}.key'):
+        os.remove(f'{poly}.key')
     return poly
 
 
-def extract_coords(geom):
-    coords = []
-    if geom.type == 'Polygon':
-        coords.append(extract_poly_coords(geom))
-    elif geom.type == 'MultiPolygon':
-        coords.extend(extract_multi_poly_coords(geom))
-    else:
-        raise ValueError('Unhandled geometry type: ' + repr(geom.type))
-    return coords
-
-
-def extract_poly_coords(geom):
-    exterior_coords = None
-    interior_coords = None
-    if geom.type == 'Polygon':
-        exterior_coords = geom.exterior.coords[:]
-        interior_coords = []
-        for interior in geom.interiors:
-            interior_coords.append(interior.coords[:])
-
-    return [{'exterior_coords': exterior_coords,
-             'interior_coords': interior_coords}]
-
-
-# noinspection SpellCheckingInspection
-def extract_multi_poly_coords(geom):
-    coords = []
-    if geom.type == 'MultiPolygon':
-        for part in geom:
-            coords.append(extract_poly_coords(part))  # Recursive call
-    return coords
+def write_polys(clip_data, output, attribute, layer=None, simplify=None):
+    """
+        Read shapefile and write one *.poly file per feature named by the attribute column
+    """
+    wb_poly = read_clip(clip_data, layer)
+
+    if attribute not in wb_poly.columns:
+        print(f'Attribute {attribute} not found in {clip_data}')
+        return None
+
+    polys = {}
+    # The union of the regions is cut next to them under a reserved name
+    for name, geom in zip(region_names(wb_poly[attribute], reserved=[UNION_NAME]), wb_poly.geometry):
+        poly = os.path.join(output, f'{name}.poly')
+        write_poly_file(poly, name, [geom], simplify=simplify)
+        polys[name] = poly
+    return polys
+
+
+def region_name(value):
+    """
+        Attribute value made safe to use in a file name
+    """
+    return re.sub(r'[^0-9A-Za-z_-]+', '_', str(value)).strip('_') or 'region'
+
+
+def region_names(values, reserved=()):
+    """
+        File safe name of each region, a name already taken or reserved gets the first free _<n> suffix appended
+    """
+    names = []
+    taken = set(reserved)
+    counts = {}
+    for value in values:
+        name = base = region_name(value)
+        while name in taken:
+            counts[base] = counts.get(base, 0) + 1
+            name = f'{base}_{counts[base]}'
+        taken.add(name)
+        names.append(name)
+    return names
+
+
+def write_poly_file(poly, name, geoms, simplify=None):
+    """
+        Write the polygons in geoms to a *.poly file.  The coordinates of all rings are formatted
+        in one operation and written in one call.
+    """
+    import numpy as np
+    import shapely
+    geoms = np.asarray(geoms, dtype=object)
+    geoms = geoms[~shapely.is_missing(geoms)]
+    if simplify:
+        geoms = shapely.simplify(geoms, simplify, preserve_topology=True)
+    parts = shapely.get_parts(geoms)
+    other = parts[shapely.get_type_id(parts) != shapely.GeometryType.POLYGON]
+    if len(other) > 0:
+        raise ValueError('Unhandled geometry type: ' + repr(other[0].geom_type))
+    parts = parts[~shapely.is_empty(parts)]
+
+    # Rings come out per polygon with the exterior first then the interiors
+    rings = shapely.get_rings(parts)
+    counts = shapely.get_num_coordinates(rings)
+    holes = shapely.get_num_interior_rings(parts)
+    exterior = np.zeros(len(rings), dtype=bool)
+    exterior[np.cumsum(holes + 1) - holes - 1] = True
+
+    template = [name + '\n']
+    for i, (count, outer) in enumerate(zip(counts.tolist(), exterior.tolist())):
+        template.append('{}{}\n'.format('' if outer else '!', i))
+        template.append('\t%.7E\t%.7E\n' * count)
+        template.append('END\n')
+    template.append('END\n')
+    coords = shapely.get_coordinates(rings)
+    with open(poly, 'w') as fp:
+        fp.write(''.join(template) % tuple(coords.ravel().tolist()))
+
+
+def write_pbfs(inputs, output, osmconvert, polys, union_poly=None, workers=1):
+    """
+        Write one pbf per region poly into the output folder.  The input is first cut to the union of the regions
+        so the full input is read once, then the regions are cut from the smaller file in parallel.  Returns
+        False when a region could not be cut.
+    """
+    begin_time = time.time()
+    source = inputs
+    union_pbf = None
+    if union_poly is not None:
+        union_pbf = os.path.join(output, f'{UNION_NAME}.pbf')
+        print(f'Cutting union of {len(polys)} regions')
+        if not write_pbf(inputs, union_pbf, osmconvert, poly=union_poly,
+                         temp=os.path.join(output, 'osm_temp_union')):
+            return False
+        source = union_pbf
+
+    def cut(name, poly):
+        # Each osmconvert job gets its own temp files so parallel jobs do not collide
+        temp_dir = tempfile.mkdtemp(prefix=f'{name}_', dir=output)
+        try:
+            if not write_pbf(source, os.path.join(output, f'{name}.pbf'), osmconvert, poly=poly,
+                             temp=os.path.join(temp_dir, 'osm_temp')):
+                raise RuntimeError(f'Unable to cut region {name}')
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+        return name
+
+    written = True
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(cut, name, poly) for name, poly in polys.items()]
+        for x in as_completed(futures):
+            if x.exception() is not None:
+                print(f'Future Exception {x.exception()}')
+                written = False
+            else:
+                print(f'Done {x.result()}.pbf')
+
+    if union_pbf is not None and os.path.exists(union_pbf):
+        os.remove(union_pbf)
+    print('Done {} regions after {} seconds.'.format(len(polys), round(time.time() - begin_time, 0)))
+    return written
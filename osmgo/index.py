@@ -0,0 +1,237 @@
+import json
+import os
+import shutil
+import subprocess
+import time
+import numpy as np
+import pandas as pd
+
+# Folder of the index written next to the PBF
+INDEX_SUFFIX = '.osmgo-index'
+
+# Coordinates are stored as int32 in units of 1e-7 degrees, the precision of OSM
+SCALE = 10 ** 7
+
+# Array files of the index and their dtype
+ARRAYS = {'node_ids': np.int64, 'node_lon': np.int32, 'node_lat': np.int32, 'way_ids': np.int64,
+          'way_offsets': np.int64, 'way_nodes': np.int64}
+
+# Nodes read from osmconvert per chunk and ways per write while building
+CHUNK_SIZE = 1000000
+
+
+def index_path(inputs):
+    return f'{inputs}{INDEX_SUFFIX}'
+
+
+def pbf_stamp(inputs):
+    """
+        Size and modification time of the PBF the index is valid for
+    """
+    stat = os.stat(inputs)
+    return {'pbf_size': stat.st_size, 'pbf_mtime': stat.st_mtime}
+
+
+def append_array(fp, values, dtype):
+    np.asarray(values, dtype=dtype).tofile(fp)
+
+
+def sort_arrays(folder, key, others, count):
+    """
+        Sort the array files of the index by key in place, only needed for PBFs not sorted by id
+    """
+    order = np.argsort(np.fromfile(os.path.join(folder, f'{key}.bin'), dtype=ARRAYS[key], count=count), kind='stable')
+    for name in [key] + others:
+        path = os.path.join(folder, f'{name}.bin')
+        np.fromfile(path, dtype=ARRAYS[name], count=count)[order].tofile(path)
+
+
+def build_index(inputs, osmconvert, folder=None):
+    """
+        Write the node coordinates and the way node lists of the PBF as flat arrays sorted by id.  The nodes are
+        read with osmconvert, the ways need pyosmium.  Returns the index folder or None.
+    """
+    begin_time = time.time()
+    folder = folder or index_path(inputs)
+    temp = f'{folder}.partial'
+    shutil.rmtree(temp, ignore_errors=True)
+    os.makedirs(temp)
+    meta = dict(pbf_stamp(inputs), nodes=0, ways=0, refs=0)
+
+    cmd = [osmconvert, inputs, '--drop-ways', '--drop-relations', '--out-csv', '--csv=@id @lon @lat',
+           '--csv-separator=,']
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    ordered = True
+    last = None
+    with open(os.path.join(temp, 'node_ids.bin'), 'wb') as ids, \
+            open(os.path.join(temp, 'node_lon.bin'), 'wb') as lon, \
+            open(os.path.join(temp, 'node_lat.bin'), 'wb') as lat:
+        for chunk in pd.read_csv(process.stdout, header=None, names=['id', 'lon', 'lat'], chunksize=CHUNK_SIZE):
+            chunk = chunk.dropna()
+            values = chunk['id'].to_numpy(np.int64)
+            if len(values) == 0:
+                continue
+            ordered = ordered and (last is None or values[0] > last) and bool(np.all(np.diff(values) > 0))
+            last = values[-1]
+            append_array(ids, values, np.int64)
+            append_array(lon, np.round(chunk['lon'].to_numpy() * SCALE), np.int32)
+            append_array(lat, np.round(chunk['lat'].to_numpy() * SCALE), np.int32)
+            meta['nodes'] += len(values)
+    if process.wait() != 0:
+        print('Unable to read the nodes {}'.format(' '.join(cmd)))
+        shutil.rmtree(temp, ignore_errors=True)
+        return None
+    if not ordered:
+        print('Sorting nodes by id')
+        sort_arrays(temp, 'node_ids', ['node_lon', 'node_lat'], meta['nodes'])
+
+    try:
+        import osmium as pyosmium
+    except ImportError:
+        pyosmium = None
+    with open(os.path.join(temp, 'way_ids.bin'), 'wb') as ids, \
+            open(os.path.join(temp, 'way_offsets.bin'), 'wb') as offsets, \
+            open(os.path.join(temp, 'way_nodes.bin'), 'wb') as refs:
+        append_array(offsets, [0], np.int64)
+        if pyosmium is None or not hasattr(pyosmium, 'FileProcessor'):
+            print('Indexing the nodes only, the way node lists need pyosmium 4')
+        else:
+            way_ids, counts, way_refs = [], [], []
+            for way in pyosmium.FileProcessor(inputs, pyosmium.osm.WAY):
+                way_ids.append(way.id)
+                nodes = [node.ref for node in way.nodes]
+                counts.append(len(nodes))
+                way_refs.extend(nodes)
+                if len(way_refs) >= CHUNK_SIZE:
+                    meta = write_ways(ids, offsets, refs, way_ids, counts, way_refs, meta)
+                    way_ids, counts, way_refs = [], [], []
+            meta = write_ways(ids, offsets, refs, way_ids, counts, way_refs, meta)
+    way_ids = np.fromfile(os.path.join(temp, 'way_ids.bin'), dtype=np.int64)
+    if len(way_ids) > 1 and not np.all(np.diff(way_ids) > 0):
+        # Ways are looked up by position so an unsorted PBF keeps its order and gets a sorted lookup
+        np.argsort(way_ids, kind='stable').tofile(os.path.join(temp, 'way_order.bin'))
+        meta['way_order'] = True
+    del way_ids
+
+    with open(os.path.join(temp, 'meta.json'), 'w') as fp:
+        json.dump(meta, fp)
+    shutil.rmtree(folder, ignore_errors=True)
+    os.replace(temp, folder)
+    print('Indexed {} nodes and {} ways of {} in {} seconds.'.format(meta['nodes'], meta['ways'], inputs,
+                                                                    round(time.time() - begin_time, 0)))
+    return folder
+
+
+def write_ways(ids, offsets, refs, way_ids, counts, way_refs, meta):
+    append_array(ids, way_ids, np.int64)
+    append_array(offsets, meta['refs'] + np.cumsum(np.asarray(counts, dtype=np.int64)), np.int64)
+    append_array(refs, way_refs, np.int64)
+    meta['ways'] += len(way_ids)
+    meta['refs'] += len(way_refs)
+    return meta
+
+
+class NodeIndex:
+    """
+        Memory mapped node coordinates and way node lists of a PBF.  The arrays are mapped read only so every
+        process using the index shares the same pages of the OS cache.
+    """
+
+    def __init__(self, folder, meta):
+        self.folder = folder
+        self.meta = meta
+        sizes = {'node_ids': meta['nodes'], 'node_lon': meta['nodes'], 'node_lat': meta['nodes'],
+                 'way_ids': meta['ways'], 'way_offsets': meta['ways'] + 1, 'way_nodes': meta['refs']}
+        for name, size in sizes.items():
+            setattr(self, name, self.map(name, ARRAYS[name], size))
+        self.way_order = None
+        self.lookup_ids = self.way_ids
+        if meta.get('way_order'):
+            # Ways of an unsorted PBF are found through a sorted copy of their ids
+            self.way_order = self.map('way_order', np.int64, meta['ways'])
+            self.lookup_ids = np.asarray(self.way_ids)[self.way_order]
+
+    def __getstate__(self):
+        # Pickled by folder so a worker maps the same files instead of receiving a copy of the arrays
+        return self.folder, self.meta
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def map(self, name, dtype, size):
+        if size == 0:
+            return np.empty(0, dtype=dtype)
+        # A plain ndarray view of the mapping, memmap slices are slow to create
+        return np.asarray(np.memmap(os.path.join(self.folder, f'{name}.bin'), dtype=dtype, mode='r', shape=(size,)))
+
+    @classmethod
+    def open(cls, inputs):
+        """
+            Index of the PBF, None when there is none or it was built from another version of the PBF
+        """
+        folder = index_path(inputs)
+        try:
+            with open(os.path.join(folder, 'meta.json')) as fp:
+                meta = json.load(fp)
+        except (OSError, ValueError):
+            return None
+        stamp = pbf_stamp(inputs)
+        if meta.get('pbf_size') != stamp['pbf_size'] or meta.get('pbf_mtime') != stamp['pbf_mtime']:
+            return None
+        return cls(folder, meta)
+
+    def locate(self, node_ids):
+        """
+            lon, lat arrays of the nodes, NaN for nodes missing from the PBF
+        """
+        node_ids = np.asarray(node_ids, dtype=np.int64)
+        lon = np.full(len(node_ids), np.nan)
+        lat = np.full(len(node_ids), np.nan)
+        if len(self.node_ids) == 0 or len(node_ids) == 0:
+            return lon, lat
+        positions = np.minimum(np.searchsorted(self.node_ids, node_ids), len(self.node_ids) - 1)
+        found = self.node_ids[positions] == node_ids
+        lon[found] = self.node_lon[positions[found]] / SCALE
+        lat[found] = self.node_lat[positions[found]] / SCALE
+        return lon, lat
+
+    def way_refs(self, way_id):
+        """
+            Node ids of the way, None when the way is missing
+        """
+        if len(self.way_ids) == 0:
+            return None
+        position = min(np.searchsorted(self.lookup_ids, way_id), len(self.lookup_ids) - 1)
+        if self.lookup_ids[position] != way_id:
+            return None
+        if self.way_order is not None:
+            position = self.way_order[position]
+        return self.refs_at(position)
+
+    def node_ways(self, node_ids):
+        """
+            Ids of the ways using any of the nodes, None when the index has no way node lists
+        """
+        if self.meta['ways'] == 0:
+            return None
+        node_ids = np.unique(np.asarray(node_ids, dtype=np.int64))
+        ways = []
+        # The way nodes are scanned in chunks so a planet index is not read into memory at once
+        for start in range(0, len(self.way_nodes), CHUNK_SIZE * 10):
+            positions = start + np.flatnonzero(np.isin(self.way_nodes[start:start + CHUNK_SIZE * 10], node_ids))
+            ways.append(self.way_ids[np.searchsorted(self.way_offsets, positions, side='right') - 1])
+        return set(np.concatenate(ways).tolist()) if len(ways) > 0 else set()
+
+    def refs_at(self, position):
+        return np.asarray(self.way_nodes[self.way_offsets[position]:self.way_offsets[position + 1]])
+
+    def way_coords(self, way_id):
+        """
+            (lon, lat) of the located nodes of the way, None when the way is missing
+        """
+        nodes = self.way_refs(way_id)
+        if nodes is None:
+            return None
+        lon, lat = self.locate(nodes)
+        found = ~np.isnan(lon)
+        return np.column_stack([lon[found], lat[found]])
@@ -0,0 +1,82 @@
+import csv
+import glob
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+import psutil
+
+SPAN_FIELDS = ['stage', 'theme', 'geo', 'start', 'seconds', 'features', 'bytes', 'rss', 'pid']
+
+
+class Recorder:
+    """
+        Collect timed spans of the export stages. Spans are not pickled so each pool task starts empty
+        and returns its own spans to the parent.
+    """
+
+    def __init__(self):
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        return {}
+
+    def __setstate__(self, state):
+        self.__init__()
+
+    @contextmanager
+    def span(self, stage, theme=None, geo=None):
+        """
+            Time a stage, set record['features'] or record['bytes'] inside the block
+        """
+        record = {'stage': stage, 'theme': theme, 'geo': geo, 'start': time.time(), 'features': None,
+                  'bytes': None}
+        begin = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record['seconds'] = time.perf_counter() - begin
+            record['rss'] = psutil.Process().memory_info().rss
+            record['pid'] = os.getpid()
+            with self._lock:
+                self.spans.append(record)
+
+
+@contextmanager
+def span(recorder, stage, theme=None, geo=None):
+    """
+        Recorder.span that does nothing when there is no recorder
+    """
+    if recorder is None:
+        yield {}
+    else:
+        with recorder.span(stage, theme, geo) as record:
+            yield record
+
+
+def output_bytes(path):
+    """
+        Size of an output file including shapefile sidecar files
+    """
+    if os.path.splitext(path)[-1] == '.shp':
+        return sum(os.path.getsize(each) for each in glob.glob(os.path.splitext(path)[0] + '.*'))
+    if os.path.exists(path):
+        return os.path.getsize(path)
+    return None
+
+
+def write_report(path, run, tasks, spans):
+    """
+        Write the run report as JSON, or the spans as CSV when path ends with .csv
+    """
+    if os.path.splitext(path)[-1].lower() == '.csv':
+        with open(path, 'w', newline='') as fp:
+            writer = csv.DictWriter(fp, fieldnames=SPAN_FIELDS, extrasaction='ignore')
+            writer.writeheader()
+            writer.writerows(spans)
+    else:
+        with open(path, 'w') as fp:
+            json.dump({'run': run, 'tasks': tasks, 'spans': spans}, fp, indent=2, default=str)
+    print(f'Profile report: {path}')
@@ -0,0 +1,468 @@
+import json
+import os
+import shutil
+import time
+from osmgo.cache import pbf_fingerprint
+from osmgo.extract import extract_pbf
+from osmgo.manifest import Manifest
+from osmgo.osmprocess import ProcessOSM, THEMES, FEATURES
+from osmgo.scheduler import MemoryScheduler
+from osmgo.schema import read_columns, theme_columns
+from osmgo.util import combine_gpkg
+from osmgo.writer import DRIVERS, remove_partial
+
+# Options of each job type, named like the options of the osmgo command of the same name
+JOB_OPTIONS = {'extract': ['inputs', 'output', 'clip_data', 'bbox', 'layer', 'split_by', 'simplify', 'keep_themes'],
+               'export': ['inputs', 'output', 'prefix', 'clip_data', 'bbox', 'layer', 'theme', 'feature', 'ext',
+                          'keep', 'columns', 'split_by'],
+               'combine': ['inputs', 'output', 'prefix']}
+
+# Options holding paths, relative paths are taken from the folder of the jobs file
+PATH_OPTIONS = ['inputs', 'output', 'clip_data', 'columns']
+
+# Imported once by each pool worker when the pool starts
+WORKER_MODULES = ('osmgo.jobs',)
+
+
+def load_jobs(path):
+    """
+        Read a YAML or JSON jobs file, either a list of jobs or {workers, max_memory, jobs}.  Returns
+        (settings, jobs, error) with the jobs checked and relative paths taken from the folder of the jobs file.
+    """
+    try:
+        with open(path) as fp:
+            if path.endswith('.json'):
+                data = json.load(fp)
+            else:
+                try:
+                    import yaml
+                except ImportError:
+                    return None, None, 'Reading YAML jobs needs pyyaml, or write the jobs file as JSON'
+                data = yaml.safe_load(fp)
+    except Exception as e:
+        return None, None, f'Unable to read jobs {path} {e}'
+    if isinstance(data, list):
+        data = {'jobs': data}
+    if not isinstance(data, dict) or not isinstance(data.get('jobs'), list) or len(data['jobs']) == 0:
+        return None, None, 'Jobs file must hold a list of jobs'
+    settings = {key: value for key, value in data.items() if key != 'jobs'}
+    unknown = [key for key in settings if key not in ['workers', 'max_memory']]
+    if len(unknown) > 0:
+        return None, None, 'Unknown settings {}'.format(','.join(unknown))
+
+    folder = os.path.dirname(os.path.abspath(path))
+    jobs = []
+    for index, job in enumerate(data['jobs']):
+        job, error = read_job(job, index, folder)
+        if error is not None:
+            return None, None, error
+        jobs.append(job)
+    names = [job['name'] for job in jobs]
+    for name in names:
+        if names.count(name) > 1:
+            return None, None, f'Job name {name} is used twice'
+    for job in jobs:
+        missing = [name for name in job['after'] if name not in names]
+        if len(missing) > 0:
+            return None, None, 'Job {} runs after unknown jobs {}'.format(job['name'], ','.join(missing))
+    return settings, jobs, None
+
+
+def split_list(values):
+    if isinstance(values, str):
+        values = values.split(',')
+    return [str(each).strip() for each in values]
+
+
+def read_job(job, index, folder):
+    """
+        Check the options of a job and fill in the defaults of the osmgo command, returns (job, error)
+    """
+    if not isinstance(job, dict):
+        return None, f'Job {index + 1} is not a mapping of options'
+    job = {str(key).replace('-', '_'): value for key, value in job.items()}
+    kind = job.pop('type', None)
+    name = str(job.pop('name', f'job{index + 1}'))
+    after = split_list(job.pop('after', []))
+    if kind not in JOB_OPTIONS:
+        return None, 'Job {} type must be one of {}'.format(name, ','.join(JOB_OPTIONS))
+    unknown = [key for key in job if key not in JOB_OPTIONS[kind]]
+    if len(unknown) > 0:
+        return None, 'Job {} has unknown options {}'.format(name, ','.join(unknown))
+    required = ['inputs', 'output'] + ([] if kind == 'extract' else ['prefix'])
+    missing = [key for key in required if job.get(key) is None]
+    if len(missing) > 0:
+        return None, 'Job {} is missing {}'.format(name, ','.join(missing))
+    for key in PATH_OPTIONS:
+        if job.get(key) is not None and not (key == 'columns' and job[key] == 'default'):
+            job[key] = os.path.normpath(os.path.join(folder, str(job[key])))
+
+    options = {option: job.get(option) for option in JOB_OPTIONS[kind]}
+    options.update(type=kind, name=name, after=after)
+    if kind == 'combine':
+        return options, None
+
+    bbox = options['bbox']
+    if bbox is not None:
+        try:
+            bbox = [float(each) for each in split_list(bbox)]
+        except ValueError:
+            return None, f'Job {name} bbox must be minx,miny,maxx,maxy in decimal degrees'
+        if len(bbox) != 4 or bbox[0] >= bbox[2] or bbox[1] >= bbox[3]:
+            return None, f'Job {name} coordinates out of sequence'
+        options['bbox'] = bbox
+    clip_data = options['clip_data']
+    if clip_data is not None:
+        if bbox is not None:
+            return None, f'Job {name} clip data and BBOX selected'
+        if not os.path.exists(clip_data):
+            return None, f'Job {name} clip data {clip_data} not found'
+        if os.path.splitext(clip_data)[-1] not in ['.shp', '.gdb']:
+            return None, f'Job {name} clip data not a .shp or .gdb'
+        if os.path.splitext(clip_data)[-1] == '.gdb' and options['layer'] is None:
+            return None, f'Job {name} GDB missing layer option'
+    if options['split_by'] is not None and clip_data is None:
+        return None, f'Job {name} split by requires clip data'
+
+    if kind == 'extract':
+        if options['keep_themes'] is not None:
+            options['keep_themes'] = split_list(options['keep_themes'])
+            missing = [each for each in options['keep_themes'] if each not in THEMES]
+            if len(missing) > 0:
+                return None, 'Job {} theme {} is misspelled or missing'.format(name, ','.join(missing))
+        if options['simplify'] is not None:
+            try:
+                options['simplify'] = float(options['simplify'])
+            except ValueError:
+                return None, f'Job {name} simplify must be a tolerance in decimal degrees'
+        return options, None
+
+    for option, choices in [('theme', THEMES), ('feature', FEATURES)]:
+        values = choices if options[option] is None else split_list(options[option])
+        missing = [each for each in values if each not in choices]
+        if len(missing) > 0:
+            return None, 'Job {} {} {} is misspelled or missing'.format(name, option, ','.join(missing))
+        options[option] = values
+    options['ext'] = options['ext'] or 'shp'
+    if options['ext'] not in DRIVERS:
+        return None, 'Job {} extension {} is not one of {}'.format(name, options['ext'], ','.join(DRIVERS))
+    options['keep'] = bool(options['keep'])
+    if options['columns'] is not None:
+        columns, error = read_columns(options['columns'])
+        if error is not None:
+            return None, f'Job {name} {error}'
+        options['columns'] = columns
+    return options, None
+
+
+def same_path(path, other):
+    return os.path.abspath(path) == os.path.abspath(other)
+
+
+def reads_extract(job, extract):
+    """
+        True when the job reads the PBF the extract writes, or a PBF of a split extract folder
+    """
+    if job['type'] == 'combine':
+        return False
+    return same_path(job['inputs'], extract['output']) or (
+        extract['split_by'] is not None and same_path(os.path.dirname(job['inputs']), extract['output']))
+
+
+def combines_export(job, export):
+    """
+        True when the combine job picks up the GeoPackages of the export
+    """
+    # combine picks the GeoPackages whose path holds its prefix, the outputs are named PREFIX_theme_geo.gpkg
+    return export['ext'] == 'gpkg' and same_path(job['inputs'], export['output']) and \
+        job['prefix'] in '{}_'.format(export['prefix'])
+
+
+def job_settings(job, ignore=('name', 'after')):
+    return json.dumps({key: value for key, value in job.items() if key not in ignore}, sort_keys=True)
+
+
+def plan_jobs(jobs):
+    """
+        Turn the jobs into tasks with their dependencies, returns (tasks, error).  A job repeated with the same
+        options runs once, an extract repeated with another output is copied from the first, and the themes
+        of the exports reading the same PBF with the same extent and tag columns are parsed once for all of them.
+    """
+    # Jobs repeating an earlier job run as that job
+    unique = {}
+    alias = {}
+    for job in jobs:
+        key = job_settings(job)
+        if key in unique:
+            alias[job['name']] = unique[key]['name']
+            unique[key]['after'] = unique[key]['after'] + [name for name in job['after']
+                                                            if name not in unique[key]['after']]
+        else:
+            unique[key] = job
+            alias[job['name']] = job['name']
+    jobs = list(unique.values())
+    extracts = [job for job in jobs if job['type'] == 'extract']
+    exports = [job for job in jobs if job['type'] == 'export']
+
+    for kind, outputs in [('extract', [job['output'] for job in extracts]),
+                          ('export', [os.path.join(job['output'], job['prefix']) for job in exports])]:
+        outputs = [os.path.abspath(each) for each in outputs]
+        for output in outputs:
+            if outputs.count(output) > 1:
+                return None, f'More than one {kind} job writes {output}'
+
+    # Job names each job runs after, from the paths it reads and its after option
+    after = {}
+    for job in jobs:
+        names = set(alias[name] for name in job['after'])
+        names.update(extract['name'] for extract in extracts if reads_extract(job, extract))
+        if job['type'] == 'combine':
+            names.update(export['name'] for export in exports if combines_export(job, export))
+        names.discard(job['name'])
+        after[job['name']] = names
+    error = find_cycle(after)
+    if error is not None:
+        return None, error
+    for job in jobs:
+        if job['type'] == 'combine':
+            written = any(combines_export(job, export) for export in exports)
+        else:
+            written = any(reads_extract(job, extract) for extract in extracts)
+        if not written and not os.path.exists(job['inputs']):
+            return None, 'Job {} input {} not found'.format(job['name'], job['inputs'])
+
+    tasks = []
+    units = {}  # Task names of each job
+    sources = {}
+    for job in extracts:
+        key = job_settings(job, ignore=('name', 'after', 'output'))
+        if key in sources:
+            # Same clip of the same PBF, copied once the first extract is written
+            units[job['name']] = [f'copy:{job["name"]}']
+            tasks.append({'name': units[job['name']][0], 'key': 'copy', 'fn': copy_extract, 'jobs': [job],
+                          'args': (sources[key]['output'], job['output']), 'after': [job['name']],
+                          'tasks': units[sources[key]['name']]})
+        else:
+            sources[key] = job
+            units[job['name']] = [f'extract:{job["name"]}']
+            tasks.append({'name': units[job['name']][0], 'key': 'extract', 'fn': run_extract, 'jobs': [job],
+                          'args': (job,), 'after': [job['name']]})
+
+    groups = {}
+    for job in exports:
+        units[job['name']] = []
+        for theme in job['theme']:
+            extent = [os.path.abspath(job['inputs']), job['clip_data'], job['layer'], job['bbox'], theme,
+                      theme_columns(job['columns'], theme)]
+            key = json.dumps(extent)
+            if key not in groups:
+                groups[key] = {'name': f'export:{theme}:{len(groups) + 1}', 'key': theme, 'fn': export_theme,
+                               'jobs': [], 'theme': theme, 'after': []}
+                tasks.append(groups[key])
+            groups[key]['jobs'].append(job)
+            groups[key]['after'].append(job['name'])
+            units[job['name']].append(groups[key]['name'])
+    for group in groups.values():
+        group['args'] = (group['jobs'], group['theme'])
+
+    for job in jobs:
+        if job['type'] == 'combine':
+            units[job['name']] = [f'combine:{job["name"]}']
+            tasks.append({'name': units[job['name']][0], 'key': 'combine', 'fn': run_combine, 'jobs': [job],
+                          'args': (job,), 'after': [job['name']]})
+
+    # The job names a task carries are replaced by the tasks of the jobs they run after
+    for task in tasks:
+        names = set()
+        for name in task['after']:
+            names.update(after.get(name, [name]))
+        names = set(unit for name in names for unit in units[name]).union(task.get('tasks', []))
+        task['after'] = sorted(names - {task['name']})
+        task['size'] = input_size(task['jobs'][0]['inputs'], extracts)
+    return tasks, None
+
+
+def find_cycle(after):
+    """
+        Name a job that runs after itself through its dependencies, None when the jobs form a DAG
+    """
+    state = {}
+
+    def visit(name):
+        state[name] = 'visiting'
+        for other in after.get(name, []):
+            if state.get(other) == 'visiting' or (other not in state and visit(other)):
+                return True
+        state[name] = 'done'
+        return False
+
+    for name in after:
+        if name not in state and visit(name):
+            return f'Job {name} depends on itself through the jobs it runs after'
+    return None
+
+
+def input_size(path, extracts):
+    """
+        Size of the PBF a task reads, a PBF not written yet is sized by the PBF it is extracted from
+    """
+    seen = set()
+    while not os.path.exists(path) and path not in seen:
+        seen.add(path)
+        source = next((job for job in extracts if reads_extract({'type': 'export', 'inputs': path}, job)), None)
+        if source is None:
+            return 0
+        path = source['inputs']
+    return os.path.getsize(path) if os.path.isfile(path) else 0
+
+
+def manifest_path(job):
+    return os.path.join(job['output'], '{}_manifest.jsonl'.format(job['prefix']))
+
+
+def run_extract(job, osmconvert, osmium=None, resume=False):
+    """
+        Write the PBF of an extract job, with resume an extract newer than its input is kept
+    """
+    begin_time = time.time()
+    output = job['output']
+    if resume and job['split_by'] is None and os.path.exists(output) and \
+            os.path.getmtime(output) >= os.path.getmtime(job['inputs']):
+        print('Keeping extract {}'.format(output))
+        return None
+    print('Extracting {} to {}'.format(job['inputs'], output))
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    if not extract_pbf(job['inputs'], output, osmconvert, clip_data=job['clip_data'], bbox=job['bbox'],
+                       layer=job['layer'], split_by=job['split_by'], simplify=job['simplify'],
+                       keep_themes=job['keep_themes'], osmium=osmium, temp=f'{output}_osm_temp'):
+        raise RuntimeError('Unable to extract {}'.format(output))
+    if job['split_by'] is None and not os.path.exists(output):
+        raise RuntimeError('osmconvert did not write {}'.format(output))
+    print('Done extract {} after {} seconds.'.format(output, round(time.time() - begin_time, 0)))
+    return None
+
+
+def copy_extract(source, output, resume=False):
+    """
+        Copy an extract written by another job with the same input and clip
+    """
+    if resume and os.path.exists(output) and os.path.getmtime(output) >= os.path.getmtime(source):
+        print('Keeping extract {}'.format(output))
+        return None
+    if os.path.isdir(source):
+        shutil.copytree(source, output, dirs_exist_ok=True)
+    else:
+        os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+        shutil.copyfile(source, output)
+    print('Copied extract {} to {}'.format(source, output))
+    return None
+
+
+def export_theme(jobs, theme, cache=None, resume=False):
+    """
+        Parse a theme once for the export jobs reading the same PBF with the same extent and tag columns, then
+        clip and write the outputs of each job
+    """
+    begin_time = time.time()
+    fingerprint = None
+    posms = []
+    for job in jobs:
+        posm = ProcessOSM(job['inputs'], job['output'], job['prefix'], job['ext'], [theme], job['feature'])
+        posm.clip_data = job['clip_data']
+        posm.layer = job['layer']
+        posm.bbox = job['bbox']
+        posm.keep = job['keep']
+        posm.columns = job['columns']
+        posm.split_by = job['split_by']
+        posm.cache = cache
+        try:
+            posm.set_extent()
+        except SystemExit:
+            # load_clip exits the export command on bad clip data, here only the tasks of this job fail
+            raise RuntimeError('Unable to load the clip data of job {}'.format(job['name']))
+        # Each task clears the temporary files of its own theme, the other themes may be writing
+        remove_partial(posm.output, posm.output_names())
+        if fingerprint is None:
+            fingerprint = pbf_fingerprint(job['inputs'])
+        posm.fingerprint = fingerprint
+        posm.manifest = Manifest(manifest_path(job))
+        if resume:
+            posm.resume = True
+            if not posm.resume_themes():
+                continue
+        posms.append(posm)
+    if len(posms) == 0:
+        return None
+
+    first = posms[0]
+    first.osm = first.open_osm(None if first.clip_gdf is None else first.clip_gdf.geometry.unary_union)
+    gdf = first.parse_theme(theme)
+    first.osm = None
+    for index, posm in enumerate(posms):
+        # process_gdf adds columns to the GeoDataFrame so every job but the last gets its own copy
+        posm.process_gdf(gdf.copy() if gdf is not None and index < len(posms) - 1 else gdf, theme)
+    print('Done {} for {} after {} seconds.'.format(theme, ','.join(posm.prefix for posm in posms),
+                                                   round(time.time() - begin_time, 0)))
+    return None
+
+
+def run_combine(job, resume=False):
+    """
+        Combine the GeoPackages of a combine job, with resume a combined GeoPackage already written is kept
+    """
+    if resume and os.path.exists(job['output']):
+        print('Keeping {}'.format(job['output']))
+        return None
+    combine_gpkg(job['inputs'], job['output'], job['prefix'])
+    return None
+
+
+def run_jobs(jobs, workers=1, max_memory=None, osmconvert=None, osmium=None, cache=None, resume=False,
+             dry_run=False):
+    """
+        Run the jobs as one graph of tasks on a single worker pool.  Returns the names of the failed jobs, None
+        when the jobs cannot be planned.
+    """
+    tasks, error = plan_jobs(jobs)
+    if error is not None:
+        print(error)
+        return None
+    for task in tasks:
+        print('Task {} for {}{}'.format(task['name'], ','.join(job['name'] for job in task['jobs']),
+                                        '' if len(task['after']) == 0 else ' after ' + ','.join(task['after'])))
+    if dry_run:
+        return []
+    for job in jobs:
+        if job['type'] == 'combine' and not resume and os.path.exists(job['output']):
+            print('{} already exists please delete before continuing'.format(job['output']))
+            return None
+
+    begin_time = time.time()
+    for job in jobs:
+        if job['type'] == 'export':
+            # Cleared once here, the tasks of the job then append to the manifest side by side
+            os.makedirs(job['output'], exist_ok=True)
+            if not resume:
+                Manifest(manifest_path(job)).reset()
+
+    scheduler = MemoryScheduler(workers=workers, max_memory=max_memory, preload=WORKER_MODULES)
+    for task in tasks:
+        if task['fn'] is run_extract:
+            args = task['args'] + (osmconvert, osmium, resume)
+        elif task['fn'] is copy_extract:
+            args = task['args'] + (resume,)
+        elif task['fn'] is export_theme:
+            args = task['args'] + (cache, resume)
+        else:
+            args = task['args'] + (resume,)
+        scheduler.submit(task['key'], task['size'], task['fn'], *args, name=task['name'], after=task['after'])
+    scheduler.run()
+
+    failed_tasks = set(task['name'] for task in scheduler.failed)
+    failed = []
+    for task in tasks:
+        if task['name'] in failed_tasks:
+            failed.extend(job['name'] for job in task['jobs'] if job['name'] not in failed)
+    print('Done {} tasks of {} jobs after {} seconds.'.format(len(tasks) - len(failed_tasks), len(jobs),
+                                                             round(time.time() - begin_time, 0)))
+    return failed
@@ -0,0 +1,54 @@
+import json
+import os
+import time
+
+
+class Manifest:
+    """
+        Record of the finished outputs of an export kept in the output folder, one JSON line per output.
+        Workers append their lines as they finish, the last line of an output wins and a line cut short
+        by a crash is ignored.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.folder = os.path.dirname(path)
+        self.entries = {}
+
+    def load(self):
+        self.entries = {}
+        if os.path.exists(self.path):
+            with open(self.path) as fp:
+                for line in fp:
+                    try:
+                        entry = json.loads(line)
+                        self.entries[entry['name']] = entry
+                    except (ValueError, KeyError, TypeError):
+                        continue
+        return self
+
+    def reset(self):
+        open(self.path, 'w').close()
+        self.entries = {}
+
+    def finished(self, name, key):
+        """
+            True when the output was written with the same inputs and settings and its files are still there
+        """
+        entry = self.entries.get(name)
+        if entry is None or entry.get('key') != key:
+            return False
+        return all(os.path.exists(os.path.join(self.folder, each)) for each in entry.get('files', []))
+
+    def record(self, name, key, files, features=None):
+        """
+            Append an output once its files are in place, files are stored relative to the output folder
+        """
+        entry = {'name': name, 'key': key, 'files': [os.path.relpath(each, self.folder) for each in files],
+                 'features': features, 'time': time.time()}
+        # One write to a file opened for append so the lines of parallel workers do not interleave
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, (json.dumps(entry) + '\n').encode())
+        finally:
+            os.close(fd)
@@ -1,14 +1,88 @@
 from pyrosm import OSM
-from concurrent.futures import ProcessPoolExecutor, as_completed
 import time
 import geopandas as gpd
 import os
+import copy
+import functools
+import hashlib
+import json
+import math
+import shutil
 from pygeos import GEOSException
+from shapely.errors import GEOSException as ShapelyGEOSException
+import shapely
 from shapely.geometry import Polygon
+from osmgo.extract import write_pbf, pbf_bounds, filter_pbf, region_names
+from osmgo.tiles import make_tiles, merge_tiles
+from osmgo.scheduler import MemoryScheduler, share_bytes, read_shared
+from osmgo.clip import ClipIndex, RegionIndex
+from osmgo.cache import ParseCache, pbf_fingerprint
+from osmgo.schema import OSM_COLUMNS, theme_columns, compact
+from osmgo.writer import write_atomic, remove_partial, output_files, output_path, GpkgWriter, AsyncWriter, \
+    StreamWriter
+from osmgo.stream import read_batches
+from osmgo.index import NodeIndex
+from osmgo.update import apply_changes, read_changes, locate_nodes, read_output, output_keys, splice, \
+    touched_tiles, shapefile_columns, reshaped_ways, UPDATE_TILE_SIZE
+from osmgo.instrument import Recorder, span, output_bytes, write_report
+from osmgo.workqueue import WorkQueue, run_worker, LEASE_SECONDS, POLL_SECONDS
 
+import multiprocessing
 import signal
 import psutil
 
+THEMES = ['aerialway', 'aeroway', 'amenity', 'boundary', 'building', 'craft', 'emergency', 'geological', 'highway',
+          'historic', 'landuse', 'leisure', 'natural', 'office', 'place', 'power', 'public_transport', 'railway',
+          'route', 'shop', 'tourism', 'waterway']
+
+FEATURES = ['point', 'line', 'polygon']
+
+# Geometry types written to each feature type layer
+GEOMETRY_TYPES = {'point': ['Point', 'MultiPoint'], 'line': ['LineString', 'MultiLineString'],
+                  'polygon': ['Polygon', 'MultiPolygon']}
+
+# Relative run time of the themes in a typical extract, used until a theme has a run time from a previous export
+THEME_WEIGHTS = {'building': 40, 'highway': 25, 'landuse': 6, 'natural': 6, 'amenity': 4, 'waterway': 3,
+                 'boundary': 2, 'leisure': 2, 'power': 2, 'railway': 2, 'route': 2, 'shop': 2}
+
+# Imported once by each pool worker when the pool starts
+WORKER_MODULES = ('osmgo.osmprocess',)
+
+
+# State of a pool worker set up once by init_process_worker, the tasks only carry a theme or a tile
+_worker = {}
+
+
+def init_process_worker(posm, clip, parse):
+    """
+        Worker initializer building the clip geometry, its index and the OSM reader once per worker.
+        clip is the (shared memory name, size, crs) of the clip geometry WKB.
+    """
+    if posm.recorder is not None:
+        posm.recorder = Recorder()
+    with span(posm.recorder, 'worker_init'):
+        geo = None
+        if clip is not None:
+            name, size, crs = clip
+            geo = shapely.from_wkb(read_shared(name, size))
+            posm.clip_gdf = gpd.GeoDataFrame(geometry=[geo], crs=crs)
+            posm.clip_index = ClipIndex(posm.clip_gdf, threads=posm.clip_threads)
+        if parse:
+            posm.osm = posm.open_osm(geo)
+    _worker['posm'] = posm
+
+
+def worker_task(method, *args):
+    """
+        Run a ProcessOSM method on the worker state and return the spans of this task only
+    """
+    posm = _worker['posm']
+    try:
+        return getattr(posm, method)(*args)
+    finally:
+        if posm.recorder is not None:
+            posm.recorder = Recorder()
+
 
 def kill_child_processes(parent_pid, sig=signal.SIGTERM):
     try:
@@ -20,6 +94,39 @@ def kill_child_processes(parent_pid, sig=signal.SIGTERM):
         process.send_signal(sig)
 
 
+def frame_size(gdf):
+    """
+        Bytes a GeoDataFrame holds in memory, its columns and the coordinates of its geometries
+    """
+    if gdf is None:
+        return 0
+    return int(gdf.drop(columns=gdf.geometry.name).memory_usage(deep=True).sum() +
+               shapely.get_num_coordinates(gdf.geometry.values).sum() * 16)
+
+
+def split_themes(gdf, themes, columns=None):
+    """
+        Split a multi-theme GeoDataFrame into a dict of theme GeoDataFrames.
+        Tag columns that are empty within a theme or not listed for the theme in columns are dropped.
+    """
+    gdfs = {}
+    for theme in themes:
+        if gdf is None or theme not in gdf.columns:
+            gdfs[theme] = None
+            continue
+        mask = gdf[theme].notna().to_numpy()
+        if not mask.any():
+            gdfs[theme] = None
+            continue
+        own = theme_columns(columns, theme)
+        # Pick the columns first so the theme rows are copied once
+        keep = [column for column in gdf.columns if column == gdf.geometry.name or
+                ((own is None or column in own or column in themes or column in OSM_COLUMNS) and
+                 gdf[column].notna().to_numpy()[mask].any())]
+        gdfs[theme] = compact(gdf.loc[mask, keep])
+    return gdfs
+
+
 class ProcessOSM:
     """
         Processing Class
@@ -40,6 +147,41 @@ class ProcessOSM:
         self.ext = ext
         self.bbox = None
         self.layer = None
+        self.single_pass = False  # True parses all themes with one read of the PBF
+        self.tiles = None  # (columns, rows) grid for tile processing
+        self.tile_size = None  # Tile width/height in decimal degrees
+        self.osmconvert = None
+        self.max_memory = None  # Memory budget in bytes for the worker pool
+        self.clip_index = None  # Subdivided clip geometry built on first use in each worker
+        self.clip_threads = 1  # Threads intersecting the features on the clip boundary
+        self.cache = None  # ParseCache of theme GeoDataFrames
+        self.fingerprint = None  # Content fingerprint of the PBF for the cache key
+        self.extent = None  # Clip/bbox extent passed to OSM for the cache key
+        self.single_gpkg = False  # True writes all layers into one GeoPackage from a single writer
+        self.write_queue = None  # Queue of (layer, gdf) to the single GeoPackage writer
+        self.write_threads = 1  # Background write threads per worker, 0 writes inline
+        self.recorder = None  # Recorder of stage spans when profiling
+        self.profile_report = None  # JSON/CSV path of the run report
+        self.profiler = None  # (cprofile|pyinstrument, folder) to profile each pool task
+        self.task_records = []  # Timing and memory of the finished pool tasks
+        self.prefilter = False  # True filters the PBF to the theme keys before parsing
+        self.osmium = None  # Path to the osmium tool for the prefilter
+        self.filtered = None  # Prefiltered PBF removed when the export is done
+        self.split = True  # True splits themes heavier than a worker's share of the work into smaller tasks
+        self.columns = None  # Tag columns parsed per theme, None keeps the pyrosm default columns
+        self.manifest = None  # Manifest of the finished outputs in the output folder
+        self.resume = False  # True skips the outputs the manifest records as finished with the same inputs
+        self.todo = {}  # Feature types left to write per theme when resuming, other themes write all features
+        self.split_by = None  # Clip attribute naming the regions written to their own outputs
+        self.regions = None  # (names, geometries) of the clip features when splitting by region
+        self.region_index = None  # RegionIndex of the regions built on first use in each worker
+        self.stream = False  # True streams the PBF in batches with pyosmium instead of parsing whole themes
+        self.batch_size = 50000  # Features per theme held in memory when streaming
+        self.node_store = 'sparse_file_array'  # osmium location store of the way nodes when streaming
+        self.node_index = None  # NodeIndex of the PBF when its index is current, used instead of the node store
+        self.queue = None  # Shared folder of a work queue whose workers on any host run the units of the export
+        self.lease = LEASE_SECONDS  # Seconds a queued unit stays claimed by a worker without a heartbeat
+        self.queue_workers = 1  # Local workers started on the work queue by the export
 
     def process(self):
         """
@@ -51,6 +193,543 @@ class ProcessOSM:
         # warnings.filterwarnings("ignore")
 
         begin_time = time.time()
+        if self.profile_report is not None:
+            self.recorder = Recorder()
+        self.set_extent()
+        # Cache and manifest keys stay on the source PBF, a theme parses to the same features from a filtered copy
+        if self.fingerprint is None and (self.cache is not None or self.manifest is not None):
+            self.fingerprint = pbf_fingerprint(self.inputs)
+        if self.manifest is not None and not self.load_manifest():
+            print('Nothing to resume, all outputs are finished')
+            return
+        # The index of the source PBF also covers a filtered copy
+        self.node_index = NodeIndex.open(self.inputs)
+        if self.node_index is not None:
+            print('Using node index {}'.format(self.node_index.folder))
+        if self.prefilter:
+            with span(self.recorder, 'prefilter') as record:
+                self.filter_input()
+                record['bytes'] = os.path.getsize(self.inputs)
+
+        writer = None
+        if self.single_gpkg:
+            writer = GpkgWriter(os.path.join(self.output, f'{self.prefix}.gpkg'), maxsize=max(2, self.workers * 2),
+                                manifest=self.manifest, keep=self.resume)
+            self.write_queue = writer.queue
+            writer.start()
+
+        if self.stream:
+            self.process_stream()
+        elif self.queue is not None:
+            self.process_queue()
+        elif self.tiles is not None or self.tile_size is not None:
+            self.process_tiles()
+        else:
+            self.process_themes()
+
+        if writer is not None:
+            writer.close()
+            self.write_queue = None
+        if self.filtered is not None:
+            os.remove(self.filtered)
+
+        total_time = time.time() - begin_time
+        print('Done after {} seconds.'.format(round(total_time, 0)))
+        if self.profile_report is not None:
+            self.write_report(total_time)
+
+    def set_extent(self):
+        """
+        Load the clip data and set the extent the cache and manifest keys are made from
+        """
+        with span(self.recorder, 'load_clip'):
+            self.load_clip()
+        if self.clip_data is not None:
+            self.extent = self.clip_gdf.geometry.unary_union.wkb_hex
+        elif self.bbox is not None:
+            self.extent = ','.join(str(each) for each in self.bbox)
+
+    def process_update(self, changes, updated):
+        """
+        Apply change files to the PBF and rewrite only what they touch.  The themes tagged on the changed
+        objects or holding them in the previous outputs are exported again from the tiles around the changes
+        and spliced into the previous outputs, the other outputs are kept.  A moved or deleted node affects the
+        themes holding the ways using it, found through the node index, and the themes holding relations when
+        such a way is in no output.  Without an index it affects all themes.  Outputs the manifest does not
+        record as finished with the same settings are exported in full.
+        """
+        begin_time = time.time()
+        self.set_extent()
+        self.fingerprint = pbf_fingerprint(self.inputs)
+        self.manifest.load()
+        remove_partial(self.output, self.output_names())
+        previous = {}
+        stale = {}
+        for theme in self.themes:
+            for geo in self.features:
+                name = self.output_name(theme, geo)
+                if self.manifest.finished(name, self.unit_key(theme, geo)):
+                    previous[(theme, geo)] = self.manifest.entries[name]
+                else:
+                    stale.setdefault(theme, []).append(geo)
+        if len(stale) > 0:
+            print('No finished output with these settings for {}, exporting them in full'.format(
+                ','.join(f'{theme}:{geo}' for theme in stale for geo in stale[theme])))
+
+        found = read_changes(changes, self.themes)
+        nodes = set(osm_id for osm_type, osm_id in found['changed'] if osm_type == 'node')
+        ways = set(osm_id for osm_type, osm_id in found['changed'] if osm_type == 'way')
+        for members in found['relations'].values():
+            nodes.update(osm_id for osm_type, osm_id in members if osm_type == 'node')
+            ways.update(osm_id for osm_type, osm_id in members if osm_type == 'way')
+        # The changed objects are looked up before and after the update to find where they were and are
+        index = NodeIndex.open(self.inputs)
+        before = locate_nodes(self.inputs, ways, nodes, index)
+        reshaped = reshaped_ways(found['moved'], index)
+        if apply_changes(self.inputs, changes, updated, self.osmconvert) is None:
+            exit()
+        self.inputs = updated
+        self.fingerprint = pbf_fingerprint(self.inputs)
+        after = locate_nodes(self.inputs, ways, nodes)
+
+        affected = set(found['themes'])
+        if reshaped is None:
+            print('Updating all themes, finding the ways of moved nodes needs a node index with ways, see osmgo index')
+            affected = set(self.themes)
+            reshaped = set()
+        # The previous rows of the reshaped ways are replaced like the rows of the changed objects
+        found['changed'].update(reshaped)
+        outputs = {}
+        for (theme, geo), entry in previous.items():
+            if entry['features'] and (theme not in affected or len(reshaped) > 0):
+                outputs[(theme, geo)] = set(output_keys(self.read_previous(theme, geo, ['id', 'osm_type'])))
+        # A reshaped way in no output is a member of a multipolygon, the themes holding relations are affected
+        members = len(reshaped - set().union(*outputs.values())) > 0
+        for (theme, geo), keys in outputs.items():
+            if not found['changed'].isdisjoint(keys) or (members and any(key[0] == 'relation' for key in keys)):
+                affected.add(theme)
+        # An affected theme with a stale output is exported in full with all its feature types
+        for theme in stale:
+            if theme in affected:
+                stale[theme] = list(self.features)
+        affected = [theme for theme in self.themes if theme in affected and theme not in stale]
+        keep = [(theme, geo) for theme, geo in previous if theme not in affected and geo not in stale.get(theme, [])]
+        for theme, geo in keep:
+            entry = previous[(theme, geo)]
+            self.record_output(theme, geo, [os.path.join(self.output, each) for each in entry['files']],
+                               entry['features'])
+        print('Keeping {} outputs, updating themes {}'.format(len(keep), ','.join(affected) or 'none'))
+
+        if len(affected) > 0:
+            tiles = self.extent_tiles(UPDATE_TILE_SIZE if self.tiles is None and self.tile_size is None else None)
+            if before is None or after is None:
+                print('Updating all tiles, locating the changed ways and relations needs pyosmium')
+            else:
+                tiles = touched_tiles(tiles, found['points'] + before + after)
+            print(f'Processing {len(tiles)} tiles')
+            tile_dir = os.path.join(self.output, f'{self.prefix}_update')
+            shutil.rmtree(tile_dir, ignore_errors=True)
+            os.makedirs(tile_dir)
+            geo = None if self.clip_gdf is None else self.clip_gdf.geometry.unary_union
+            scheduler, clip_block = self.scheduler(geo, parse=False)
+            size = os.path.getsize(self.inputs) // max(1, len(tiles))
+            for index, box in enumerate(tiles):
+                scheduler.submit('tile', size, worker_task, 'process_tile', index, box, tile_dir, affected,
+                                 split=functools.partial(self.split_tile, index, box, tile_dir, affected))
+            try:
+                self.task_records.extend(scheduler.run())
+            finally:
+                if clip_block is not None:
+                    clip_block.close()
+                    clip_block.unlink()
+            if len(scheduler.failed) > 0:
+                print('Failed tiles {}, tile outputs kept in {}'.format(
+                    ','.join(str(task['args'][1]) for task in scheduler.failed), tile_dir))
+                exit()
+            self.merge_update(tile_dir, affected, found['changed'])
+
+        if len(stale) > 0:
+            self.todo = stale
+            self.themes = list(stale)
+            if self.tiles is not None or self.tile_size is not None:
+                self.process_tiles()
+            else:
+                self.process_themes()
+        print('Done after {} seconds.'.format(round(time.time() - begin_time, 0)))
+
+    def read_previous(self, theme, geo, columns=None):
+        return read_output(output_path(self.output, self.prefix, theme, geo, self.ext), self.ext,
+                           layer='{}_{}'.format(theme, geo) if self.ext == 'gpkg' else None, columns=columns)
+
+    def merge_update(self, tile_dir, themes, changed):
+        """
+        Replace the changed features of the previous outputs with the features exported from the tiles
+        """
+        writer = AsyncWriter(threads=self.write_threads, max_pending=self.write_threads + 1)
+        for theme in themes:
+            for geo in self.features:
+                with span(self.recorder, 'merge', theme, geo) as record:
+                    gdf = merge_tiles(tile_dir, theme, geo)
+                    if gdf is not None and self.ext == 'shp':
+                        gdf = shapefile_columns(gdf, tile_dir)
+                    old = None
+                    if self.manifest.entries.get(self.output_name(theme, geo), {}).get('features'):
+                        old = self.read_previous(theme, geo)
+                    gdf = splice(old, gdf, changed)
+                    record['features'] = 0 if gdf is None else len(gdf)
+                if gdf is None or gdf.empty:
+                    print(f'\tEmpty dataframe {theme}:{geo}')
+                    self.record_output(theme, geo, [], 0)
+                    continue
+                print('{}:{} shape {}'.format(theme, geo, gdf.shape))
+                writer.submit(self.write_data, gdf, theme, geo)
+        writer.close()
+        shutil.rmtree(tile_dir)
+
+    def load_manifest(self):
+        """
+        Start the manifest, or when resuming narrow the themes and feature types to the outputs that are
+        missing or stale.  Returns False when there is nothing left to write.
+        """
+        remove_partial(self.output, self.output_names())
+        if not self.resume:
+            self.manifest.reset()
+            return True
+        return self.resume_themes()
+
+    def resume_themes(self):
+        """
+        Narrow the themes and feature types to the outputs the manifest does not record as finished
+        """
+        self.manifest.load()
+        self.todo = {}
+        for theme in self.themes:
+            features = [geo for geo in self.features if not all(
+                self.manifest.finished(self.output_name(theme, geo, region), self.unit_key(theme, geo, region))
+                for region in self.region_names())]
+            if len(features) == 0:
+                print(f'Finished {theme}')
+            elif len(features) < len(self.features):
+                print('Resuming {}:{}'.format(theme, ','.join(features)))
+            if len(features) > 0:
+                self.todo[theme] = features
+        self.themes = [theme for theme in self.themes if theme in self.todo]
+        return len(self.themes) > 0
+
+    def region_names(self):
+        """
+        Names of the regions written to their own outputs, [None] when the clip area is not split
+        """
+        return [None] if self.regions is None else self.regions[0]
+
+    def region_prefix(self, region=None):
+        return self.prefix if region is None else f'{self.prefix}_{region}'
+
+    def layer_name(self, theme, geo, region=None):
+        return '{}_{}'.format(theme, geo) if region is None else '{}_{}_{}'.format(region, theme, geo)
+
+    def output_name(self, theme, geo, region=None):
+        return f'{self.region_prefix(region)}_{theme}_{geo}'
+
+    def output_names(self):
+        return [self.output_name(theme, geo, region) for region in self.region_names()
+                for theme in self.themes for geo in self.features]
+
+    def unit_key(self, theme, geo, region=None):
+        """
+        Hash of the inputs and settings an output is made from, a finished output with another key is stale
+        """
+        settings = [self.fingerprint, self.extent, theme, geo, self.ext, self.keep, self.single_gpkg,
+                    theme_columns(self.columns, theme)]
+        if region is not None:
+            settings.extend([self.split_by, region])
+        if self.stream:
+            settings.append('stream')
+        return hashlib.sha1(json.dumps(settings).encode()).hexdigest()
+
+    def record_output(self, theme, geo, files, features, region=None):
+        if self.manifest is not None:
+            self.manifest.record(self.output_name(theme, geo, region), self.unit_key(theme, geo, region), files,
+                                 features)
+
+    def record_empty(self, theme, geo):
+        for region in self.region_names():
+            self.record_output(theme, geo, [], 0, region)
+
+    def filter_input(self):
+        """
+        Parse a copy of the PBF holding only the objects tagged with the theme keys and what they reference
+        """
+        filtered = filter_pbf(self.inputs, os.path.join(self.output, f'{self.prefix}_filtered.osm.pbf'), self.themes,
+                              self.osmium)
+        if filtered is None:
+            print('Continuing with the unfiltered PBF')
+            return
+        self.inputs = filtered
+        self.filtered = filtered
+
+    def write_report(self, total_time):
+        """
+        Write the spans of the parent and the pool tasks to the profile report
+        """
+        spans = list(self.recorder.spans)
+        tasks = []
+        for record in self.task_records:
+            spans.extend(record['result'])
+            tasks.append({key: value for key, value in record.items() if key != 'result'})
+        run = {'inputs': self.inputs, 'output': self.output, 'prefix': self.prefix, 'ext': self.ext,
+               'themes': self.themes, 'features': self.features, 'workers': self.workers,
+               'seconds': total_time, 'peak_rss': max([task['peak_rss'] for task in tasks], default=None)}
+        write_report(self.profile_report, run, tasks, spans)
+
+    def spans(self):
+        """
+        Spans recorded in this process, returned by the pool tasks to the parent
+        """
+        return [] if self.recorder is None else self.recorder.spans
+
+    def process_themes(self):
+        """
+        Run the themes in the worker pool
+        """
+        geo = None
+        if self.clip_gdf is not None:
+            geo = self.clip_gdf.geometry.unary_union
+
+        if self.cache is not None and self.fingerprint is None:
+            self.fingerprint = pbf_fingerprint(self.inputs)
+
+        # self.process_key(self.themes[8])
+
+        # for theme in self.themes:
+        #    self.process_key(theme)
+
+        size = os.path.getsize(self.inputs)
+        scheduler, clip_block = self.scheduler(geo, parse=not self.single_pass)
+        costs = {theme: scheduler.estimate_seconds(self.cost_key(theme), size, THEME_WEIGHTS.get(theme, 1))
+                 for theme in self.themes}
+        heavy = self.heavy_themes(costs)
+        chunks = {}
+        if self.single_pass:
+            self.osm = self.open_osm(geo)
+            gdfs = self.read_themes(self.themes)
+            # Workers only need the theme GeoDataFrames, not the parsed OSM object
+            self.osm = None
+            for theme in self.themes:
+                gdf = gdfs.pop(theme)
+                if theme in heavy and gdf is not None:
+                    self.submit_features(scheduler, gdf, theme, size, costs[theme])
+                else:
+                    scheduler.submit(self.cost_key(theme), size, worker_task, 'process_gdf', gdf, theme,
+                                     cost=costs[theme], loads=frame_size(gdf))
+        else:
+            bounds = None
+            if len(heavy) > 0 and self.osmconvert is not None:
+                bounds = list(self.clip_gdf.total_bounds) if self.clip_gdf is not None else \
+                    pbf_bounds(self.inputs, self.osmconvert)
+            for theme in self.themes:
+                chunk_dir = None
+                if theme in heavy and bounds is not None:
+                    chunk_dir = self.submit_chunks(scheduler, theme, geo, bounds, heavy[theme], size, costs[theme])
+                if chunk_dir is None:
+                    scheduler.submit(theme, size, worker_task, 'process_key', theme, cost=costs[theme],
+                                     split=functools.partial(self.split_theme, theme, geo, chunks))
+                else:
+                    chunks[theme] = chunk_dir
+        # Tasks that fail or run out of memory with a single worker are reported instead of killing the pool
+        try:
+            self.task_records.extend(scheduler.run())
+        finally:
+            if clip_block is not None:
+                clip_block.close()
+                clip_block.unlink()
+        failed = sorted(set(task['group'].split(':')[0] for task in scheduler.failed))
+        for theme in failed:
+            print(f'Failed theme {theme}')
+        for theme, chunk_dir in chunks.items():
+            if theme in failed:
+                print(f'Chunk outputs of {theme} kept in {chunk_dir}')
+            else:
+                self.merge_outputs(chunk_dir, [theme])
+
+    def process_stream(self):
+        """
+        Read the PBF once in batches and append each clipped batch to its outputs, so memory follows the batch
+        size instead of the size of a theme.  Way nodes are located from a memory mapped file next to the outputs.
+        """
+        begin_time = time.time()
+        index_path = os.path.join(self.output, f'{self.prefix}_nodes.idx')
+        writers = {}
+        try:
+            batches = read_batches(self.inputs, self.themes, self.columns, self.node_store, index_path,
+                                   self.batch_size, node_index=self.node_index)
+            for theme, gdf in batches:
+                with span(self.recorder, 'geom_type', theme) as record:
+                    gdf['geom_type'] = gdf.geometry.geom_type.astype('string')
+                    record['features'] = len(gdf)
+                for geo in self.todo.get(theme, self.features):
+                    mask = gdf['geom_type'].isin(GEOMETRY_TYPES[geo]).to_numpy()
+                    if not self.keep:
+                        mask[mask] = gdf.geometry.values[mask].is_valid
+                    if not mask.any():
+                        continue
+                    with span(self.recorder, 'clip', theme, geo) as record:
+                        if self.regions is not None:
+                            if self.region_index is None:
+                                self.region_index = RegionIndex(*self.regions, crs=gdf.crs, threads=self.clip_threads)
+                            gdfs = self.region_index.split(gdf[mask])
+                        elif self.clip_gdf is not None:
+                            if self.clip_index is None:
+                                self.clip_index = ClipIndex(self.clip_gdf, threads=self.clip_threads)
+                            gdfs = {None: self.clip_index.clip(gdf[mask])}
+                        else:
+                            gdfs = {None: gdf[mask]}
+                        record['features'] = sum(len(each) for each in gdfs.values())
+                    with span(self.recorder, 'write', theme, geo):
+                        for region, gdf_write in gdfs.items():
+                            if gdf_write.empty:
+                                continue
+                            if (theme, geo, region) not in writers:
+                                writers[(theme, geo, region)] = StreamWriter(
+                                    output_path(self.output, self.region_prefix(region), theme, geo, self.ext),
+                                    self.ext, layer=self.layer_name(theme, geo, region) if self.ext == 'gpkg' else None)
+                            writers[(theme, geo, region)].write(gdf_write)
+                print('Streamed {} {} features after {} seconds.'.format(len(gdf), theme,
+                                                                         round(time.time() - begin_time, 0)))
+        finally:
+            if os.path.exists(index_path):
+                os.remove(index_path)
+
+        for theme in self.themes:
+            for geo in self.todo.get(theme, self.features):
+                for region in self.region_names():
+                    writer = writers.get((theme, geo, region))
+                    if writer is None:
+                        print('\tEmpty dataframe {}'.format(self.layer_name(theme, geo, region)))
+                        self.record_output(theme, geo, [], 0, region)
+                        continue
+                    features = writer.close()
+                    self.record_output(theme, geo, output_files(writer.path, self.ext), features, region)
+                    print('Done {} with {} features.'.format(self.layer_name(theme, geo, region), features))
+
+    def cost_key(self, theme):
+        """
+        Key of the run time history of a theme, clipping a theme parsed with --single-pass is kept apart from
+        parsing it
+        """
+        return f'{theme}:single' if self.single_pass else theme
+
+    def heavy_themes(self, costs):
+        """
+        Number of tasks for each theme expected to take longer than a worker's share of the total work
+        """
+        if not self.split or self.workers == 1:
+            return {}
+        share = sum(costs.values()) / self.workers
+        return {theme: min(self.workers, math.ceil(cost / share)) for theme, cost in costs.items() if cost > share}
+
+    def submit_features(self, scheduler, gdf, theme, size, cost):
+        """
+        Queue each feature type of a parsed theme as its own task, each writes its own layer
+        """
+        gdf['geom_type'] = gdf.geometry.geom_type
+        for geo in self.todo.get(theme, self.features):
+            gdf_select = gdf[gdf['geom_type'].isin(GEOMETRY_TYPES[geo])]
+            scheduler.submit(f'{theme}:{geo}', size, worker_task, 'process_gdf', gdf_select, theme, [geo],
+                             group=self.cost_key(theme), cost=cost * len(gdf_select) / len(gdf),
+                             loads=frame_size(gdf_select))
+
+    def submit_chunks(self, scheduler, theme, geo, bounds, parts, size, cost):
+        """
+        Queue a theme as spatial chunks cut from the PBF with osmconvert.  Returns the folder the chunk outputs
+        are merged from, or None when the theme is not split.
+        """
+        # A cached theme is read instead of parsed so there is nothing to split
+        if self.cache is not None and self.cache.has(self.cache_key(theme)):
+            return None
+        columns = math.ceil(math.sqrt(parts))
+        boxes = make_tiles(bounds, grid=(columns, math.ceil(parts / columns)))
+        if geo is not None:
+            boxes = [box for box in boxes if geo.intersects(shapely.box(*box))]
+        if len(boxes) < 2:
+            return None
+        print(f'Splitting {theme} into {len(boxes)} chunks')
+        chunk_dir = os.path.join(self.output, f'{self.prefix}_{theme}_chunks')
+        # Chunks left by an export that was killed may be cut differently
+        shutil.rmtree(chunk_dir, ignore_errors=True)
+        os.makedirs(chunk_dir)
+        for index, box in enumerate(boxes):
+            scheduler.submit(f'{theme}:chunk', size, worker_task, 'process_tile', index, box, chunk_dir, [theme],
+                             group=theme, cost=cost / len(boxes),
+                             split=functools.partial(self.split_tile, index, box, chunk_dir, [theme]))
+        return chunk_dir
+
+    def split_theme(self, theme, geo, chunks, scheduler, task):
+        """
+        Queue a theme that ran out of memory again as four spatial chunks, the chunk folder is added to chunks
+        to be merged.  Returns False when there is no osmconvert or extent to cut the chunks.
+        """
+        if self.osmconvert is None:
+            return False
+        bounds = list(self.clip_gdf.total_bounds) if self.clip_gdf is not None else \
+            pbf_bounds(self.inputs, self.osmconvert)
+        if bounds is None:
+            return False
+        chunk_dir = self.submit_chunks(scheduler, theme, geo, bounds, 4, task['size'], task['cost'])
+        if chunk_dir is None:
+            return False
+        chunks[theme] = chunk_dir
+        return True
+
+    def split_tile(self, index, box, tile_dir, themes, scheduler, task):
+        """
+        Queue a tile or chunk that ran out of memory again as its four quarters.  The quarters write to the
+        same folder and the features they share with each other or with outputs the tile finished are
+        dropped when the folder is merged.
+        """
+        for part, quarter in enumerate(make_tiles(box, grid=(2, 2))):
+            name = f'{index}_{part}'
+            scheduler.submit(task['key'], task['size'] // 4, worker_task, 'process_tile', name, quarter, tile_dir,
+                             themes, group=task['group'], cost=task['cost'] / 4,
+                             split=functools.partial(self.split_tile, name, quarter, tile_dir, themes))
+        return True
+
+    def scheduler(self, geo, parse):
+        """
+        Pool whose workers set up the clip index and OSM reader once.  The clip geometry is handed to the
+        workers as WKB in shared memory instead of pickling this instance with every task.
+        """
+        clip = None
+        clip_block = None
+        if geo is not None:
+            wkb = shapely.to_wkb(geo)
+            clip_block = share_bytes(wkb)
+            clip = (clip_block.name, len(wkb), self.clip_gdf.crs)
+        worker = copy.copy(self)
+        worker.osm = None
+        worker.clip_gdf = None
+        worker.clip_index = None
+        worker.region_index = None
+        worker.task_records = []
+        scheduler = MemoryScheduler(workers=self.workers, max_memory=self.max_memory, profiler=self.profiler,
+                                    preload=WORKER_MODULES, initializer=init_process_worker,
+                                    initargs=(worker, clip, parse))
+        return scheduler, clip_block
+
+    def open_osm(self, geo=None):
+        """
+        OSM reader of the PBF limited to the clip geometry or bbox
+        """
+        if self.clip_data is not None:
+            return OSM(self.inputs, geo)
+        elif self.bbox is not None:
+            return OSM(self.inputs, self.bbox)
+        return OSM(self.inputs)
+
+    def load_clip(self):
+        """
+        Read the clip data or create the clip GeoDataFrame from the bbox
+        """
         if self.clip_data is not None:
             if self.layer is None:
                 self.clip_gdf = gpd.read_file(self.clip_data)
@@ -60,138 +739,436 @@ class ProcessOSM:
                 except ValueError as e:
                     print(e)
                     exit()
-
-            geo = self.clip_gdf.geometry.unary_union
-            self.osm = OSM(self.inputs, geo)
+            if self.split_by is not None:
+                if self.split_by not in self.clip_gdf.columns:
+                    print(f'Attribute {self.split_by} not found in {self.clip_data}')
+                    exit()
+                self.regions = (region_names(self.clip_gdf[self.split_by]), list(self.clip_gdf.geometry.values))
+                print('Splitting the clip area into {} regions by {}'.format(len(self.regions[0]), self.split_by))
         elif self.bbox is not None:
-            self.osm = OSM(self.inputs, self.bbox)
-
             # Create Clip GDF from bbox coordinate
             p = Polygon([(self.bbox[0], self.bbox[1]), (self.bbox[0], self.bbox[3]),
                          (self.bbox[2], self.bbox[3]), (self.bbox[2], self.bbox[1])])
             self.clip_gdf = gpd.GeoDataFrame({'geometry': [p]}, geometry='geometry')
             self.clip_gdf.set_crs(epsg=4326, inplace=True)
+
+    def extent_tiles(self, tile_size=None):
+        """
+        Cut the clip extent or the PBF extent into tiles, the tiles that do not touch the clip area are skipped
+        """
+        if self.clip_gdf is not None:
+            bounds = list(self.clip_gdf.total_bounds)
         else:
-            self.osm = OSM(self.inputs)
+            bounds = pbf_bounds(self.inputs, self.osmconvert)
+            if bounds is None:
+                exit()
+        tiles = make_tiles(bounds, grid=self.tiles, tile_size=tile_size or self.tile_size)
+        if self.clip_gdf is not None:
+            # Skip tiles that do not touch the clip area
+            geo = self.clip_gdf.geometry.unary_union
+            tiles = [box for box in tiles if geo.intersects(Polygon([(box[0], box[1]), (box[0], box[3]),
+                                                                     (box[2], box[3]), (box[2], box[1])]))]
+        return tiles
 
-        # self.process_key(self.themes[8])
+    def process_tiles(self):
+        """
+        Cut the extent into tiles, process each tile PBF in the pool and merge the tile outputs per theme
+        """
+        tiles = self.extent_tiles()
+        print(f'Processing {len(tiles)} tiles')
 
-        # for theme in self.themes:
-        #    self.process_key(theme)
+        tile_dir = os.path.join(self.output, f'{self.prefix}_tiles')
+        # Tiles left by an export that was killed may be cut differently
+        shutil.rmtree(tile_dir, ignore_errors=True)
+        os.makedirs(tile_dir)
 
-        futures = []
-        with ProcessPoolExecutor(max_workers=self.workers) as executor:
-            for theme in self.themes:
-                futures.append(executor.submit(self.process_key, theme))
-            # for f in futures:
-            #    print(f, 'running?', f.running())
-            for x in as_completed(futures):
-
-                #for f in futures:
-                #    print(f, 'running?', f.running())
-                if x.exception() is not None:
-                    print(f'Future Exception {x.exception()}')
-                    # Kill remaining child processes
-                    kill_child_processes(os.getpid())
-                    # Plagued by general memory errors from pyrosm
-                    # Consumes all memory ram/swap then hangs machine
-                    # you can't cancel an active job
-                    # shutdown only cancels queued tasks not active tasks
-                    # only thing left to do is kill processes if there is an error
-
-                    #print('cancel')
-                    #for f in futures:
-                    #    f.cancel()
-                    # executor.shutdown(wait=False)
-                    # for f in futures:
-                    #     f.cancel()
-                    #     print(f, 'running?', f.running())
-                    #     if f.running():
-                    #         f.cancel()
-                    #         print('Cancelled? ', f.cancelled())
-                    # exit()
-
-                #try:
-                #    print(x.result())
-                #except Exception as exc:
-                #    print(f'generated an exception: {exc}')
-                #    exit()
+        geo = None if self.clip_gdf is None else self.clip_gdf.geometry.unary_union
+        scheduler, clip_block = self.scheduler(geo, parse=False)
+        size = os.path.getsize(self.inputs) // len(tiles)
+        for index, box in enumerate(tiles):
+            scheduler.submit('tile', size, worker_task, 'process_tile', index, box, tile_dir,
+                             split=functools.partial(self.split_tile, index, box, tile_dir, None))
+        try:
+            self.task_records.extend(scheduler.run())
+        finally:
+            if clip_block is not None:
+                clip_block.close()
+                clip_block.unlink()
+        if len(scheduler.failed) > 0:
+            print('Failed tiles {}, tile outputs kept in {}'.format(
+                ','.join(str(task['args'][1]) for task in scheduler.failed), tile_dir))
+            return
+        self.merge_outputs(tile_dir, self.themes)
 
-        total_time = time.time() - begin_time
-        print('Done after {} seconds.'.format(round(total_time, 0)))
+    def merge_outputs(self, tile_dir, themes):
+        """
+        Merge the tile outputs per theme and feature type, write them and remove the tile folder
+        """
+        # Merge the next theme while the previous one is written
+        writer = AsyncWriter(threads=self.write_threads, max_pending=self.write_threads + 1)
+        for theme in themes:
+            for geo in self.todo.get(theme, self.features):
+                with span(self.recorder, 'merge', theme, geo) as record:
+                    gdf = merge_tiles(tile_dir, theme, geo)
+                    record['features'] = 0 if gdf is None else len(gdf)
+                if gdf is None or gdf.empty:
+                    print(f'\tEmpty dataframe {theme}:{geo}')
+                    self.record_empty(theme, geo)
+                    continue
+                print('{}:{} shape {}'.format(theme, geo, gdf.shape))
+                if self.regions is None:
+                    writer.submit(self.write_data, gdf, theme, geo)
+                else:
+                    self.write_regions(writer, gdf, theme, geo)
+        writer.close()
+        shutil.rmtree(tile_dir)
+
+    def process_tile(self, index, box, tile_dir, themes=None):
+        """
+        Extract the tile from the PBF with osmconvert and run the theme workflow on it
+        """
+        begin_time = time.time()
+        if themes is None:
+            themes = self.themes
+        tile_temp = os.path.join(tile_dir, f'tile{index}_temp')
+        tile_pbf = os.path.join(tile_dir, f'tile{index}.pbf')
+        with span(self.recorder, 'extract', f'tile{index}') as record:
+            if not write_pbf(self.inputs, tile_pbf, self.osmconvert, bbox=box, complete_ways=True, temp=tile_temp):
+                # A missing tile would be merged as a tile without features
+                raise RuntimeError(f'Unable to cut tile {index} from {self.inputs}')
+            record['bytes'] = output_bytes(tile_pbf)
+
+        # Tile outputs are written as gpkg to the tile folder and merged when all tiles are finished
+        tile = copy.copy(self)
+        tile.output = tile_dir
+        tile.prefix = f'tile{index}'
+        tile.ext = 'gpkg'
+        # Tile PBFs are temporary so their parse is not cached
+        tile.cache = None
+        tile.write_queue = None
+        tile.manifest = None
+        # Tiles are clipped to the whole clip area, the merged outputs are split by region
+        tile.regions = None
+        tile.osm = OSM(tile_pbf)
+        gdfs = tile.read_themes(themes)
+        for theme in themes:
+            tile.process_gdf(gdfs.pop(theme), theme)
+        os.remove(tile_pbf)
+        print('Done tile {} after {} seconds.'.format(index, round(time.time() - begin_time, 0)))
+        return self.spans()
+
+    def queue_units(self):
+        """
+        Units of the export for the work queue, each theme by tile, by region bounds or over the whole extent
+        """
+        if self.tiles is not None or self.tile_size is not None:
+            boxes = self.extent_tiles()
+        elif self.regions is not None:
+            # Features are cut to the whole clip area and split by region when the units are merged
+            boxes = [list(geom.bounds) for geom in self.regions[1]]
+        else:
+            boxes = [None]
+        return [{'id': f'{theme}-{index:05d}', 'theme': theme, 'index': index, 'box': box}
+                for theme in self.themes for index, box in enumerate(boxes)]
+
+    def queue_job(self, units):
+        """
+        Settings a worker needs to run the units, with absolute paths for workers started elsewhere
+        """
+        job = {'inputs': os.path.abspath(self.inputs), 'output': os.path.abspath(self.output), 'prefix': self.prefix,
+               'ext': self.ext, 'themes': self.themes, 'features': self.features, 'todo': self.todo,
+               'clip_data': None if self.clip_data is None else os.path.abspath(self.clip_data),
+               'layer': self.layer, 'bbox': self.bbox, 'keep': self.keep, 'columns': self.columns,
+               'split_by': self.split_by, 'clip_threads': self.clip_threads, 'write_threads': self.write_threads,
+               'lease': self.lease}
+        job['key'] = hashlib.sha1(json.dumps([self.fingerprint, self.extent, job, units]).encode()).hexdigest()
+        return job
+
+    @classmethod
+    def from_queue_job(cls, job, osmconvert=None):
+        """
+        Export of a queued job set up in a worker
+        """
+        posm = cls(job['inputs'], job['output'], job['prefix'], job['ext'], job['themes'], job['features'])
+        posm.todo = job['todo']
+        posm.clip_data = job['clip_data']
+        posm.layer = job['layer']
+        posm.bbox = job['bbox']
+        posm.keep = job['keep']
+        posm.columns = job['columns']
+        posm.split_by = job['split_by']
+        posm.clip_threads = job['clip_threads']
+        posm.write_threads = job['write_threads']
+        posm.osmconvert = osmconvert
+        posm.set_extent()
+        return posm
+
+    def process_unit(self, theme, index, box, tile_dir):
+        """
+        Write the outputs of a theme in a tile, or in the whole extent when box is None, to tile_dir
+        """
+        if box is not None:
+            if self.osmconvert is None:
+                raise RuntimeError('Cutting tiles needs osmconvert')
+            return self.process_tile(index, box, tile_dir, [theme])
+        unit = copy.copy(self)
+        unit.output = tile_dir
+        unit.prefix = f'tile{index}'
+        unit.ext = 'gpkg'
+        unit.write_queue = None
+        unit.manifest = None
+        unit.regions = None
+        unit.osm = unit.open_osm(None if self.clip_gdf is None else self.clip_gdf.geometry.unary_union)
+        return unit.process_key(theme)
+
+    def process_queue(self):
+        """
+        Queue the units of the export in the shared work queue, start the local workers and wait until the
+        workers of every host have finished the units, then merge the unit outputs per theme
+        """
+        work = WorkQueue(self.queue, lease=self.lease)
+        units = self.queue_units()
+        work.start(self.queue_job(units), units, keep=self.resume)
+        print('Queued {} units in {}'.format(len(units), self.queue))
+        # Forked after the queue is written, a local worker is the same as an osmgo worker on another host
+        local = [multiprocessing.Process(target=run_worker, args=(self.queue, self.osmconvert))
+                 for _ in range(self.queue_workers)]
+        for process in local:
+            process.start()
+        last = None
+        while True:
+            work.reclaim()
+            counts = work.counts()
+            if counts != last:
+                print('Queue {todo} waiting, {claimed} running, {done} done, {failed} failed'.format(**counts))
+                last = counts
+            if counts['todo'] == 0 and counts['claimed'] == 0:
+                break
+            time.sleep(POLL_SECONDS)
+        for process in local:
+            process.join()
+
+        done = set(work.names('done'))
+        failed = sorted(set(unit['theme'] for unit in units if unit['id'] not in done))
+        for theme in self.themes:
+            tile_dir = work.path('tiles', theme)
+            if theme in failed:
+                print(f'Failed theme {theme}, unit outputs kept in {tile_dir}')
+                continue
+            # A theme whose units wrote nothing has no folder
+            os.makedirs(tile_dir, exist_ok=True)
+            self.merge_outputs(tile_dir, [theme])
+        if len(failed) == 0:
+            work.clear()
 
     def process_key(self, theme):
         """
         Workflow for processing OSM data
         """
         begin_time = time.time()
-        geod = {'point': ['Point', 'MultiPoint'], 'line': ['LineString', 'MultiLineString'],
-                'polygon': ['Polygon', 'MultiPolygon']}
+        gdf = self.parse_theme(theme)
+        self.process_gdf(gdf, theme)
+
+        total_time = time.time() - begin_time
+        print('Done {} after {} seconds.'.format(theme, round(total_time, 0)))
+        return self.spans()
+
+    def parse_theme(self, theme):
+        """
+        Theme GeoDataFrame from the parse cache or parsed from the PBF
+        """
+        begin_time = time.time()
         print(f'Processing PBF for {theme}')
-        try:
-            gdf = self.osm.get_data_by_custom_criteria(osm_keys_to_keep=theme, custom_filter={theme: True})
-        except Exception as e:
-            print('Bad Mojo')
-            print(f'Exception Exit {e} theme :{theme}')
-            raise #RuntimeError(f'Exception Exit {e}')
-            #exit()
+        cache_recorder = None if self.cache is None else self.recorder
+        with span(cache_recorder, 'cache_read', theme) as record:
+            hit, gdf = self.read_cache(theme)
+            record['features'] = None if gdf is None else len(gdf)
+        if hit:
+            print(f'Cached PBF for {theme}')
+        else:
+            with span(self.recorder, 'parse', theme) as record:
+                try:
+                    gdf = self.osm.get_data_by_custom_criteria(osm_keys_to_keep=theme, custom_filter={theme: True},
+                                                               tags_as_columns=theme_columns(self.columns, theme))
+                except Exception as e:
+                    print('Bad Mojo')
+                    print(f'Exception Exit {e} theme :{theme}')
+                    raise #RuntimeError(f'Exception Exit {e}')
+                    #exit()
+                record['features'] = 0 if gdf is None else len(gdf)
+            with span(self.recorder, 'compact', theme):
+                gdf = compact(gdf)
+            with span(cache_recorder, 'cache_write', theme):
+                self.write_cache(theme, gdf)
 
         print('Done PBF for {} after {} seconds.'.format(theme, round(time.time() - begin_time, 0)))
+        return gdf
+
+    def read_themes(self, themes):
+        """
+        Decode the PBF once for all themes and split the result per theme.
+        A feature tagged with more than one theme key is returned in each of those themes.
+        """
+        begin_time = time.time()
+        gdfs = {}
+        missing = []
+        for theme in themes:
+            hit, gdf = self.read_cache(theme, mode='single')
+            if hit:
+                print(f'Cached PBF for {theme}')
+                gdfs[theme] = gdf
+            else:
+                missing.append(theme)
+        if len(missing) == 0:
+            return gdfs
+
+        print('Processing PBF for {}'.format(','.join(missing)))
+        with span(self.recorder, 'parse', ','.join(missing)) as record:
+            try:
+                gdf = self.osm.get_data_by_custom_criteria(osm_keys_to_keep=missing,
+                                                           custom_filter={theme: True for theme in missing})
+            except Exception as e:
+                print('Bad Mojo')
+                print(f'Exception Exit {e} themes :{missing}')
+                raise
+            record['features'] = 0 if gdf is None else len(gdf)
+
+        print('Done PBF for {} themes after {} seconds.'.format(len(missing), round(time.time() - begin_time, 0)))
+        for theme, gdf_theme in split_themes(gdf, missing, self.columns).items():
+            self.write_cache(theme, gdf_theme, mode='single')
+            gdfs[theme] = gdf_theme
+        return gdfs
+
+    def cache_key(self, theme, mode=''):
+        """
+        Parse cache key of the theme, the tag columns parsed are part of the key
+        """
+        columns = theme_columns(self.columns, theme)
+        if columns is not None:
+            mode = '{}|{}'.format(mode, ','.join(columns))
+        return ParseCache.key(self.fingerprint, self.extent, theme, mode)
+
+    def read_cache(self, theme, mode=''):
+        """
+        Return (hit, gdf) for the theme from the parse cache
+        """
+        if self.cache is None:
+            return False, None
+        return self.cache.get(self.cache_key(theme, mode))
+
+    def write_cache(self, theme, gdf, mode=''):
+        if self.cache is not None:
+            self.cache.put(self.cache_key(theme, mode), gdf)
+
+    def process_gdf(self, gdf, theme, features=None):
+        """
+        Split a theme GeoDataFrame by geometry type, clip and write each feature type
+        """
+        if features is None:
+            features = self.todo.get(theme, self.features)
+        # Writes run in the background while the next feature type is clipped
+        writer = AsyncWriter(threads=self.write_threads, max_pending=self.write_threads + 1)
         if gdf is not None:
             theme_time = time.time()
-            gdf['geom_type'] = gdf.geometry.geom_type
+            with span(self.recorder, 'geom_type', theme) as record:
+                gdf['geom_type'] = gdf.geometry.geom_type.astype('category')
+                record['features'] = len(gdf)
 
-            for geo in self.features:
+            for geo in features:
                 print(f'Processing {theme}:{geo}')
                 theme_time = time.time()
-                gdf_select = gdf[gdf["geom_type"].isin(geod[geo])]
-                if not gdf_select.empty:
+                # Rows are picked with a mask and copied once per feature type
+                with span(self.recorder, 'split', theme, geo) as record:
+                    mask = gdf['geom_type'].isin(GEOMETRY_TYPES[geo]).to_numpy()
+                    record['features'] = int(mask.sum())
+                if mask.any() and self.regions is not None:
+                    if not self.keep:
+                        mask[mask] = gdf.geometry.values[mask].is_valid
+                    self.write_regions(writer, gdf[mask], theme, geo)
+                    print('Done Geodataframe processing: {}:{} after {} seconds .'.format(
+                        theme, geo, round(time.time() - theme_time, 0)))
+                elif mask.any():
                     if self.clip_gdf is not None:
                         try:
                             # Remove bad geometries in OSM file before clipping
                             if not self.keep:
-                                start = gdf_select.shape[0]
-                                gdf_select = gdf_select[gdf_select.geometry.is_valid]
-                                if start != gdf_select.shape[0]:
-                                    end = start - gdf_select.shape[0]
+                                with span(self.recorder, 'valid', theme, geo) as record:
+                                    start = int(mask.sum())
+                                    mask[mask] = gdf.geometry.values[mask].is_valid
+                                    record['features'] = int(mask.sum())
+                                if start != record['features']:
+                                    end = start - record['features']
                                     print(f'\tRemoving {end} geometries from {theme}:{geo}')
-                            gdp_clip = gpd.clip(gdf_select, self.clip_gdf)
+                            gdf_select = gdf[mask]
+                            with span(self.recorder, 'clip', theme, geo) as record:
+                                if self.clip_index is None:
+                                    self.clip_index = ClipIndex(self.clip_gdf, threads=self.clip_threads)
+                                gdp_clip = self.clip_index.clip(gdf_select)
+                                record['features'] = len(gdp_clip)
                             print('{}:{} shape {}'.format(theme, geo, gdp_clip.shape))
                             print('Done Geodataframe processing: {}:{} after {} seconds .'.format(theme, geo,
                                                                                 round(time.time() - theme_time, 0)))
 
-                            self.write_data(gdp_clip, theme, geo)
-                        except GEOSException:
+                            writer.submit(self.write_data, gdp_clip, theme, geo)
+                        except (GEOSException, ShapelyGEOSException):
 
                             print(f'Unable to clip {theme}:{geo} exporting unclipped')
-                            self.write_data(gdf_select, theme, geo)
+                            writer.submit(self.write_data, gdf[mask], theme, geo)
                             continue
                     else:
+                        gdf_select = gdf[mask]
                         print('{}:{} shape {}'.format(theme, geo, gdf_select.shape))
                         print('Done Geodataframe processing: {}:{} after {} seconds .'.format(theme, geo,
                                                                                     round(time.time() - theme_time, 0)))
 
-                        self.write_data(gdf_select, theme, geo)
+                        writer.submit(self.write_data, gdf_select, theme, geo)
                 else:
                     print(f'\tEmpty dataframe {theme}:{geo}')
+                    self.record_empty(theme, geo)
         else:
             print(f'\tEmpty theme {theme}')
+            for geo in features:
+                self.record_empty(theme, geo)
+        with span(self.recorder, 'write_wait', theme):
+            writer.close()
+        return self.spans()
 
-        total_time = time.time() - begin_time
-        print('Done {} after {} seconds.'.format(theme, round(total_time, 0)))
-        return theme
+    def write_regions(self, writer, gdf, theme, geo):
+        """
+        Assign the features to the regions they fall in, clip them per region and write an output per region
+        """
+        with span(self.recorder, 'regions', theme, geo) as record:
+            if self.region_index is None:
+                names, geoms = self.regions
+                self.region_index = RegionIndex(names, geoms, crs=gdf.crs, threads=self.clip_threads)
+            gdfs = self.region_index.split(gdf)
+            record['features'] = sum(len(each) for each in gdfs.values())
+        for region in self.region_names():
+            if region in gdfs:
+                writer.submit(self.write_data, gdfs[region], theme, geo, region)
+            else:
+                self.record_output(theme, geo, [], 0, region)
+        print('{}:{} written to {} regions'.format(theme, geo, len(gdfs)))
 
     # noinspection SpellCheckingInspection
-    def write_data(self, gdf_write, theme, geo):
+    def write_data(self, gdf_write, theme, geo, region=None):
         begin_time = time.time()
-        if self.ext == 'shp':
-            outputfile_shp = os.path.join(self.output, f'{self.prefix}_{theme}_{geo}.shp')
-            gdf_write.to_file(outputfile_shp)
-        elif self.ext == 'geojson':
-            outputfile_gjson = os.path.join(self.output, f'{self.prefix}_{theme}_{geo}.geojson')
-            gdf_write.to_file(outputfile_gjson, driver='GeoJSON')
-        else:
-            outputfile_gpkg = os.path.join(self.output, f'{self.prefix}_{theme}_{geo}.gpkg')
-            gdf_write.to_file(outputfile_gpkg, layer='{}_{}'.format(theme, geo), driver="GPKG")
+        name = self.layer_name(theme, geo, region)
+        if self.write_queue is not None:
+            # The single GeoPackage writer in the parent process writes the layer
+            with span(self.recorder, 'queue_put', theme, geo) as record:
+                entry = None if self.manifest is None else (self.output_name(theme, geo, region),
+                                                            self.unit_key(theme, geo, region))
+                self.write_queue.put((name, gdf_write, entry))
+                record['features'] = len(gdf_write)
+            print('Queued {} in {} seconds.'.format(name, round(time.time() - begin_time, 0)))
+            return
+        outputfile = output_path(self.output, self.region_prefix(region), theme, geo, self.ext)
+        layer = name if self.ext == 'gpkg' else None
+        with span(self.recorder, 'write', theme, geo) as record:
+            write_atomic(gdf_write, outputfile, self.ext, layer=layer)
+            record['features'] = len(gdf_write)
+            record['bytes'] = output_bytes(outputfile)
+        self.record_output(theme, geo, output_files(outputfile, self.ext), len(gdf_write), region)
 
         print('Done {}:{} in {} seconds to file.'.format(theme, geo, round(time.time() - begin_time, 0)))
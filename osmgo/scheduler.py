@@ -0,0 +1,396 @@
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+import cProfile
+import importlib
+import json
+import os
+import re
+import threading
+import time
+import psutil
+
+try:
+    import resource
+except ImportError:  # Windows has no address space limits
+    resource = None
+
+# Peak memory of a task as a multiple of the PBF size when there is no history for the task
+DEFAULT_RATIO = 30.0
+
+# Run time of a task in seconds per byte of PBF when there is no history for the task
+DEFAULT_SECONDS = 2e-8
+
+# Times a task that runs out of memory with one worker is split again into smaller parts before it fails
+MAX_SPLIT_DEPTH = 2
+
+
+def parse_memory(memory):
+    """
+        Convert a memory size such as 512M, 8G or 8GB to bytes
+    """
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+    memory = memory.strip().upper().rstrip('B')
+    try:
+        if memory[-1] in units:
+            return int(float(memory[:-1]) * units[memory[-1]])
+        return int(memory)
+    except (ValueError, IndexError):
+        return None
+
+
+def limit_memory(limit):
+    """
+        Worker initializer limiting the address space a worker can add on top of what it starts with.  The
+        limit is on virtual memory, RLIMIT_AS, as Linux does not enforce a resident memory limit.  pyarrow and
+        GDAL reserve address space they never touch, so a worker can hit the limit well below the same
+        resident memory.
+    """
+    if resource is not None and limit is not None:
+        # The forked worker already maps the interpreter and imported libraries
+        limit += psutil.Process().memory_info().vms
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+def init_worker(limit=None, modules=(), initializer=None, initargs=()):
+    """
+        Worker initializer importing the modules the tasks use once per worker before its memory is limited,
+        so spawned workers do not pay the imports in their first task.  initializer(*initargs) then sets up
+        the state the tasks of the worker share.
+    """
+    for module in modules:
+        importlib.import_module(module)
+    if initializer is not None:
+        initializer(*initargs)
+    limit_memory(limit)
+
+
+def share_bytes(data):
+    """
+        Copy data into a new shared memory block, the workers read it by name with read_shared
+    """
+    block = shared_memory.SharedMemory(create=True, size=max(1, len(data)))
+    block.buf[:len(data)] = data
+    return block
+
+
+def read_shared(name, size):
+    block = shared_memory.SharedMemory(name=name)
+    try:
+        return bytes(block.buf[:size])
+    finally:
+        block.close()
+
+
+class PeakMemory:
+    """
+        Sample the resident memory of the current process in a background thread
+    """
+
+    def __init__(self, interval=0.2):
+        self.interval = interval
+        self.peak = 0
+        self._process = psutil.Process()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, self._process.memory_info().rss)
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self.peak = self._process.memory_info().rss
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, self._process.memory_info().rss)
+
+
+def profile_call(profiler, name, fn, args):
+    """
+        Run fn(*args) under cProfile or pyinstrument and save the profile as <folder>/<name>_<pid>
+    """
+    kind, folder = profiler
+    path = os.path.join(folder, '{}_{}'.format(re.sub(r'[^0-9A-Za-z_-]+', '_', str(name)), os.getpid()))
+    if kind == 'pyinstrument':
+        from pyinstrument import Profiler
+        profile = Profiler()
+        profile.start()
+        try:
+            return fn(*args)
+        finally:
+            profile.stop()
+            with open(f'{path}.html', 'w') as fp:
+                fp.write(profile.output_html())
+    profile = cProfile.Profile()
+    try:
+        return profile.runcall(fn, *args)
+    finally:
+        profile.dump_stats(f'{path}.prof')
+
+
+def run_task(fn, profiler, name, *args):
+    """
+        Run a task in the worker and return the result with the timing and peak resident memory of the worker
+    """
+    start = time.time()
+    with PeakMemory() as peak:
+        if profiler is None:
+            result = fn(*args)
+        else:
+            result = profile_call(profiler, name, fn, args)
+    return {'result': result, 'peak_rss': peak.peak, 'start': start, 'end': time.time(), 'pid': os.getpid()}
+
+
+class MemoryScheduler:
+    """
+        Run tasks in a process pool only when there is memory headroom for them.
+        Tasks that run out of memory are retried with fewer workers.
+    """
+
+    def __init__(self, workers=1, max_memory=None, history=None, profiler=None, preload=(), initializer=None,
+                 initargs=()):
+        self.workers = workers
+        # Modules imported by each worker when the pool starts
+        self.preload = preload
+        # Called once in each worker to set up the state shared by its tasks
+        self.initializer = initializer
+        self.initargs = initargs
+        # (cprofile|pyinstrument, folder) to profile each task
+        self.profiler = profiler
+        # Memory budget in bytes, defaults to the memory available at start
+        self.max_memory = max_memory
+        self.history_file = history
+        if self.history_file is None:
+            self.history_file = os.path.join(os.path.expanduser('~'), '.osmgo', 'memory_history.json')
+        self.history = self.read_history(self.history_file)
+        # Seconds per byte of input of each task key and task group from previous runs
+        self.cost_file = os.path.join(os.path.dirname(self.history_file), 'cost_history.json')
+        self.costs = self.read_history(self.cost_file)
+        self.tasks = []
+        self.failed = []
+        # Names of the finished tasks, a task starts once the tasks it runs after are finished
+        self.finished = set()
+
+    @staticmethod
+    def read_history(path):
+        if os.path.exists(path):
+            try:
+                with open(path) as fp:
+                    return json.load(fp)
+            except (ValueError, OSError):
+                pass
+        return {}
+
+    def write_history(self):
+        for path, history in [(self.history_file, self.history), (self.cost_file, self.costs)]:
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, 'w') as fp:
+                    json.dump(history, fp, indent=2)
+            except OSError as e:
+                print(f'Unable to write history {path} {e}')
+
+    def estimate(self, key, size):
+        """
+            Estimate the peak memory of a task from the input size and the history of the task key
+        """
+        return int(max(size, 1) * self.history.get(key, DEFAULT_RATIO))
+
+    def estimate_seconds(self, key, size, weight=1.0):
+        """
+            Estimate the run time of a task or task group from the history of the key.  Without history the
+            default rate is scaled by weight, a guess of how heavy the key is.
+        """
+        return max(size, 1) * self.costs.get(key, DEFAULT_SECONDS * weight)
+
+    def submit(self, key, size, fn, *args, group=None, cost=None, name=None, after=(), loads=None, split=None):
+        """
+            Queue fn(*args) to run in the pool.  key groups tasks with the same memory profile such as a theme
+            and size is the input size in bytes the task reads.  Tasks that split up one unit of work, such as
+            the parts of a theme, share a group so the cost of the whole group is recorded for the next run.
+            cost is the estimated run time, the longest tasks are started first.  after holds the names of the
+            tasks that must finish first, a task whose dependency failed is not run.  loads is the size in
+            bytes of the data handed to a task that does not read the PBF, such as a parsed GeoDataFrame, its
+            memory is estimated from that size instead.  split(scheduler, task) is called when the task runs out
+            of memory with one worker, it submits the task again as smaller parts and returns False when the
+            task cannot be split.
+        """
+        memory_key, memory_size = (key, size) if loads is None else (f'{key}:loaded', loads)
+        self.tasks.append({'key': key, 'size': size, 'fn': fn, 'args': args, 'group': group or key,
+                           'name': name or key, 'after': list(after), 'memory_key': memory_key,
+                           'memory_size': memory_size, 'estimate': self.estimate(memory_key, memory_size),
+                           'split': split, 'depth': 0,
+                           'cost': self.estimate_seconds(key, size) if cost is None else cost})
+
+    def worker_limit(self, budget):
+        if self.max_memory is None:
+            return None
+        return budget // self.workers
+
+    def run(self):
+        """
+            Run all queued tasks and return a record of each completed task with its result, peak memory,
+            queue wait and run time
+        """
+        # Tasks are only held back for memory when a budget is set
+        budget = self.max_memory
+        if budget is not None:
+            print('Memory budget {} MB'.format(round(budget / 1024 ** 2)))
+        pending = list(self.tasks)
+        # Longest tasks first so the workers finish together instead of one grinding on after the others,
+        # then the largest memory estimate so the big tasks do not queue behind the small ones
+        pending.sort(key=lambda task: (task['cost'], task['estimate']), reverse=True)
+        results = []
+
+        while len(pending) > 0:
+            retry = self.run_round(pending, budget, results)
+            if len(retry) == 0:
+                break
+            if self.workers == 1:
+                pending = self.split_tasks(retry)
+                continue
+            self.workers = max(1, self.workers // 2)
+            print(f'Retrying {len(retry)} tasks with {self.workers} workers')
+            for task in retry:
+                # Only a task running out of memory with one worker is split
+                task.pop('out_of_memory', None)
+            pending = retry
+
+        self.record_costs(results)
+        self.write_history()
+        return results
+
+    def record_costs(self, results):
+        """
+            Keep the seconds per byte of each task key and of each group of tasks for the next run.  Tasks of
+            one run sharing a key, such as the tiles or the chunks of a theme, keep the longest of them and a
+            group keeps the sum of its tasks.
+        """
+        rates = {}
+        groups = {}
+        for record in results:
+            rate = record['seconds'] / max(record['size'], 1)
+            rates[record['key']] = max(rate, rates.get(record['key'], 0))
+            if record['group'] != record['key']:
+                groups[record['group']] = groups.get(record['group'], 0) + rate
+        self.costs.update(rates)
+        self.costs.update(groups)
+
+    def split_tasks(self, tasks):
+        """
+            Submit the tasks that ran out of memory with one worker again as the smaller parts their split cuts
+            them into.  Returns the tasks to run next, the tasks that cannot be split fail.
+        """
+        pending = []
+        for task in tasks:
+            if not task.pop('out_of_memory', False):
+                # Not started because another task ran out of memory
+                pending.append(task)
+                continue
+            first = len(self.tasks)
+            if task['split'] is not None and task['depth'] < MAX_SPLIT_DEPTH and task['split'](self, task):
+                parts = self.tasks[first:]
+                for part in parts:
+                    part['depth'] = task['depth'] + 1
+                print('Task {} ran out of memory with 1 worker, split into {} parts'.format(task['name'],
+                                                                                           len(parts)))
+                pending.extend(parts)
+            else:
+                print('Task {} ran out of memory with 1 worker'.format(task['name']))
+                self.failed.append(task)
+        pending.sort(key=lambda task: (task['cost'], task['estimate']), reverse=True)
+        return pending
+
+    def skip_failed(self, pending):
+        """
+            Drop the pending tasks that run after a failed task, and the tasks that run after those
+        """
+        failed = set(task['name'] for task in self.failed)
+        skipped = [task for task in pending if failed.intersection(task['after'])]
+        while len(skipped) > 0:
+            for task in skipped:
+                print('Skipping task {}, {} failed'.format(task['name'], ','.join(failed.intersection(task['after']))))
+                pending.remove(task)
+                self.failed.append(task)
+                failed.add(task['name'])
+            skipped = [task for task in pending if failed.intersection(task['after'])]
+
+    def run_round(self, pending, budget, results):
+        """
+            Run pending tasks in one pool.  Returns the tasks to retry with fewer workers after a memory failure.
+        """
+        retry = []
+        running = {}
+        reserved = 0
+        # Name of the task last held back for memory, logged once while it waits
+        throttled = None
+        with ProcessPoolExecutor(max_workers=self.workers, initializer=init_worker,
+                                 initargs=(self.worker_limit(budget), self.preload, self.initializer,
+                                           self.initargs)) as executor:
+            while len(pending) > 0 or len(running) > 0:
+                self.skip_failed(pending)
+                # Start tasks while the budget and the free memory reported by the OS allow it
+                while len(pending) > 0 and len(running) < self.workers and len(retry) == 0:
+                    # The longest task whose dependencies are finished
+                    task = next((task for task in pending if self.finished.issuperset(task['after'])), None)
+                    if task is None:
+                        break
+                    if len(running) > 0 and budget is not None:
+                        available = psutil.virtual_memory().available
+                        if reserved + task['estimate'] > budget or task['estimate'] > available:
+                            if throttled != task['name']:
+                                print('Holding task {} needing {} MB, {} tasks use {} MB of the budget'.format(
+                                    task['name'], round(task['estimate'] / 1024 ** 2), len(running),
+                                    round(reserved / 1024 ** 2)))
+                                throttled = task['name']
+                            break
+                    pending.remove(task)
+                    task['submitted'] = time.time()
+                    running[executor.submit(run_task, task['fn'], self.profiler, task['key'], *task['args'])] = task
+                    reserved += task['estimate']
+
+                if len(running) == 0:
+                    if len(retry) == 0 and len(pending) > 0:
+                        for task in pending:
+                            print('Task {} waits on tasks that never run'.format(task['name']))
+                        self.failed.extend(pending)
+                        pending.clear()
+                        break
+                    # Stop submitting after a memory failure and let the caller shrink the pool
+                    retry.extend(pending)
+                    pending.clear()
+                    break
+
+                done, _ = wait(list(running), timeout=1, return_when=FIRST_COMPLETED)
+                for future in done:
+                    task = running.pop(future)
+                    reserved -= task['estimate']
+                    try:
+                        record = future.result()
+                    except (MemoryError, BrokenProcessPool) as e:
+                        print('Task {} out of memory {}'.format(task['key'], repr(e)))
+                        # Double the estimate so the retry leaves more room
+                        task['estimate'] *= 2
+                        task['out_of_memory'] = True
+                        retry.append(task)
+                        continue
+                    except Exception as e:
+                        print(f'Future Exception {e}')
+                        self.failed.append(task)
+                        continue
+                    self.finished.add(task['name'])
+                    ratio = record['peak_rss'] / max(task['memory_size'], 1)
+                    self.history[task['memory_key']] = max(ratio, self.history.get(task['memory_key'], 0) * 0.5)
+                    record['key'] = task['key']
+                    record['group'] = task['group']
+                    record['size'] = task['size']
+                    record['queue_wait'] = record['start'] - task['submitted']
+                    record['seconds'] = record['end'] - record['start']
+                    results.append(record)
+        return retry
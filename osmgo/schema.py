@@ -0,0 +1,83 @@
+import json
+
+# Tag columns parsed for each theme with --columns default, the other tags stay in the JSON tags column.
+# '*' is used for the themes that are not listed.
+DEFAULT_COLUMNS = {
+    '*': ['name', 'operator'],
+    'aeroway': ['name', 'ref', 'iata', 'icao', 'surface'],
+    'amenity': ['name', 'operator', 'opening_hours', 'addr:housenumber', 'addr:street', 'addr:city',
+                'addr:postcode', 'website'],
+    'boundary': ['name', 'admin_level', 'border_type', 'protect_class'],
+    'building': ['name', 'building:levels', 'height', 'addr:housenumber', 'addr:street', 'addr:city',
+                 'addr:postcode'],
+    'highway': ['name', 'ref', 'surface', 'lanes', 'maxspeed', 'oneway', 'bridge', 'tunnel', 'layer', 'access',
+                'service'],
+    'landuse': ['name', 'crop', 'residential'],
+    'natural': ['name', 'ele', 'water', 'wetland', 'leaf_type'],
+    'place': ['name', 'population', 'is_in'],
+    'power': ['name', 'operator', 'voltage', 'cables', 'line'],
+    'public_transport': ['name', 'ref', 'network', 'operator', 'bus', 'train'],
+    'railway': ['name', 'ref', 'gauge', 'electrified', 'usage', 'service', 'bridge', 'tunnel'],
+    'route': ['name', 'ref', 'network', 'operator', 'from', 'to'],
+    'shop': ['name', 'brand', 'operator', 'opening_hours', 'addr:housenumber', 'addr:street', 'addr:city'],
+    'tourism': ['name', 'operator', 'stars', 'website'],
+    'waterway': ['name', 'width', 'intermittent', 'tunnel', 'bridge'],
+}
+
+# Columns pyrosm adds to every theme besides the tag columns
+OSM_COLUMNS = ['id', 'osm_type', 'timestamp', 'version', 'changeset', 'visible', 'lon', 'lat', 'tags']
+
+# Text columns with at most this share of distinct values are stored as categoricals
+CATEGORY_RATIO = 0.5
+
+
+def read_columns(columns):
+    """
+        Tag columns per theme from 'default' or a JSON file of {theme: [tag, ...]}.  Themes missing from the
+        file use the default columns.  Returns (columns, error).
+    """
+    if columns == 'default':
+        return dict(DEFAULT_COLUMNS), None
+    try:
+        with open(columns) as fp:
+            schema = json.load(fp)
+    except (OSError, ValueError) as e:
+        return None, f'Unable to read columns {columns} {e}'
+    if not isinstance(schema, dict) or not all(isinstance(tags, list) and all(isinstance(tag, str) for tag in tags)
+                                               for tags in schema.values()):
+        return None, 'Columns must be a JSON object of theme: [tag, ...]'
+    return dict(DEFAULT_COLUMNS, **schema), None
+
+
+def theme_columns(columns, theme):
+    """
+        Tag columns of theme, None keeps the pyrosm default columns
+    """
+    if columns is None:
+        return None
+    tags = columns.get(theme, columns.get('*', []))
+    # pyrosm needs the area tag to tell closed lines from polygons
+    return [theme, 'area'] + [tag for tag in tags if tag not in [theme, 'area']]
+
+
+def compact(gdf):
+    """
+        Drop the columns that are empty and store the low cardinality text columns such as the theme key or
+        osm_type as categoricals
+    """
+    if gdf is None:
+        return None
+    empty = [column for column in gdf.columns if column != gdf.geometry.name and gdf[column].isna().all()]
+    if len(empty) > 0:
+        gdf = gdf.drop(columns=empty)
+    for column in gdf.columns:
+        if column == gdf.geometry.name or gdf[column].dtype != object:
+            continue
+        values = gdf[column].dropna()
+        try:
+            distinct = values.nunique()
+        except TypeError:  # Lists or dicts cannot be categories
+            continue
+        if distinct <= CATEGORY_RATIO * len(values):
+            gdf[column] = gdf[column].astype('category')
+    return gdf
@@ -0,0 +1,355 @@
+import json
+import os
+import queue
+import signal
+import socketserver
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import geopandas as gpd
+import shapely
+from pyrosm import OSM
+from osmgo.cache import pbf_fingerprint
+from osmgo.extract import region_name
+from osmgo.osmprocess import ProcessOSM, THEMES, FEATURES, kill_child_processes
+from osmgo.writer import DRIVERS
+from osmgo.scheduler import init_worker
+
+# Theme GeoDataFrames parsed once by the server, the forked workers inherit them without pickling
+_resident = {}
+
+# Seconds a finished request stays available to GET /jobs/<id>
+JOB_TTL = 3600
+
+
+def preload_themes(inputs, themes, cache=None):
+    """
+        Parse the themes of the whole PBF once and keep them resident with their spatial index built
+    """
+    posm = ProcessOSM(inputs, None, None, None, themes, FEATURES)
+    posm.cache = cache
+    if cache is not None:
+        posm.fingerprint = pbf_fingerprint(inputs)
+    posm.osm = OSM(inputs)
+    for theme, gdf in posm.read_themes(themes).items():
+        if gdf is not None:
+            # Build the index before the workers fork so each request only queries it
+            gdf.sindex
+        _resident[theme] = gdf
+
+
+def init_server_worker():
+    """
+        Worker initializer, Ctrl-C stops the server which then stops the workers
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    init_worker(modules=('osmgo.server',))
+
+
+def run_export(settings, job):
+    """
+        Run one export request in a worker.  Resident themes are cut to the clip extent, other themes are
+        parsed from the PBF like osmgo export.
+    """
+    begin_time = time.time()
+    output = os.path.join(settings['output'], job['id'])
+    os.makedirs(output, exist_ok=True)
+    posm = ProcessOSM(settings['inputs'], output, job['prefix'], job['ext'], job['themes'], job['features'])
+    posm.keep = job['keep']
+    posm.cache = settings['cache']
+    posm.fingerprint = settings['fingerprint']
+    if job['bbox'] is not None:
+        posm.bbox = job['bbox']
+        posm.load_clip()
+        posm.extent = ','.join(str(each) for each in job['bbox'])
+    elif job['clip'] is not None:
+        posm.clip_gdf = gpd.GeoDataFrame(geometry=[shapely.from_wkt(job['clip'])], crs='EPSG:4326')
+        posm.extent = posm.clip_gdf.geometry.unary_union.wkb_hex
+
+    geo = None if posm.clip_gdf is None else posm.clip_gdf.geometry.unary_union
+    for theme in job['themes']:
+        if theme in _resident:
+            gdf = _resident[theme]
+            if gdf is not None and geo is not None:
+                gdf = gdf.iloc[gdf.sindex.query(geo, predicate='intersects')]
+            posm.process_gdf(None if gdf is None else gdf.copy(), theme)
+        else:
+            if posm.osm is None:
+                posm.osm = OSM(settings['inputs']) if geo is None else OSM(settings['inputs'], geo)
+            posm.process_key(theme)
+    return {'outputs': sorted(os.listdir(output)), 'output': output, 'seconds': time.time() - begin_time}
+
+
+class ExportServer:
+    """
+        Keep the PBF and the preloaded themes resident and run export requests from a queue in a worker pool
+    """
+
+    def __init__(self, inputs, output, workers=1, max_queue=16, cache=None, themes=(), job_ttl=JOB_TTL):
+        self.inputs = inputs
+        self.output = output
+        self.workers = workers
+        self.cache = cache
+        # Themes kept resident, loaded again if a new pool is started without them
+        self.themes = list(themes)
+        self.job_ttl = job_ttl
+        self.fingerprint = None if cache is None else pbf_fingerprint(inputs)
+        # Bounded so a burst of requests is refused instead of piling up
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.slots = threading.Semaphore(workers)
+        self.stopping = threading.Event()
+        self.executor = None
+        self.dispatcher = threading.Thread(target=self.dispatch, daemon=True)
+
+    def start(self):
+        # Created after the preload so the workers fork with the resident themes
+        self.executor = ProcessPoolExecutor(max_workers=self.workers, initializer=init_server_worker)
+        self.dispatcher.start()
+
+    def restart(self):
+        """
+            Replace a pool broken by a worker that died, such as one killed for running out of memory.  The
+            resident themes live in the server process so the new workers fork with them, only themes missing
+            from it are loaded again.
+        """
+        print('Worker pool broken, starting a new pool')
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        missing = [theme for theme in self.themes if theme not in _resident]
+        if len(missing) > 0:
+            preload_themes(self.inputs, missing, cache=self.cache)
+        self.executor = ProcessPoolExecutor(max_workers=self.workers, initializer=init_server_worker)
+
+    def close(self):
+        """
+            Stop taking requests, fail the queued ones and stop the workers
+        """
+        self.stopping.set()
+        self.dispatcher.join()
+        while True:
+            try:
+                job = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            job['status'] = 'failed'
+            job['error'] = 'Server stopped'
+            job['done'].set()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        kill_child_processes(os.getpid())
+
+    def parse_request(self, body):
+        """
+            Validate an export request, returns (job, error)
+        """
+        try:
+            request = json.loads(body or b'{}')
+        except ValueError:
+            return None, 'Request is not valid JSON'
+        if not isinstance(request, dict):
+            return None, 'Request must be a JSON object'
+
+        def parse_list(name, choices):
+            values = request.get(name) or choices
+            if isinstance(values, str):
+                values = [each.strip() for each in values.split(',')]
+            missing = [each for each in values if each not in choices]
+            return values, missing
+
+        themes, missing = parse_list('themes', THEMES)
+        if len(missing) > 0:
+            return None, 'Theme {} is misspelled or missing'.format(','.join(missing))
+        features, missing = parse_list('features', FEATURES)
+        if len(missing) > 0:
+            return None, 'Feature {} is misspelled or missing'.format(','.join(missing))
+        ext = request.get('ext', 'shp')
+        if ext not in DRIVERS:
+            return None, 'Please select valid extension'
+
+        bbox = request.get('bbox')
+        clip = request.get('clip')
+        if bbox is not None and clip is not None:
+            return None, 'Clip data and BBOX selected'
+        if bbox is not None:
+            try:
+                bbox = [float(each) for each in (bbox.split(',') if isinstance(bbox, str) else bbox)]
+            except (TypeError, ValueError):
+                return None, 'bbox must be minx,miny,maxx,maxy'
+            if len(bbox) != 4 or bbox[0] >= bbox[2] or bbox[1] >= bbox[3]:
+                return None, 'Coordinates out of sequence'
+        if clip is not None:
+            try:
+                geom = shapely.from_wkt(clip)
+            except (shapely.errors.GEOSException, TypeError) as e:
+                return None, f'Invalid clip WKT {e}'
+            if geom is None or geom.geom_type not in ['Polygon', 'MultiPolygon']:
+                return None, 'Clip WKT must be a Polygon or MultiPolygon'
+
+        job_id = uuid.uuid4().hex[:12]
+        return {'id': job_id, 'themes': themes, 'features': features, 'ext': ext, 'bbox': bbox, 'clip': clip,
+                'prefix': region_name(request.get('prefix', 'osmgo')), 'keep': bool(request.get('keep', False)),
+                'status': 'queued', 'submitted': time.time()}, None
+
+    def submit(self, job):
+        """
+            Queue a job, returns False when the queue is full or the server is stopping
+        """
+        if self.stopping.is_set():
+            return False
+        job['done'] = threading.Event()
+        with self.lock:
+            self.evict_jobs()
+            self.jobs[job['id']] = job
+        try:
+            self.queue.put_nowait(job)
+        except queue.Full:
+            with self.lock:
+                del self.jobs[job['id']]
+            return False
+        return True
+
+    def dispatch(self):
+        """
+            Hand queued jobs to the pool as workers become free
+        """
+        settings = {'inputs': self.inputs, 'output': self.output, 'cache': self.cache,
+                    'fingerprint': self.fingerprint}
+        while not self.stopping.is_set():
+            try:
+                job = self.queue.get(timeout=1)
+            except queue.Empty:
+                continue
+            # Waits for a free worker without missing a stop
+            while not self.slots.acquire(timeout=1):
+                if self.stopping.is_set():
+                    # Put back so close fails it with the other queued jobs
+                    self.queue.put_nowait(job)
+                    return
+            job['status'] = 'running'
+            job['started'] = time.time()
+            request = {key: value for key, value in job.items() if key != 'done'}
+            try:
+                future = self.executor.submit(run_export, settings, request)
+            except BrokenProcessPool:
+                self.restart()
+                future = self.executor.submit(run_export, settings, request)
+            future.add_done_callback(lambda f, job=job: self.finish(job, f))
+
+    def finish(self, job, future):
+        self.slots.release()
+        try:
+            job.update(future.result())
+            job['status'] = 'done'
+            print('Done request {} after {} seconds.'.format(job['id'], round(job['seconds'], 0)))
+        except Exception as e:
+            job['status'] = 'failed'
+            job['error'] = repr(e)
+            print('Failed request {} {}'.format(job['id'], repr(e)))
+        job['finished'] = time.time()
+        job['done'].set()
+
+    def evict_jobs(self):
+        """
+            Forget the requests finished more than job_ttl seconds ago, called with the lock held
+        """
+        expired = time.time() - self.job_ttl
+        for job_id in [job_id for job_id, job in self.jobs.items() if job.get('finished', expired + 1) < expired]:
+            del self.jobs[job_id]
+
+    def job_status(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+        if job is None:
+            return None
+        return {key: value for key, value in job.items() if key not in ['done', 'clip']}
+
+    def status(self):
+        with self.lock:
+            running = sum(1 for job in self.jobs.values() if job['status'] == 'running')
+        return {'inputs': self.inputs, 'output': self.output, 'workers': self.workers,
+                'resident': sorted(_resident), 'queued': self.queue.qsize(), 'running': running}
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    """
+        POST /export queues a request, ?wait=1 answers when it is finished.
+        GET /jobs/<id> returns the job status and GET /status the server status.
+    """
+    export_server = None
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def reply(self, code, body):
+        data = json.dumps(body, default=str).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        path = urlparse(self.path).path.rstrip('/')
+        if path == '/status':
+            self.reply(200, self.export_server.status())
+        elif path.startswith('/jobs/'):
+            job = self.export_server.job_status(path.split('/')[-1])
+            if job is None:
+                self.reply(404, {'error': 'Unknown job'})
+            else:
+                self.reply(200, job)
+        else:
+            self.reply(404, {'error': 'Unknown path'})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path.rstrip('/') != '/export':
+            self.reply(404, {'error': 'Unknown path'})
+            return
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        job, error = self.export_server.parse_request(body)
+        if error is not None:
+            self.reply(400, {'error': error})
+            return
+        if not self.export_server.submit(job):
+            self.reply(503, {'error': 'Request queue is full'})
+            return
+        if parse_qs(url.query).get('wait', ['0'])[0] not in ['0', 'false']:
+            job['done'].wait()
+            self.reply(200, self.export_server.job_status(job['id']))
+        else:
+            self.reply(202, self.export_server.job_status(job['id']))
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(export_server, host='127.0.0.1', port=8765, socket_path=None):
+    """
+        Serve export requests over HTTP on host:port or on a Unix socket until interrupted
+    """
+    RequestHandler.export_server = export_server
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        httpd = UnixHTTPServer(socket_path, RequestHandler)
+        print(f'Serving on {socket_path}')
+    else:
+        httpd = ThreadingHTTPServer((host, port), RequestHandler)
+        print(f'Serving on http://{host}:{port}')
+    export_server.start()
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        print('Stopping server')
+    finally:
+        httpd.server_close()
+        export_server.close()
+        if socket_path is not None and os.path.exists(socket_path):
+            os.remove(socket_path)
@@ -0,0 +1,199 @@
+import json
+import numpy as np
+import geopandas as gpd
+import shapely
+from osmgo.schema import DEFAULT_COLUMNS, theme_columns
+
+# Themes whose closed ways are lines unless they are tagged area=yes
+LINE_THEMES = ['aerialway', 'barrier', 'highway', 'power', 'railway', 'route', 'waterway']
+
+# osmium node location stores, the file arrays are memory mapped files on disk
+NODE_STORES = ['sparse_file_array', 'dense_file_array', 'flex_mem']
+
+# Object types of the osmium type letters streamed
+OSM_TYPES = {'n': 'node', 'w': 'way'}
+
+# Columns of every streamed feature besides the tag columns of its theme
+STREAM_COLUMNS = ['id', 'osm_type', 'version', 'timestamp']
+
+
+def stream_available():
+    """
+        Streaming reads the PBF with the pyosmium 4 FileProcessor
+    """
+    try:
+        import osmium as pyosmium
+    except ImportError:
+        return False
+    return hasattr(pyosmium, 'FileProcessor')
+
+
+def is_polygon(theme, tags):
+    """
+        True when a closed way of the theme is an area
+    """
+    area = tags.get('area')
+    return area == 'yes' or (theme not in LINE_THEMES and area != 'no')
+
+
+def way_geometry(way, theme, tags):
+    """
+        Line or polygon of a way from the node locations, None when it has too few located nodes
+    """
+    coords = [(node.lon, node.lat) for node in way.nodes if node.location.valid()]
+    if len(coords) >= 4 and way.is_closed() and is_polygon(theme, tags):
+        return shapely.Polygon(coords)
+    if len(coords) < 2:
+        return None
+    return shapely.LineString(coords)
+
+
+def relation_geometry(relation, index):
+    """
+        Area of a multipolygon or boundary relation built from the member ways in the node index
+    """
+    lines = []
+    for member in relation.members:
+        if member.type != 'w':
+            continue
+        coords = index.way_coords(member.ref)
+        if coords is not None and len(coords) >= 2:
+            lines.append(shapely.LineString(coords))
+    if len(lines) == 0:
+        return None
+    geom = shapely.build_area(shapely.MultiLineString(lines))
+    return None if geom.is_empty else geom
+
+
+def index_geometries(refs, closed, index):
+    """
+        Lines or polygons of ways from their node ids, located in one lookup of the node index.  closed marks
+        the ways that are areas.  Ways with too few located nodes get None.
+    """
+    geoms = np.full(len(refs), None, dtype=object)
+    if len(refs) == 0:
+        return geoms
+    counts = np.array([len(each) for each in refs])
+    lon, lat = index.locate(np.concatenate(refs))
+    owner = np.repeat(np.arange(len(refs)), counts)
+    found = ~np.isnan(lon)
+    coords = np.column_stack([lon[found], lat[found]])
+    owner = owner[found]
+    located = np.bincount(owner, minlength=len(refs))
+    polygon = closed & (located >= 4)
+    line = ~polygon & (located >= 2)
+    for select, build in [(polygon, lambda xy, ids: shapely.polygons(shapely.linearrings(xy, indices=ids))),
+                          (line, lambda xy, ids: shapely.linestrings(xy, indices=ids))]:
+        if select.any():
+            keep = select[owner]
+            # The builders need indices numbered from 0 and return one geometry per index in increasing order
+            ids = np.unique(owner[keep], return_inverse=True)[1]
+            geoms[np.flatnonzero(select)] = build(coords[keep], ids)
+    return geoms
+
+
+class ThemeBatches:
+    """
+        Rows of one theme collected until there are enough for a batch
+    """
+
+    def __init__(self, theme, columns, index=None):
+        self.theme = theme
+        self.tags = theme_columns(columns or DEFAULT_COLUMNS, theme)
+        self.columns = STREAM_COLUMNS + self.tags + ['tags']
+        self.index = index
+        self.rows = []
+        self.geoms = []
+        # Positions, node ids and area flags of the ways located from the index when the batch is flushed
+        self.ways = []
+
+    def add(self, obj, osm_type, osm_id, tags, geom):
+        row = [osm_id, osm_type, obj.version, int(obj.timestamp.timestamp())]
+        row.extend(tags.get(tag) for tag in self.tags)
+        other = {key: value for key, value in tags.items() if key not in self.tags}
+        row.append(json.dumps(other) if len(other) > 0 else None)
+        self.rows.append(row)
+        self.geoms.append(geom)
+
+    def add_way(self, way, tags):
+        refs = np.array([node.ref for node in way.nodes], dtype=np.int64)
+        closed = len(refs) >= 4 and refs[0] == refs[-1] and is_polygon(self.theme, tags)
+        self.ways.append((len(self.rows), refs, closed))
+        self.add(way, 'way', way.id, tags, None)
+
+    def flush(self):
+        geoms = np.array(self.geoms, dtype=object)
+        if len(self.ways) > 0:
+            positions, refs, closed = zip(*self.ways)
+            geoms[list(positions)] = index_geometries(list(refs), np.array(closed), self.index)
+        keep = ~shapely.is_missing(geoms)
+        rows = [row for row, found in zip(self.rows, keep) if found]
+        gdf = gpd.GeoDataFrame(rows, columns=self.columns, geometry=geoms[keep], crs='EPSG:4326')
+        # Strings even when a batch has no value, so every appended batch has the same field types
+        gdf = gdf.astype({column: 'string' for column in self.columns
+                          if column not in ['id', 'version', 'timestamp']})
+        self.rows = []
+        self.geoms = []
+        self.ways = []
+        return gdf
+
+
+def read_batches(inputs, themes, columns=None, node_store='sparse_file_array', index_path=None, batch_size=50000,
+                 node_index=None):
+    """
+        Read the PBF block by block with pyosmium and yield (theme, GeoDataFrame) batches of at most batch_size
+        features.  With a NodeIndex of the PBF the ways and multipolygon relations are built from the index,
+        otherwise way nodes are located from node_store, the file stores are kept in index_path, and the
+        multipolygon relations are assembled by osmium.
+    """
+    import osmium as pyosmium
+    batches = {theme: ThemeBatches(theme, columns, node_index) for theme in themes}
+    if node_index is None:
+        storage = node_store if node_store == 'flex_mem' else f'{node_store},{index_path}'
+        processor = pyosmium.FileProcessor(inputs).with_locations(storage).with_areas()
+    else:
+        processor = pyosmium.FileProcessor(inputs)
+    factory = pyosmium.geom.WKBFactory()
+    for obj in processor.with_filter(pyosmium.filter.KeyFilter(*themes)):
+        if obj.is_area():
+            # Closed ways are built from their nodes, the areas of relations are taken from osmium
+            if obj.from_way():
+                continue
+            osm_type, osm_id = 'relation', obj.orig_id()
+        elif obj.is_relation():
+            if node_index is None or obj.tags.get('type') not in ['multipolygon', 'boundary']:
+                continue
+            osm_type, osm_id = 'relation', obj.id
+        else:
+            osm_type, osm_id = OSM_TYPES[obj.type_str()], obj.id
+        tags = {tag.k: tag.v for tag in obj.tags}
+        point = None
+        for theme in themes:
+            if theme not in tags:
+                continue
+            batch = batches[theme]
+            if osm_type == 'way' and node_index is not None:
+                batch.add_way(obj, tags)
+            else:
+                try:
+                    if osm_type == 'node':
+                        if point is None:
+                            point = shapely.Point(obj.lon, obj.lat)
+                        geom = point
+                    elif osm_type == 'way':
+                        geom = way_geometry(obj, theme, tags)
+                    elif node_index is not None:
+                        geom = relation_geometry(obj, node_index)
+                    else:
+                        geom = shapely.from_wkb(factory.create_multipolygon(obj))
+                except (RuntimeError, ValueError, shapely.errors.GEOSException):
+                    # Invalid locations or rings that cannot be assembled
+                    continue
+                if geom is None:
+                    continue
+                batch.add(obj, osm_type, osm_id, tags, geom)
+            if len(batch.rows) >= batch_size:
+                yield theme, batch.flush()
+    for theme, batch in batches.items():
+        if len(batch.rows) > 0:
+            yield theme, batch.flush()
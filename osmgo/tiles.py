@@ -0,0 +1,62 @@
+import glob
+import os
+import pandas as pd
+import geopandas as gpd
+
+
+def parse_tiles(tiles):
+    """
+        Parse a NxM tile grid string into (columns, rows)
+    """
+    try:
+        nx, ny = [int(each.strip()) for each in tiles.lower().split('x')]
+    except ValueError:
+        return None
+    if nx < 1 or ny < 1:
+        return None
+    return nx, ny
+
+
+def make_tiles(bounds, grid=None, tile_size=None):
+    """
+        Cut minx,miny,maxx,maxy into a grid of tiles, either NxM tiles or tiles of tile_size degrees
+    """
+    minx, miny, maxx, maxy = bounds
+    if tile_size is not None:
+        nx = max(1, int(-(-(maxx - minx) // tile_size)))
+        ny = max(1, int(-(-(maxy - miny) // tile_size)))
+    else:
+        nx, ny = grid
+    width = (maxx - minx) / nx
+    height = (maxy - miny) / ny
+    tiles = []
+    for j in range(ny):
+        for i in range(nx):
+            # Use the outer bounds on the last row/column to avoid floating point gaps
+            tiles.append([minx + i * width,
+                          miny + j * height,
+                          maxx if i == nx - 1 else minx + (i + 1) * width,
+                          maxy if j == ny - 1 else miny + (j + 1) * height])
+    return tiles
+
+
+def dedupe_osm(gdf):
+    """
+        Drop features repeated in neighbouring tiles using the OSM id
+    """
+    subset = [each for each in ['id', 'osm_type'] if each in gdf.columns]
+    if len(subset) == 0:
+        return gdf
+    return gdf.drop_duplicates(subset=subset)
+
+
+def merge_tiles(tile_dir, theme, geo):
+    """
+        Read the tile outputs of theme:geo and merge them into one GeoDataFrame without duplicates
+    """
+    tile_files = sorted(glob.glob(os.path.join(tile_dir, f'tile*_{theme}_{geo}.gpkg')))
+    if len(tile_files) == 0:
+        return None
+    gdfs = [gpd.read_file(each) for each in tile_files]
+    gdf = gpd.GeoDataFrame(pd.concat(gdfs, ignore_index=True), geometry='geometry', crs=gdfs[0].crs)
+    return dedupe_osm(gdf)
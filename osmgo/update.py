@@ -0,0 +1,214 @@
+import gzip
+import os
+import subprocess
+import time
+import xml.etree.ElementTree as ElementTree
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+from osmgo.writer import write_gdf, SHAPEFILE_PARTS
+from osmgo.index import SCALE
+
+try:
+    import pyogrio
+except ImportError:
+    pyogrio = None
+
+# Types of the objects in a change file
+OSM_TYPES = ['node', 'way', 'relation']
+
+# Tile size in decimal degrees the changes are located in when no tiles are given
+UPDATE_TILE_SIZE = 0.25
+
+
+def updated_path(inputs):
+    """
+        Default path of the updated PBF, next to the input with _updated before the .osm.pbf or .pbf extension
+    """
+    for ext in ['.osm.pbf', '.pbf']:
+        if inputs.endswith(ext):
+            return inputs[:-len(ext)] + '_updated' + ext
+    return f'{inputs}_updated.osm.pbf'
+
+
+def apply_changes(inputs, changes, output, osmconvert):
+    """
+        Apply .osc or .osc.gz change files to the PBF with osmconvert.  The update goes to a temporary file that
+        is renamed to output when complete, so output may be the input PBF.  Returns output or None.
+    """
+    begin_time = time.time()
+    temp = f'{output}.partial.pbf'
+    cmd = [osmconvert, inputs] + list(changes) + ['--out-pbf', f'-o={temp}']
+    result = subprocess.run(cmd, capture_output=True, text=True)
+    if result.returncode != 0 or not os.path.exists(temp):
+        print(result.stderr)
+        print('Unable to apply changes {}'.format(' '.join(cmd)))
+        if os.path.exists(temp):
+            os.remove(temp)
+        return None
+    os.replace(temp, output)
+    print('Applied {} change files to {} in {} seconds.'.format(len(changes), output,
+                                                              round(time.time() - begin_time, 0)))
+    return output
+
+
+def read_changes(changes, themes):
+    """
+        Scan change files for the objects they touch.  Returns a dict of
+        themes: theme keys tagged on the changed objects
+        changed: (osm_type, id) of every created, modified or deleted object
+        points: lon, lat of the changed nodes
+        relations: (member type, id) of each changed relation
+        moved: new lon, lat of each modified node and None for each deleted node, a node that moved reshapes
+        the ways and relations using it
+    """
+    found = {'themes': set(), 'changed': set(), 'points': [], 'relations': {}, 'moved': {}}
+    for change in changes:
+        opener = gzip.open if change.endswith('.gz') else open
+        with opener(change, 'rb') as fp:
+            action = None
+            for event, elem in ElementTree.iterparse(fp, events=('start', 'end')):
+                if event == 'start':
+                    if elem.tag in ['create', 'modify', 'delete']:
+                        action = elem.tag
+                    continue
+                if elem.tag not in OSM_TYPES:
+                    continue
+                osm_id = int(elem.get('id'))
+                found['changed'].add((elem.tag, osm_id))
+                found['themes'].update(tag.get('k') for tag in elem.iter('tag') if tag.get('k') in themes)
+                if elem.tag == 'node':
+                    location = None
+                    if elem.get('lon') is not None and elem.get('lat') is not None:
+                        location = (float(elem.get('lon')), float(elem.get('lat')))
+                        found['points'].append(location)
+                    if action != 'create':
+                        found['moved'][osm_id] = None if action == 'delete' else location
+                elif elem.tag == 'relation':
+                    found['relations'][osm_id] = [(member.get('type'), int(member.get('ref')))
+                                                  for member in elem.iter('member')]
+                elem.clear()
+    print('Changes touch {} objects and themes {}'.format(len(found['changed']), ','.join(sorted(found['themes']))))
+    return found
+
+
+def reshaped_ways(moved, index):
+    """
+        ('way', id) of the ways using a node that moved or was deleted, found through the node index of the PBF
+        before the update.  A modified node at its old location only changed its tags and reshapes nothing.
+        Returns None without an index holding the way node lists.
+    """
+    if index is None:
+        return None
+    if len(moved) == 0:
+        return set()
+    node_ids = np.array(sorted(moved), dtype=np.int64)
+    lon, lat = index.locate(node_ids)
+    shifted = []
+    for node_id, old_lon, old_lat in zip(node_ids.tolist(), lon, lat):
+        location = moved[node_id]
+        # Compared in the 1e-7 degree units the index stores
+        if location is None or np.isnan(old_lon) or round(location[0] * SCALE) != round(old_lon * SCALE) or \
+                round(location[1] * SCALE) != round(old_lat * SCALE):
+            shifted.append(node_id)
+    if len(shifted) == 0:
+        return set()
+    ways = index.node_ways(shifted)
+    return None if ways is None else set(('way', way) for way in ways)
+
+
+def locate_nodes(inputs, ways=(), nodes=(), index=None):
+    """
+        Locations of the nodes and of the nodes of the ways in the PBF, read from the node index of the PBF or
+        with the pyosmium id filter.  Returns None without either.
+    """
+    nodes = set(nodes)
+    if index is not None:
+        for way in ways:
+            refs = index.way_refs(way)
+            if refs is not None:
+                nodes.update(refs.tolist())
+        lon, lat = index.locate(sorted(nodes))
+        found = ~np.isnan(lon)
+        return list(zip(lon[found].tolist(), lat[found].tolist()))
+    try:
+        import osmium as pyosmium
+    except ImportError:
+        return None
+    if not hasattr(pyosmium, 'FileProcessor'):
+        return None
+    if len(ways) > 0:
+        for way in pyosmium.FileProcessor(inputs, pyosmium.osm.WAY).with_filter(pyosmium.filter.IdFilter(ways)):
+            nodes.update(node.ref for node in way.nodes)
+    if len(nodes) == 0:
+        return []
+    return [(node.location.lon, node.location.lat) for node in
+            pyosmium.FileProcessor(inputs, pyosmium.osm.NODE).with_filter(pyosmium.filter.IdFilter(nodes))
+            if node.location.valid()]
+
+
+def read_output(path, ext, layer=None, columns=None):
+    """
+        Read an output of a previous export, columns without geometry only reads the attributes
+    """
+    if ext == 'parquet':
+        if columns is not None:
+            return pd.read_parquet(path, columns=columns)
+        return gpd.read_parquet(path)
+    if pyogrio is not None:
+        return pyogrio.read_dataframe(path, layer=layer, columns=columns, read_geometry=columns is None)
+    gdf = gpd.read_file(path, layer=layer)
+    return gdf if columns is None else pd.DataFrame(gdf[columns])
+
+
+def output_keys(gdf):
+    """
+        (osm_type, id) of each row
+    """
+    if gdf is None or 'id' not in gdf.columns or 'osm_type' not in gdf.columns:
+        return []
+    return list(zip(gdf['osm_type'].astype(str), gdf['id'].astype('int64')))
+
+
+def splice(old, new, changed):
+    """
+        Replace the rows of the previous output that changed or were exported again with the new rows
+    """
+    if old is None or old.empty:
+        return new
+    drop = set(changed)
+    if new is not None:
+        drop.update(output_keys(new))
+    old = old[[key not in drop for key in output_keys(old)]]
+    if new is None or new.empty:
+        return old
+    gdf = gpd.GeoDataFrame(pd.concat([old, new], ignore_index=True), geometry=old.geometry.name, crs=old.crs)
+    # Tag columns the new rows bring without values, the previous output had dropped them as empty
+    empty = [column for column in new.columns if column not in old.columns and gdf[column].isna().all()]
+    return gdf.drop(columns=empty)
+
+
+def touched_tiles(tiles, points):
+    """
+        Tiles holding any of the points
+    """
+    tree = shapely.STRtree([shapely.box(*box) for box in tiles])
+    touched = set()
+    if len(points) > 0:
+        touched.update(tree.query(shapely.points(points), predicate='intersects')[1].tolist())
+    return [tiles[index] for index in sorted(touched)]
+
+
+def shapefile_columns(gdf, folder):
+    """
+        Round trip the rows through a shapefile so the column names are cut to 10 characters the same way
+        as in a previous shapefile output
+    """
+    path = os.path.join(folder, 'columns.shp')
+    write_gdf(gdf, path, 'shp')
+    gdf = read_output(path, 'shp')
+    for part in SHAPEFILE_PARTS:
+        if os.path.exists(os.path.join(folder, f'columns{part}')):
+            os.remove(os.path.join(folder, f'columns{part}'))
+    return gdf
@@ -1,8 +1,35 @@
 import glob
 import os
-import geopandas as gpd
+import time
 import fiona
 
+try:
+    import pyogrio
+except ImportError:
+    pyogrio = None
+
+
+def copy_layer(source, layer, output):
+    """
+        Copy a layer between GeoPackages without building a GeoDataFrame
+    """
+    if pyogrio is not None:
+        try:
+            # Arrow table copy, GDAL reads and writes the layer in bulk
+            meta, table = pyogrio.read_arrow(source, layer=layer)
+            pyogrio.write_arrow(table, output, layer=layer, driver='GPKG', geometry_name=meta['geometry_name'],
+                                geometry_type=meta['geometry_type'], crs=meta['crs'], encoding=meta['encoding'])
+            return
+        except Exception as e:
+            # pyogrio or GDAL built without arrow support, or the arrow write failed part way
+            print(f'Arrow copy of {layer} failed, copying with fiona {e}')
+        if os.path.exists(output) and layer in fiona.listlayers(output):
+            # Rows of a partly written layer would be copied twice
+            fiona.remove(output, driver='GPKG', layer=layer)
+    with fiona.open(source, layer=layer) as src:
+        with fiona.open(output, 'w', layer=layer, **src.meta) as dst:
+            dst.writerecords(src)
+
 
 def combine_gpkg(inputs, outputs, prefix):
 
@@ -13,11 +40,13 @@ def combine_gpkg(inputs, outputs, prefix):
             if prefix in each:
                 target_gpkg.append(each)
         for each in target_gpkg:
-            if len(fiona.listlayers(each)) == 1:
-                layername = fiona.listlayers(each)[0]
+            layers = fiona.listlayers(each)
+            if len(layers) == 1:
+                layername = layers[0]
                 print(layername)
-                gdf = gpd.read_file(each, layer=layername)
-                gdf.to_file(outputs, layer=layername, driver="GPKG")
+                begin_time = time.time()
+                copy_layer(each, layername, outputs)
+                print('Done {} in {} seconds.'.format(layername, round(time.time() - begin_time, 0)))
 
     else:
         print('No input files found')
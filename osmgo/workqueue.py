@@ -0,0 +1,272 @@
+import json
+import os
+import shutil
+import socket
+import threading
+import time
+import traceback
+
+# Seconds a claimed unit stays leased without a heartbeat before another worker may take it over
+LEASE_SECONDS = 120
+
+# Runs of a unit, including runs whose lease expired, before it is moved to failed
+MAX_ATTEMPTS = 3
+
+# Seconds between polls of a queue with no unit to claim
+POLL_SECONDS = 2
+
+# Folders a unit moves through
+QUEUE_STATES = ['todo', 'claimed', 'done', 'failed']
+
+
+def worker_id():
+    return '{}-{}'.format(socket.gethostname(), os.getpid())
+
+
+class WorkQueue:
+    """
+        Work queue in a folder shared by the hosts.  Each unit is a JSON file moved between the todo, claimed,
+        done and failed folders with atomic renames, so workers on any host claim units without a server or a
+        lock.  A worker touches its claimed file as a heartbeat and a claim not touched for longer than the
+        lease goes back to todo.
+    """
+
+    def __init__(self, folder, lease=LEASE_SECONDS):
+        self.folder = folder
+        self.lease = lease
+
+    def path(self, state, name=''):
+        return os.path.join(self.folder, state, name)
+
+    @staticmethod
+    def write(path, data):
+        # Written under a hidden name and renamed so other hosts never read half a file
+        temp = os.path.join(os.path.dirname(path), '.{}.{}.tmp'.format(os.path.basename(path), worker_id()))
+        with open(temp, 'w') as fp:
+            json.dump(data, fp)
+        os.replace(temp, path)
+
+    @staticmethod
+    def read(path):
+        with open(path) as fp:
+            return json.load(fp)
+
+    def read_job(self):
+        """
+            Settings of the queued export, None before the queue is started or after it is cleared
+        """
+        try:
+            job = self.read(os.path.join(self.folder, 'job.json'))
+        except (OSError, ValueError):
+            return None
+        self.lease = job.get('lease', self.lease)
+        return job
+
+    def names(self, state):
+        """
+            Unit ids in a state, claimed files carry the worker after the unit id
+        """
+        try:
+            files = os.listdir(self.path(state))
+        except FileNotFoundError:
+            return []
+        return sorted(name.split('.json')[0] for name in files if not name.startswith('.') and '.json' in name)
+
+    def counts(self):
+        return {state: len(self.names(state)) for state in QUEUE_STATES}
+
+    def clear(self):
+        for name in QUEUE_STATES + ['tiles']:
+            shutil.rmtree(self.path(name), ignore_errors=True)
+        if os.path.exists(os.path.join(self.folder, 'job.json')):
+            os.remove(os.path.join(self.folder, 'job.json'))
+
+    def start(self, job, units, keep=False):
+        """
+            Write the job and queue its units.  With keep a queue left by the same job keeps its finished units
+            and the units still claimed by its workers.
+        """
+        previous = self.read_job()
+        if not keep or previous is None or previous.get('key') != job['key']:
+            self.clear()
+        for state in QUEUE_STATES + ['tiles']:
+            os.makedirs(self.path(state), exist_ok=True)
+        queued = set(self.names('todo') + self.names('claimed') + self.names('done'))
+        for name in self.names('failed'):
+            # Failed units get a new set of attempts
+            os.remove(self.path('failed', f'{name}.json'))
+        for unit in units:
+            if unit['id'] not in queued:
+                self.write(self.path('todo', '{}.json'.format(unit['id'])), dict(unit, attempts=0))
+        # Written last so workers only start on a complete queue
+        self.lease = job['lease']
+        self.write(os.path.join(self.folder, 'job.json'), job)
+
+    def claim(self, worker):
+        """
+            Move the first unit waiting to claimed under the name of the worker, None when no unit is waiting
+        """
+        for name in self.names('todo'):
+            source = self.path('todo', f'{name}.json')
+            target = self.path('claimed', f'{name}.json.{worker}')
+            try:
+                # The lease starts now, not when the unit was queued
+                os.utime(source)
+                os.rename(source, target)
+            except FileNotFoundError:
+                # Claimed by another worker first
+                continue
+            unit = self.read(target)
+            unit['claim'] = target
+            return unit
+        return None
+
+    def heartbeat(self, unit):
+        """
+            Renew the lease of a claimed unit, raises FileNotFoundError when the lease was lost
+        """
+        os.utime(unit['claim'])
+
+    def complete(self, unit):
+        """
+            Move the unit to done, False when its lease expired and it went back to the queue
+        """
+        try:
+            os.rename(unit['claim'], self.path('done', '{}.json'.format(unit['id'])))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def retry(self, unit, error):
+        """
+            Queue the unit again after a failed run, or move it to failed after MAX_ATTEMPTS runs
+        """
+        unit = {key: value for key, value in unit.items() if key != 'claim'}
+        unit['attempts'] = unit.get('attempts', 0) + 1
+        unit['error'] = error
+        state = 'failed' if unit['attempts'] >= MAX_ATTEMPTS else 'todo'
+        self.write(self.path(state, '{}.json'.format(unit['id'])), unit)
+        return state
+
+    def fail(self, unit, error):
+        if not os.path.exists(unit['claim']):
+            # Lease lost, the unit is already back in the queue
+            return
+        self.retry(unit, error)
+        os.remove(unit['claim'])
+
+    def reclaim(self):
+        """
+            Put the units whose lease expired back in the queue.  Lease ages are measured against this host's
+            clock so the hosts need synchronised clocks.
+        """
+        now = time.time()
+        try:
+            files = os.listdir(self.path('claimed'))
+        except FileNotFoundError:
+            return
+        for name in files:
+            if name.startswith('.'):
+                continue
+            path = self.path('claimed', name)
+            try:
+                if now - os.path.getmtime(path) <= self.lease:
+                    continue
+                # Hidden while it is rewritten, only one host wins the rename
+                temp = self.path('claimed', f'.{name}')
+                os.rename(path, temp)
+            except FileNotFoundError:
+                continue
+            unit = self.read(temp)
+            worker = name.split('.json.', 1)[-1]
+            state = self.retry(unit, f'Lease held by {worker} expired')
+            os.remove(temp)
+            print('Lease of {} held by {} expired, unit moved to {}'.format(unit['id'], worker, state))
+
+
+class Heartbeat:
+    """
+        Renew the lease of a claimed unit in a background thread while the unit runs
+    """
+
+    def __init__(self, queue, unit):
+        self.queue = queue
+        self.unit = unit
+        self.lost = False
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _beat(self):
+        while not self._stop.wait(max(1, self.queue.lease / 4)):
+            try:
+                self.queue.heartbeat(self.unit)
+            except FileNotFoundError:
+                self.lost = True
+                print('Lost the lease of {}'.format(self.unit['id']))
+                return
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._beat, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._stop.set()
+        self._thread.join()
+
+
+def run_worker(folder, osmconvert=None, wait=60):
+    """
+        Claim and run units from the queue in folder until no unit is waiting or running.  A worker started
+        before the queue waits up to wait seconds for it.  Returns the number of units completed.
+    """
+    from osmgo.osmprocess import ProcessOSM
+    queue = WorkQueue(folder)
+    worker = worker_id()
+    posm = None
+    key = None
+    completed = 0
+    begin_time = time.time()
+    print(f'Worker {worker} on {folder}')
+    while True:
+        job = queue.read_job()
+        if job is None:
+            if time.time() - begin_time > wait:
+                print(f'No work queue in {folder}')
+                break
+            time.sleep(POLL_SECONDS)
+            continue
+        unit = queue.claim(worker)
+        if unit is None:
+            queue.reclaim()
+            counts = queue.counts()
+            if counts['todo'] == 0 and counts['claimed'] == 0:
+                break
+            # Units running elsewhere come back to todo if their worker dies
+            time.sleep(POLL_SECONDS)
+            continue
+
+        unit_time = time.time()
+        print('Worker {} running {}'.format(worker, unit['id']))
+        with Heartbeat(queue, unit) as heartbeat:
+            try:
+                if job['key'] != key:
+                    posm = ProcessOSM.from_queue_job(job, osmconvert)
+                    key = job['key']
+                tile_dir = queue.path('tiles', unit['theme'])
+                os.makedirs(tile_dir, exist_ok=True)
+                posm.process_unit(unit['theme'], unit['index'], unit['box'], tile_dir)
+            except (Exception, SystemExit) as e:
+                # ProcessOSM exits on bad input, here only the unit fails
+                traceback.print_exc()
+                queue.fail(unit, repr(e))
+                key = None
+                continue
+        if heartbeat.lost or not queue.complete(unit):
+            print('Unit {} was taken over by another worker'.format(unit['id']))
+            continue
+        completed += 1
+        print('Done unit {} after {} seconds.'.format(unit['id'], round(time.time() - unit_time, 0)))
+    print('Worker {} completed {} units after {} seconds.'.format(worker, completed,
+                                                                  round(time.time() - begin_time, 0)))
+    return completed
@@ -0,0 +1,239 @@
+import glob
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Manager
+
+try:
+    import pyogrio
+except ImportError:
+    pyogrio = None
+
+# Output extension and OGR driver, parquet is written by geopandas/pyarrow
+DRIVERS = {'shp': 'ESRI Shapefile', 'geojson': 'GeoJSON', 'gpkg': 'GPKG', 'fgb': 'FlatGeobuf', 'parquet': None}
+
+# Layer creation options per driver
+LAYER_OPTIONS = {'FlatGeobuf': {'SPATIAL_INDEX': 'YES'}}
+
+# Files of a shapefile, the .shp is renamed into place last
+SHAPEFILE_PARTS = ['.shx', '.dbf', '.prj', '.cpg', '.shp']
+
+# Output extensions a streamed export appends its batches to
+STREAM_EXTS = ['shp', 'gpkg']
+
+
+def use_arrow():
+    """
+        pyogrio writes through the GDAL Arrow stream interface with GDAL 3.8+ and pyarrow installed
+    """
+    if pyogrio is None or pyogrio.__gdal_version__ < (3, 8, 0):
+        return False
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def output_path(output, prefix, theme, geo, ext):
+    return os.path.join(output, f'{prefix}_{theme}_{geo}.{ext}')
+
+
+def write_gdf(gdf, path, ext, layer=None, append=False):
+    """
+        Write a GeoDataFrame in bulk with pyogrio when available, otherwise feature by feature with fiona
+    """
+    if ext == 'parquet':
+        gdf.to_parquet(path, compression='zstd')
+        return
+    driver = DRIVERS[ext]
+    if pyogrio is not None:
+        pyogrio.write_dataframe(gdf, path, layer=layer, driver=driver, append=append, use_arrow=use_arrow(),
+                                layer_options=LAYER_OPTIONS.get(driver))
+    else:
+        # fiona has no field type for categoricals
+        categories = [column for column in gdf.columns if gdf[column].dtype.name == 'category']
+        if len(categories) > 0:
+            gdf = gdf.astype({column: object for column in categories})
+        gdf.to_file(path, layer=layer, driver=driver, mode='a' if append else 'w', **LAYER_OPTIONS.get(driver, {}))
+
+
+def write_atomic(gdf, path, ext, layer=None):
+    """
+        Write to a temporary name next to path and rename it into place when complete, so an export that
+        dies never leaves a half written output under the final name
+    """
+    root = os.path.splitext(path)[0]
+    temp_root = f'{root}.partial{os.getpid()}'
+    if layer is None and ext not in ['shp', 'parquet']:
+        # The layer name would otherwise come from the temporary file name
+        layer = os.path.basename(root)
+    try:
+        write_gdf(gdf, f'{temp_root}.{ext}', ext, layer=layer)
+        replace_output(temp_root, path, ext)
+    finally:
+        for temp in glob.glob(glob.escape(temp_root) + '.*'):
+            os.remove(temp)
+
+
+def replace_output(temp_root, path, ext):
+    """
+        Rename the finished temporary output over path, the .shp of a shapefile last
+    """
+    root = os.path.splitext(path)[0]
+    if ext == 'shp':
+        for part in SHAPEFILE_PARTS:
+            if os.path.exists(temp_root + part):
+                os.replace(temp_root + part, root + part)
+            elif os.path.exists(root + part):
+                os.remove(root + part)
+    else:
+        os.replace(f'{temp_root}.{ext}', path)
+
+
+class StreamWriter:
+    """
+        Append batches to a temporary output that is renamed into place when closed, only formats GDAL
+        can append to are streamed
+    """
+
+    def __init__(self, path, ext, layer=None):
+        self.path = path
+        self.ext = ext
+        self.temp_root = '{}.partial{}'.format(os.path.splitext(path)[0], os.getpid())
+        self.layer = layer
+        if layer is None and ext != 'shp':
+            self.layer = os.path.basename(os.path.splitext(path)[0])
+        self.features = 0
+        self.fields = None  # Field names of a shapefile after the first batch cut them to 10 characters
+
+    def write(self, gdf):
+        path = f'{self.temp_root}.{self.ext}'
+        if self.fields is not None:
+            # Appended columns are matched to the shapefile fields by name
+            columns = [column for column in gdf.columns if column != gdf.geometry.name]
+            gdf = gdf.rename(columns=dict(zip(columns, self.fields)))
+        write_gdf(gdf, path, self.ext, layer=self.layer, append=self.features > 0)
+        if self.ext == 'shp' and self.fields is None:
+            if pyogrio is not None:
+                self.fields = list(pyogrio.read_info(path)['fields'])
+            else:
+                import geopandas as gpd
+                self.fields = [column for column in gpd.read_file(path, rows=0).columns if column != 'geometry']
+        self.features += len(gdf)
+
+    def close(self):
+        """
+            Rename the output into place and return the number of features written
+        """
+        replace_output(self.temp_root, self.path, self.ext)
+        return self.features
+
+
+def output_files(path, ext):
+    """
+        Files making up an output, a shapefile has its parts next to the .shp
+    """
+    if ext == 'shp':
+        root = os.path.splitext(path)[0]
+        return [root + part for part in SHAPEFILE_PARTS if os.path.exists(root + part)]
+    return [path]
+
+
+def remove_partial(output, names):
+    """
+        Remove the temporary files of the named outputs left by an export that was killed while writing.
+        Only exact names are matched, other exports may be writing to the same folder.
+    """
+    for name in names:
+        for temp in glob.glob(os.path.join(glob.escape(output), glob.escape(name) + '.partial*')):
+            os.remove(temp)
+
+
+class GpkgWriter:
+    """
+        Single writer thread appending the layers the workers put on the queue into one GeoPackage.
+        Each layer is written in one call so GDAL inserts it in one transaction and builds the rtree
+        index in bulk once the layer is complete.
+    """
+
+    def __init__(self, path, maxsize=4, manifest=None, keep=False):
+        self.path = path
+        self.manifest = manifest  # Manifest recording each layer written
+        self.keep = keep  # True keeps the layers of a previous run to resume it
+        self.manager = Manager()
+        # Bounded so workers block instead of piling finished layers up in memory
+        self.queue = self.manager.Queue(maxsize=maxsize)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        # First write error, raised by close so the export fails
+        self.error = None
+
+    def start(self):
+        if os.path.exists(self.path) and not self.keep:
+            os.remove(self.path)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            if self.error is not None:
+                # Keep taking layers off the queue so the workers do not block on a stopped writer
+                continue
+            layer, gdf, entry = item
+            begin_time = time.time()
+            try:
+                write_gdf(gdf, self.path, 'gpkg', layer=layer)
+            except Exception as e:
+                print(f'Unable to write {layer} to {self.path} {e}')
+                self.error = e
+                continue
+            if self.manifest is not None and entry is not None:
+                name, key = entry
+                self.manifest.record(name, key, [self.path], len(gdf))
+            print('Done {} in {} seconds to {}.'.format(layer, round(time.time() - begin_time, 0), self.path))
+
+    def close(self):
+        """
+            Wait for the queued layers to be written and raise the write error that stopped the writer
+        """
+        self.queue.put(None)
+        self.thread.join()
+        self.manager.shutdown()
+        if self.error is not None:
+            raise self.error
+
+
+class AsyncWriter:
+    """
+        Run writes on background threads so the worker can clip the next feature type while GDAL writes.
+        At most max_pending writes are queued or running, submit blocks until one finishes.
+    """
+
+    def __init__(self, threads=1, max_pending=2):
+        self.threads = threads
+        self.executor = ThreadPoolExecutor(max_workers=threads) if threads > 0 else None
+        self.slots = threading.BoundedSemaphore(max(1, max_pending))
+        self.futures = []
+
+    def submit(self, fn, *args):
+        if self.executor is None:
+            fn(*args)
+            return
+        # Backpressure, keeps at most max_pending GeoDataFrames waiting to be written
+        self.slots.acquire()
+        future = self.executor.submit(fn, *args)
+        future.add_done_callback(lambda f: self.slots.release())
+        self.futures.append(future)
+
+    def close(self):
+        """
+            Wait for all writes and raise the first write error
+        """
+        if self.executor is None:
+            return
+        self.executor.shutdown(wait=True)
+        for future in self.futures:
+            future.result()